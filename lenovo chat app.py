@@ -1,13 +1,32 @@
 import streamlit as st
 import sqlite3
 import json
+import pickle
 import datetime
 import pandas as pd
+import numpy as np
 import time
 import socket
 import re
 import base64
 import random
+import os
+import zlib
+import hashlib
+import io
+import html
+import queue
+import threading
+from collections import OrderedDict, deque
+import contextlib
+import abc
+import functools
+import cProfile
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import urllib.parse
+import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Try to import FPDF for PDF generation, handle if missing
 try:
@@ -16,6 +35,20 @@ try:
 except ImportError:
     HAS_FPDF = False
 
+# Pillow is optional too: without it attachments are stored but get no thumbnail
+try:
+    from PIL import Image
+    HAS_PIL = True
+except ImportError:
+    HAS_PIL = False
+
+# SciPy is optional: corpus analytics use sparse products with it, NumPy bincounts without
+try:
+    import scipy.sparse as sp
+    HAS_SCIPY = True
+except ImportError:
+    HAS_SCIPY = False
+
 # --- PAGE CONFIGURATION (Must be first) ---
 st.set_page_config(
     page_title="Lenovo Chat App", 
@@ -29,14 +62,226 @@ st.set_page_config(
     }
 )
 
+# --- PROFILING HOOKS (OPT-IN) ---
+# Enable with LENOVO_CHAT_PROFILE=1 or the toggle in the Manager DIAGNOSTICS tab
+PROFILE_ENABLED = os.environ.get("LENOVO_CHAT_PROFILE", "0") == "1"
+PROFILE_DIR = os.environ.get("LENOVO_CHAT_PROFILE_DIR", "profiles")
+PROFILE_KEEP_SLOWEST = 5   # cProfile dumps kept for the N slowest reruns
+PROFILE_SAMPLES = 500      # Rolling window per section
+
+class Profiler:
+    """Process-wide rolling timings per named section, shared by every session."""
+    def __init__(self):
+        self.enabled = PROFILE_ENABLED
+        self.cprofile = False
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.slowest = [] # (ms, path) of kept cProfile dumps, slowest first
+
+    @contextlib.contextmanager
+    def section(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def record(self, name, secs):
+        ms = secs * 1000
+        with self.lock:
+            sec = self.sections.get(name)
+            if sec is None:
+                sec = self.sections[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'samples': deque(maxlen=PROFILE_SAMPLES)}
+            sec['count'] += 1
+            sec['total_ms'] += ms
+            sec['max_ms'] = max(sec['max_ms'], ms)
+            sec['samples'].append(ms)
+
+    def begin_rerun(self):
+        if not self.enabled: return None
+        run = {'t0': time.perf_counter(), 'prof': None}
+        if self.cprofile:
+            try:
+                run['prof'] = cProfile.Profile()
+                run['prof'].enable()
+            except ValueError: run['prof'] = None # Another session is profiling right now
+        return run
+
+    def end_rerun(self, run):
+        if not run: return
+        ms = (time.perf_counter() - run['t0']) * 1000
+        self.record("rerun (total)", ms / 1000)
+        prof = run['prof']
+        if prof is None: return
+        prof.disable()
+        with self.lock:
+            if len(self.slowest) >= PROFILE_KEEP_SLOWEST and ms <= self.slowest[-1][0]: return
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f"rerun_{int(ms)}ms_{datetime.datetime.now():%Y%m%d_%H%M%S_%f}.prof")
+            prof.dump_stats(path)
+            self.slowest = sorted(self.slowest + [(ms, path)], reverse=True)
+            for _, old in self.slowest[PROFILE_KEEP_SLOWEST:]:
+                try: os.remove(old)
+                except OSError: pass
+            self.slowest = self.slowest[:PROFILE_KEEP_SLOWEST]
+
+    def abandon(self, run):
+        # Reruns cut short by st.rerun()/st.stop() never reach end_rerun
+        if run and run['prof']:
+            try: run['prof'].disable()
+            except: pass
+
+    def summary(self):
+        with self.lock:
+            rows = []
+            for name, sec in self.sections.items():
+                samples = sorted(sec['samples'])
+                rows.append({'SECTION': name, 'CALLS': sec['count'],
+                             'MEAN MS': round(sec['total_ms'] / sec['count'], 2),
+                             'P50 MS': round(samples[len(samples) // 2], 2),
+                             'P95 MS': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+                             'MAX MS': round(sec['max_ms'], 2), 'TOTAL MS': round(sec['total_ms'], 1)})
+            return rows
+
+    def reset(self):
+        with self.lock: self.sections.clear()
+
+@st.cache_resource
+def get_profiler():
+    return Profiler()
+
+NULL_SECTION = contextlib.nullcontext()
+
+def profile_section(name):
+    """Times the enclosed block when profiling is on; a shared no-op context otherwise."""
+    prof = get_profiler()
+    return prof.section(name) if prof.enabled else NULL_SECTION
+
+def profiled(name):
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with profile_section(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+# Close out a rerun that was interrupted by st.rerun(), then start timing this one
+get_profiler().abandon(st.session_state.pop('_profile_run', None))
+st.session_state['_profile_run'] = get_profiler().begin_rerun()
+
+# --- TRAFFIC RECORDER (OPT-IN) ---
+# Enable with LENOVO_CHAT_TRACE=path.jsonl or the toggle in the Manager DIAGNOSTICS tab; replay with tools/replay.py
+TRACE_FILE = os.environ.get("LENOVO_CHAT_TRACE", "")
+TRACE_DIR = os.environ.get("LENOVO_CHAT_TRACE_DIR", "traces")
+TRACE_FLUSH_S = 0.5 # Writer thread appends queued lines at most this often
+
+class TrafficRecorder:
+    """Appends one JSON line per traced data-layer call: wall-clock start, session, op, args,
+    duration, row count / result and error. A traced call only builds a dict and queues it;
+    a background thread writes. Starting takes a backup-API copy of every shard file next to
+    the trace (<trace>.base/), so a replay begins from the state the trace began in."""
+    def __init__(self):
+        self.path = None
+        self.q = queue.Queue()
+        self.lock = threading.Lock()
+        self.stats = {'recorded': 0, 'written': 0, 'errors': 0}
+        self.error = None
+        threading.Thread(target=self._run, name="lenovo-trace", daemon=True).start()
+
+    def start(self, path):
+        with self.lock:
+            if self.path: return self.path
+            base = path + ".base"
+            os.makedirs(base, exist_ok=True)
+            for shard in range(SHARD_COUNT):
+                src, dst = connect_db(get_shard_file(shard)), sqlite3.connect(os.path.join(base, os.path.basename(get_shard_file(shard))))
+                try: src.backup(dst, pages=SNAPSHOT_PAGES_PER_STEP, sleep=SNAPSHOT_STEP_SLEEP_S)
+                finally:
+                    dst.close()
+                    src.close()
+            self.q.put((path, {'op': 'start', 't': time.time(), 'db': os.path.basename(DB_FILE), 'shards': SHARD_COUNT,
+                               'group_commit': GROUP_COMMIT, 'base': os.path.basename(base)}))
+            self.path = path
+            return path
+
+    def stop(self):
+        with self.lock: self.path = None
+
+    def record(self, entry):
+        path = self.path
+        if not path: return
+        self.stats['recorded'] += 1
+        self.q.put((path, entry))
+
+    def _run(self):
+        while True:
+            items = [self.q.get()]
+            time.sleep(TRACE_FLUSH_S)
+            while True:
+                try: items.append(self.q.get_nowait())
+                except queue.Empty: break
+            by_path = {}
+            for path, entry in items: by_path.setdefault(path, []).append(entry)
+            for path, entries in by_path.items():
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                    with open(path, "a", encoding="utf-8") as f:
+                        f.write("".join(json.dumps(e, default=trace_json) + "\n" for e in entries))
+                    self.stats['written'] += len(entries)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    self.error = str(e)
+
+@st.cache_resource
+def get_recorder():
+    rec = TrafficRecorder()
+    if TRACE_FILE: rec.start(TRACE_FILE)
+    return rec
+
+def trace_json(o):
+    # numpy / pandas scalars (room ids out of DataFrames) -> plain Python
+    return o.item() if hasattr(o, 'item') else str(o)
+
+def trace_session():
+    """Browser session making the call; job/writer threads (no script context) record their thread name."""
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id[:8] if ctx else threading.current_thread().name
+
+def traced(op, method=False):
+    """Records calls of the decorated data-layer function while the recorder is on."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            rec = get_recorder()
+            if not rec.path: return fn(*args, **kwargs)
+            t_wall, t0, error, result = time.time(), time.perf_counter(), None, None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            except Exception as e:
+                error = e
+                raise
+            finally:
+                entry = {'t': t_wall, 'session': trace_session(), 'op': op, 'args': list(args[1:] if method else args),
+                         'ms': round((time.perf_counter() - t0) * 1000, 3)}
+                if kwargs: entry['kwargs'] = kwargs
+                if isinstance(result, pd.DataFrame): entry['rows'] = len(result)
+                elif isinstance(result, (int, str)): entry['result'] = result
+                if error is not None: entry['error'] = repr(error)
+                rec.record(entry)
+        return inner
+    return wrap
+
 # --- CUSTOM CSS STYLING (FUTURISTIC UI) ---
-st.markdown("""
+with profile_section("css/audio injection"):
+    st.markdown("""
 <style>
     /* IMPORT FUTURISTIC FONTS */
     @import url('https://fonts.googleapis.com/css2?family=Rajdhani:wght@400;600;700&family=Roboto+Mono:wght@300;400;500&display=swap');
 
     /* --- GLOBAL HIDES --- */
-    #MainMenu, footer, .stDeployButton, [data-testid="stToolbar"] {
+    #MainMenu, footer, .stDeployButton, [data-testid="stToolbar"], [class*="st-key-push_refresh_"] {
         visibility: hidden;
         display: none;
     }
@@ -188,6 +433,21 @@ st.markdown("""
         font-style: italic;
     }
     
+    /* --- WALL VIEW --- */
+    .wall-card {
+        background: rgba(0, 0, 0, 0.6);
+        border: 1px solid #333;
+        border-left: 4px solid #444;
+        padding: 10px 12px;
+        margin-bottom: 6px;
+        font-size: 0.85em;
+    }
+    .wall-card.wall-ok { border-left-color: #00ffcc; }
+    .wall-card.wall-warn { border-left-color: #ffcc00; }
+    .wall-card.wall-crit { border-left-color: #ff3b30; }
+    .wall-title { font-family: 'Rajdhani', sans-serif; font-weight: 700; letter-spacing: 1px; color: #fff; }
+    .wall-last { color: #999; font-style: italic; white-space: nowrap; overflow: hidden; text-overflow: ellipsis; }
+
     /* --- SCENARIO CARD --- */
     .scenario-card {
         background: rgba(226, 35, 26, 0.1);
@@ -253,10 +513,149 @@ st.markdown("""
     });
     observer.observe(window.parent.document.body, { childList: true, subtree: true });
 </script>
-""", unsafe_allow_html=True)
+    """, unsafe_allow_html=True)
 
 # --- CONSTANTS & DICTIONARIES ---
-DB_FILE = "qa_database.db"
+DB_FILE = os.environ.get("LENOVO_CHAT_DB", "qa_database.db")
+
+# SHARDING: Rooms (and their messages) can be spread over several SQLite files.
+# 1 shard = classic single-file layout. SQLite attaches at most 10 extra files.
+SHARD_COUNT = max(1, min(11, int(os.environ.get("LENOVO_CHAT_SHARDS", "1"))))
+SHARD_STRATEGY = os.environ.get("LENOVO_CHAT_SHARD_BY", "range") # 'range' (room id blocks) or 'cohort' (host)
+SHARD_RANGE_SIZE = 100
+
+# MULTI-WORKER: Several app processes (one port each, behind a local reverse proxy) share the database
+# files. Turns on WAL, cross-process hub sync, and per-worker side-channel ports / metrics files.
+MULTI_WORKER = os.environ.get("LENOVO_CHAT_MULTI_WORKER", "0") == "1"
+WORKER_ID = int(os.environ.get("LENOVO_CHAT_WORKER_ID", "0")) # Worker 0 also runs the scheduled retention purge
+WORKER_SYNC_S = float(os.environ.get("LENOVO_CHAT_WORKER_SYNC", "0.25")) # Hub picks up other workers' commits this often
+CLEAR_WAIT_S = 10.0 # A concurrent clear of the same room waits this long for the first one's replacement
+
+# GROUP COMMIT: send_msg calls from all sessions are batched by one writer thread
+GROUP_COMMIT = os.environ.get("LENOVO_CHAT_GROUP_COMMIT", "1") == "1"
+GROUP_COMMIT_WINDOW_MS = 4  # Max time a message waits for company before commit
+GROUP_COMMIT_MAX_BATCH = 256
+
+# RATE LIMITS: Token buckets in front of UI sends (per user, per room) + global backpressure
+RATE_LIMITS = os.environ.get("LENOVO_CHAT_RATE_LIMITS", "1") == "1"
+RATE_USER_PER_S = 1.0        # Sustained messages/second per user...
+RATE_USER_BURST = 6          # ...after a burst of this many
+RATE_ROOM_PER_S = 3.0        # Whole room, all participants together
+RATE_ROOM_BURST = 12
+RATE_MAX_BUCKETS = 10000     # Idle (full) buckets are dropped beyond this
+BACKPRESSURE_WRITE_MS = 150  # Write latency (EWMA, lock waits included) that turns backpressure on
+BACKPRESSURE_MAX_DELAY_S = 1.0
+BACKPRESSURE_RATE_FACTOR = 0.5 # Bucket refill rates are scaled by this while it is on
+
+# ROOM HUB: Recent messages + status of hot rooms, shared by every session in the process
+HUB_MAX_ROOMS = 200  # Coldest rooms are evicted (LRU) beyond this
+HUB_RING_SIZE = 100  # Messages kept per room; must cover the live feed limit (50)
+MESSAGE_FIELDS = ['id', 'room_id', 'sender', 'role', 'text', 'timestamp_ms', 'flags']
+ROOM_FIELDS = ['id', 'host', 'agent', 'status', 'scenario_id', 'created_at_ms', 'last_activity_ms', 'graded_at_ms', 'updated_at_ms']
+
+# COMPLIANCE SCAN: Critical phrases flagged in Agent messages as they are written (messages.flags)
+COMPLIANCE_LISTS = ('cxCritical', 'compCritical') # KEYWORDS lists, in the order grading reports them
+COMPLIANCE_ROLES = ('Agent',)
+COMPLIANCE_ALERTS_MAX = 50 # Recent flagged messages the hub keeps for the managers' sidebar
+
+# TIMESTAMPS: Stored as INTEGER epoch ms (indexed); formatted only for display/export
+TS_MS_COLUMNS = [('rooms', 'created_at_ms', 'created_at'), ('rooms', 'last_activity_ms', 'last_activity'),
+                 ('messages', 'timestamp_ms', 'timestamp')]
+CATALOG_TS_MS_COLUMNS = [('attachments', 'created_at_ms', 'created_at')] # Tables only the catalog file has
+EXPORT_MAX_ROWS = 50000
+
+# BACKGROUND JOBS: Grading / report / clear-and-recreate run off the script thread
+JOB_WORKERS = max(1, int(os.environ.get("LENOVO_CHAT_JOB_WORKERS", "2")))
+JOB_KEEP = 200  # Finished jobs kept for polling sessions (and result reuse)
+JOB_POLL_SECONDS = 1.0
+
+# ROOM LIST: Sidebar reads a process-wide index refreshed by change watermark, paged in the UI
+ROOM_INDEX_FIELDS = ['id', 'host', 'agent', 'status', 'created_at_ms', 'updated_at_ms']
+ROOM_INDEX_REFRESH_S = 1.0   # Sessions share one refresh per interval
+ROOM_INDEX_SLACK_MS = 5000   # Re-read window for writes stamped before they committed
+ROOM_PAGE_SIZE = 15
+ROOM_STATUS_FILTERS = ["ACTIVE", "ALL", "EXPIRED", "OFFLINE"]
+
+# PRESENCE: Who is connected / typing per room, in memory with TTL expiry
+PRESENCE_TTL_S = 15.0      # No heartbeat for this long = disconnected
+TYPING_TTL_S = 4.0         # A typing beacon counts for this long
+PRESENCE_HEARTBEAT_MS = 5000
+TYPING_THROTTLE_MS = 1500  # Client sends at most one typing beacon per window
+
+# SIDE CHANNEL: Small asyncio HTTP server next to Streamlit for browser beacons (0 disables)
+SIDE_CHANNEL_PORT = int(os.environ.get("LENOVO_CHAT_SIDE_PORT", "8765"))
+if SIDE_CHANNEL_PORT > 0: SIDE_CHANNEL_PORT += WORKER_ID # Browsers reach their own worker's channel
+SIDE_CHANNEL_HOST = os.environ.get("LENOVO_CHAT_SIDE_HOST", "127.0.0.1") # Set to the app's interface for remote browsers
+SIDE_CHANNEL_MAX_BODY = 4096
+SIDE_CHANNEL_GRANT_TTL_S = 120.0 # Session token stays valid for a room this long after its last page run
+
+# PUSH: Side channel streams room events (SSE) so the chat fragment reruns on change, not on a timer
+PUSH_POLL_SECONDS = 2.5            # Fragment polling when the browser has no event stream
+PUSH_FALLBACK_POLL_SECONDS = 10.0  # Safety-net polling (timers, missed events) while subscribed
+PUSH_PING_SECONDS = 15.0           # Keep-alive comment; a failed write drops the subscriber
+PUSH_DEBOUNCE_MS = 150             # Client coalesces bursts into one refresh
+PUSH_MAX_SUBSCRIBERS = 500
+
+# SNAPSHOT: Read-only copy of every shard (sqlite3 backup API) for exports, grading sweeps, analytics
+SNAPSHOT_DIR = os.environ.get("LENOVO_CHAT_SNAPSHOT_DIR", os.path.splitext(DB_FILE)[0] + "_snapshot")
+SNAPSHOT_INTERVAL_S = float(os.environ.get("LENOVO_CHAT_SNAPSHOT_INTERVAL", "300")) # Background refresh (0 = on demand only)
+SNAPSHOT_MAX_AGE_S = float(os.environ.get("LENOVO_CHAT_SNAPSHOT_MAX_AGE", "900"))   # Readers refresh first beyond this
+SNAPSHOT_PAGES_PER_STEP = 1024 # Backup copies this many pages, then lets writers in
+SNAPSHOT_STEP_SLEEP_S = 0.005
+
+# ANALYTICS: Corpus-wide phrase / sentiment / criterion stats from a cached term-by-message matrix
+ANALYTICS_CACHE = os.environ.get("LENOVO_CHAT_ANALYTICS_CACHE", os.path.join(SNAPSHOT_DIR, "term_matrix.npz"))
+ANALYTICS_SLACK_MS = 5000 # Re-read window for messages stamped before they committed
+ANALYTICS_TERM_CHUNK = 64 # Terms per rooms x terms block (bounds memory on big corpora)
+PASS_SCORE = 85
+
+# CONFIG CACHE: Parsed config shared per process, re-validated via config.version at most this often
+CONFIG_CHECK_SECONDS = 2.0
+CONFIG_MISSING = "missing" # ConfigCache version for a key with no row yet (cached and re-checked like any other)
+
+# SCENARIOS: Reusable sim definitions in the catalog file; rooms reference one by id
+SCENARIO_FIELDS = ['name', 'product', 'issue', 'difficulty']
+SCENARIO_DIFFICULTIES = ["EASY", "MEDIUM", "HARD"]
+DEFAULT_SCENARIOS = [
+    {"name": "John Doe", "product": "ThinkPad X1", "issue": "Blue Screen of Death when launching games.", "difficulty": "MEDIUM"},
+    {"name": "Priya Shah", "product": "Legion 5 Pro", "issue": "Fans get very loud and the laptop overheats during long gaming sessions.", "difficulty": "EASY"},
+    {"name": "Marco Rossi", "product": "Yoga 9i", "issue": "Third battery swap this year; wants a refund, not another repair.", "difficulty": "HARD"},
+    {"name": "Emily Chen", "product": "IdeaPad 3", "issue": "Student on a budget comparing it with a cheaper competitor model.", "difficulty": "MEDIUM"},
+]
+
+# RETENTION: Policy-driven purge of old rooms in short write transactions (policies live in config 'retention')
+RETENTION_INTERVAL_S = float(os.environ.get("LENOVO_CHAT_RETENTION_INTERVAL", "0")) # 0 = on demand only
+RETENTION_BATCH_ROWS = 500      # Starting message rows per delete; adapts towards RETENTION_MAX_LOCK_MS
+RETENTION_MAX_LOCK_MS = 25.0    # Target write-lock hold per batch
+RETENTION_ROOMS_PER_BATCH = 100 # Rooms per statement (stays under SQLite's bound-parameter limit)
+RETENTION_PAUSE_S = 0.01        # Gap between batches so queued sends get the lock
+RETENTION_VACUUM_PAGES = 256    # Pages released per incremental_vacuum step
+TOMBSTONE_TTL_MS = 7 * 86400 * 1000 # room_deletions kept this long; an older room index watermark reloads fully
+DEFAULT_RETENTION = [
+    {"name": "Abandoned sims", "statuses": ["Expired", "Offline"], "older_than_days": 30, "graded": False},
+    {"name": "Graded sims", "statuses": [], "older_than_days": 180, "graded": True},
+]
+
+# SESSION STATE: Per-room UI state lives in one bounded namespace per browser session
+SESSION_MAX_ROOMS = int(os.environ.get("LENOVO_CHAT_SESSION_ROOMS", "10")) # Least recently opened room dropped beyond this
+ROOM_WIDGET_KEYS = ("chat_input_{rid}", "push_refresh_{rid}", "upload_{rid}", "radio_{rid}") # Key, or key prefix + "_"
+SESSION_REPORT_SECONDS = 30.0 # Size estimate of a session refreshed at most this often
+SESSION_STALE_S = 900.0       # Sessions not seen for this long drop out of the process total
+
+# WALL VIEW: Manager overview of many rooms, one batched query per tick
+WALL_MAX_ROOMS = 60
+WALL_WINDOW = 20 # Recent messages per room fed to sentiment + provisional score
+
+# INSTRUMENTATION: Per-statement timings for every SQLite call
+SLOW_QUERY_MS = float(os.environ.get("LENOVO_CHAT_SLOW_QUERY_MS", "50")) # EXPLAIN QUERY PLAN captured above this
+METRICS_FILE = os.environ.get("LENOVO_CHAT_METRICS_FILE", f"lenovo_chat_metrics.w{WORKER_ID}.prom" if MULTI_WORKER else "lenovo_chat_metrics.prom")
+LATENCY_BUCKETS_MS = (0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000)
+
+# ATTACHMENTS: Content-addressed blob store. Messages only carry "[ATTACHMENT]:<id>"
+BLOB_DIR = os.environ.get("LENOVO_CHAT_BLOBS", "attachments")
+ATTACHMENT_PREFIX = "[ATTACHMENT]:"
+LEGACY_ATTACHMENT_PREFIX = "[ATTACHMENT SENT]" # Old simulated attachments, no file behind them
+THUMB_SIZE = (480, 320)
 
 # SOUNDS: Working Short Base64 WAV Files (Click & Chime)
 # These are short, valid, monophonic 8-bit WAV files encoded in Base64.
@@ -404,6 +803,27 @@ SCORECARD_STRUCTURE = {
     ]
 }
 
+# 5. GRADING RULES (DSL)
+# rule = {"phrases": [...], "regex": [...], "roles": ["Agent"], "min_count": 1, "negative": [...]}
+# Hits of phrases + regex (case-insensitive) in the chosen roles' text must reach min_count and
+# no negative phrase may appear. A list of rules means "any of". No phrases/regex = subjective (PASS).
+SPECIAL_RULES = {
+    'greet': {"regex": [INTENT_REGEX['greeting']]},
+    'discovery': [{"regex": [INTENT_REGEX['question']]}, {"regex": [r"\?"], "min_count": 2}],
+    'warranty': {"regex": [INTENT_REGEX['warranty']]},
+    'empathy': {"regex": [INTENT_REGEX['empathy']]},
+    'end_prof': {"regex": [INTENT_REGEX['closing']]},
+    'product': {"phrases": KEYWORDS['products']},
+    'objection': {"phrases": KEYWORDS['objection']},
+}
+RULE_ROLES = ["Agent", "Manager"]
+
+def default_rule(item):
+    """Rule equivalent to the pre-DSL grading for an item (also used for saved configs without 'rule')."""
+    if item.get('id') in SPECIAL_RULES: return SPECIAL_RULES[item['id']]
+    kws = KEYWORDS.get(item.get('keywords', ''), [])
+    return {"phrases": kws} if kws else {}
+
 # Flatten for DB
 DEFAULT_SCORECARD = []
 for cat, items in SCORECARD_STRUCTURE.items():
@@ -419,189 +839,2236 @@ for cat, items in SCORECARD_STRUCTURE.items():
             "keywords": kw,
             "category": cat
         })
+        DEFAULT_SCORECARD[-1]['rule'] = default_rule(DEFAULT_SCORECARD[-1])
+
+CRITICAL_DEFINITIONS = {
+    "CX Critical": ["Rude attitude or sarcasm.", "Providing misleading information.", "Chat Dumping."],
+    "Business Critical": ["Stacking discounts.", "Unauthorized prices.", "Misrepresenting specs."],
+    "Compliance Critical": ["PCI DSS: Asking for Credit Card info.", "GDPR: Sharing personal data."]
+}
+
+# --- QUERY INSTRUMENTATION ---
+class QueryStats:
+    """Process-wide per-statement counters: calls, latency histogram, errors, rows returned.
+    Statements slower than SLOW_QUERY_MS land in a slow log with their query plan."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stmts = {}
+        self.slow_log = deque(maxlen=200)
+        self.plans = {}
+
+    @staticmethod
+    def normalize(sql):
+        # Inline numbers (e.g. LIMIT 50) would otherwise split one statement into many
+        return re.sub(r"\b\d+\b", "?", " ".join(sql.split()))[:300]
+
+    def _stmt(self, key):
+        st_ = self.stmts.get(key)
+        if st_ is None:
+            st_ = self.stmts[key] = {'count': 0, 'errors': 0, 'lock_errors': 0, 'rows': 0, 'sum_ms': 0.0,
+                                     'max_ms': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+        return st_
+
+    def record(self, key, ms, error=None):
+        with self.lock:
+            st_ = self._stmt(key)
+            st_['count'] += 1
+            st_['sum_ms'] += ms
+            st_['max_ms'] = max(st_['max_ms'], ms)
+            i = 0
+            while i < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[i]: i += 1
+            st_['buckets'][i] += 1
+            if error is not None:
+                st_['errors'] += 1
+                msg = str(error).lower()
+                if "locked" in msg or "busy" in msg: st_['lock_errors'] += 1
+
+    def record_rows(self, key, n):
+        with self.lock: self._stmt(key)['rows'] += n
+
+    def record_slow(self, key, ms, plan):
+        with self.lock:
+            if plan is not None: self.plans[key] = plan
+            self.slow_log.append({'at': datetime.datetime.now(), 'stmt': key, 'ms': ms, 'plan': self.plans.get(key)})
+
+    def snapshot(self):
+        with self.lock:
+            return {k: dict(v, buckets=list(v['buckets'])) for k, v in self.stmts.items()}, list(self.slow_log)
+
+    def reset(self):
+        with self.lock:
+            self.stmts.clear()
+            self.slow_log.clear()
+            self.plans.clear()
+
+@st.cache_resource
+def get_query_stats():
+    return QueryStats()
+
+class InstrumentedCursor(sqlite3.Cursor):
+    _key = None
+
+    def _timed(self, method, sql, params, explain_params=None):
+        key = QueryStats.normalize(sql)
+        self._key = key
+        t0 = time.perf_counter()
+        try:
+            result = method(sql, params)
+        except Exception as e:
+            self.connection.stats.record(key, (time.perf_counter() - t0) * 1000, e)
+            raise
+        ms = (time.perf_counter() - t0) * 1000
+        stats = self.connection.stats
+        stats.record(key, ms)
+        if ms >= SLOW_QUERY_MS:
+            stats.record_slow(key, ms, self._explain(sql, params if explain_params is None else explain_params) if key not in stats.plans else None)
+        return result
+
+    def _explain(self, sql, params):
+        if sql.lstrip().split(None, 1)[0].upper() not in ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT", "REPLACE"):
+            return None
+        try:
+            rows = sqlite3.Cursor(self.connection).execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+            return "\n".join(r[-1] for r in rows)
+        except sqlite3.Error: return None
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params)
+
+    def executemany(self, sql, seq):
+        # Listed once: the plan of a slow batch is explained with its first row's parameters
+        seq = list(seq)
+        return self._timed(super().executemany, sql, seq, seq[0] if seq else ())
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self._key: self.connection.stats.record_rows(self._key, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(size) if size is not None else super().fetchmany()
+        if self._key: self.connection.stats.record_rows(self._key, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self._key: self.connection.stats.record_rows(self._key, len(rows))
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    stats = None
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+def connect_db(path):
+    # Use a timeout to handle concurrent writes better
+    conn = sqlite3.connect(path, timeout=10, factory=InstrumentedConnection)
+    conn.stats = get_query_stats()
+    return conn
+
+def latency_percentile(st_, q):
+    """Upper bucket bound holding the q-th percentile (histograms keep no raw samples)."""
+    target, seen = st_['count'] * q, 0
+    for i, n in enumerate(st_['buckets']):
+        seen += n
+        if seen >= target and n:
+            return LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else st_['max_ms']
+    return 0.0
+
+def prom_label(val):
+    return str(val).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def prom_histogram(metric, help_txt, label_name, stats):
+    """Histogram lines from a QueryStats-style snapshot ({label: {'buckets', 'sum_ms', 'count'}})."""
+    lines = [f"# HELP lenovo_chat_{metric} {help_txt}", f"# TYPE lenovo_chat_{metric} histogram"]
+    for key, st_ in sorted(stats.items()):
+        label = prom_label(key)
+        cumulative = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS + ("+Inf",), st_['buckets']):
+            cumulative += n
+            lines.append(f'lenovo_chat_{metric}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'lenovo_chat_{metric}_sum{{{label_name}="{label}"}} {st_["sum_ms"]:.3f}')
+        lines.append(f'lenovo_chat_{metric}_count{{{label_name}="{label}"}} {st_["count"]}')
+    return lines
+
+def render_prometheus_metrics():
+    """Prometheus text exposition of the data layer (and the in-process caches behind it)."""
+    stmts, _ = get_query_stats().snapshot()
+    lines = prom_histogram("query_duration_ms", "SQLite statement execute() latency.", "stmt", stmts)
+    for metric, field, help_txt in (("query_errors_total", "errors", "Failed statements."),
+                                    ("query_lock_errors_total", "lock_errors", "Statements failing on database locked/busy."),
+                                    ("query_rows_total", "rows", "Rows fetched.")):
+        lines += [f"# HELP lenovo_chat_{metric} {help_txt}", f"# TYPE lenovo_chat_{metric} counter"]
+        for key, st_ in sorted(stmts.items()):
+            lines.append(f'lenovo_chat_{metric}{{stmt="{prom_label(key)}"}} {st_[field]}')
+
+    wq = get_write_queue().stats
+    lines += ["# HELP lenovo_chat_writer_total Group-commit writer counters.", "# TYPE lenovo_chat_writer_total counter"]
+    lines += [f'lenovo_chat_writer_total{{kind="{k}"}} {v}' for k, v in sorted(wq.items())]
+    hub = get_room_hub().stats()
+    lines += ["# HELP lenovo_chat_hub_total Room hub cache counters.", "# TYPE lenovo_chat_hub_total counter"]
+    lines += [f'lenovo_chat_hub_total{{kind="{k}"}} {hub[k]}' for k in ("hits", "misses", "evictions", "transitions", "conflicts", "synced")]
+    lines += ["# TYPE lenovo_chat_hub_rooms gauge", f"lenovo_chat_hub_rooms {hub['rooms']}"]
+    jobs = get_job_pool()
+    queued, running = jobs.depth()
+    lines += ["# HELP lenovo_chat_job_queue_depth Jobs waiting for a worker.", "# TYPE lenovo_chat_job_queue_depth gauge",
+              f"lenovo_chat_job_queue_depth {queued}", "# TYPE lenovo_chat_jobs_running gauge", f"lenovo_chat_jobs_running {running}"]
+    lines += ["# HELP lenovo_chat_jobs_total Background job counters.", "# TYPE lenovo_chat_jobs_total counter"]
+    lines += [f'lenovo_chat_jobs_total{{kind="{k}"}} {v}' for k, v in sorted(jobs.stats.items())]
+    lines += ["# HELP lenovo_chat_job_wait_ms_total Time jobs spent queued.", "# TYPE lenovo_chat_job_wait_ms_total counter",
+              f"lenovo_chat_job_wait_ms_total {jobs.wait_ms:.3f}"]
+    lines += prom_histogram("job_duration_ms", "Background job run time.", "job", jobs.timing.snapshot()[0])
+    rooms_live, users_live = get_presence().counts()
+    lines += ["# HELP lenovo_chat_presence_users Users with a live heartbeat.", "# TYPE lenovo_chat_presence_users gauge",
+              f"lenovo_chat_presence_users {users_live}", "# TYPE lenovo_chat_presence_rooms gauge", f"lenovo_chat_presence_rooms {rooms_live}"]
+    side = get_side_channel()
+    if side:
+        lines += ["# HELP lenovo_chat_side_channel_total Side-channel HTTP requests.", "# TYPE lenovo_chat_side_channel_total counter"]
+        lines += [f'lenovo_chat_side_channel_total{{kind="{k}"}} {v}' for k, v in sorted(side.stats.items())]
+        lines += ["# HELP lenovo_chat_push_subscribers Open room event streams.", "# TYPE lenovo_chat_push_subscribers gauge",
+                  f"lenovo_chat_push_subscribers {side.subscriber_count()}"]
+    cfg = get_config_cache().stats
+    lines += ["# HELP lenovo_chat_config_cache_total Config cache counters.", "# TYPE lenovo_chat_config_cache_total counter"]
+    lines += [f'lenovo_chat_config_cache_total{{kind="{k}"}} {v}' for k, v in sorted(cfg.items())]
+    snap = get_snapshot()
+    lines += ["# HELP lenovo_chat_snapshot_total Read-snapshot counters.", "# TYPE lenovo_chat_snapshot_total counter"]
+    lines += [f'lenovo_chat_snapshot_total{{kind="{k}"}} {v}' for k, v in sorted(snap.stats.items())]
+    if snap.meta:
+        lines += ["# HELP lenovo_chat_snapshot_age_seconds Age of the read snapshot.", "# TYPE lenovo_chat_snapshot_age_seconds gauge",
+                  f"lenovo_chat_snapshot_age_seconds {snap.age_s():.1f}", "# TYPE lenovo_chat_snapshot_bytes gauge",
+                  f"lenovo_chat_snapshot_bytes {snap.meta['bytes']}"]
+    lines += prom_histogram("snapshot_duration_ms", "Snapshot refresh (backup) time.", "step", snap.timing.snapshot()[0])
+    rl = get_rate_limiter()
+    lines += ["# HELP lenovo_chat_rate_limit_total Send admission counters (shed = rejected).", "# TYPE lenovo_chat_rate_limit_total counter"]
+    lines += [f'lenovo_chat_rate_limit_total{{kind="{k}"}} {v}' for k, v in sorted(rl.stats.items())]
+    lines += ["# HELP lenovo_chat_write_latency_ewma_ms Message write latency EWMA driving backpressure.", "# TYPE lenovo_chat_write_latency_ewma_ms gauge",
+              f"lenovo_chat_write_latency_ewma_ms {rl.write_ms:.3f}", "# TYPE lenovo_chat_backpressure gauge", f"lenovo_chat_backpressure {int(rl.backpressure())}"]
+    sessions = get_session_registry()
+    n_sessions, total, largest, held = sessions.totals()
+    lines += ["# HELP lenovo_chat_sessions Browser sessions reporting state in this process.", "# TYPE lenovo_chat_sessions gauge", f"lenovo_chat_sessions {n_sessions}",
+              "# HELP lenovo_chat_session_state_bytes Estimated session_state size (sum and largest session).", "# TYPE lenovo_chat_session_state_bytes gauge",
+              f'lenovo_chat_session_state_bytes{{agg="sum"}} {total}', f'lenovo_chat_session_state_bytes{{agg="max"}} {largest}',
+              "# TYPE lenovo_chat_session_rooms gauge", f"lenovo_chat_session_rooms {held}"]
+    lines += ["# HELP lenovo_chat_session_total Session-state counters.", "# TYPE lenovo_chat_session_total counter"]
+    lines += [f'lenovo_chat_session_total{{kind="{k}"}} {v}' for k, v in sorted(sessions.stats.items())]
+    ret = get_retention()
+    lines += ["# HELP lenovo_chat_retention_total Retention purge counters.", "# TYPE lenovo_chat_retention_total counter"]
+    lines += [f'lenovo_chat_retention_total{{kind="{k}"}} {v}' for k, v in sorted(ret.stats.items())]
+    lines += prom_histogram("retention_duration_ms", "Retention batch (write lock), vacuum step and run time.", "step", ret.timing.snapshot()[0])
+    return "\n".join(lines) + "\n"
+
+def dump_prometheus_metrics(path=METRICS_FILE):
+    write_file_atomic(path, render_prometheus_metrics().encode())
+    return path
+
+# --- DATABASE (STABILITY FIX) ---
+def get_shard_file(shard):
+    """Shard 0 is the catalog file itself, so a 1-shard setup is the classic layout."""
+    if shard == 0: return DB_FILE
+    base, ext = os.path.splitext(DB_FILE)
+    return f"{base}.shard{shard}{ext or '.db'}"
+
+def pick_shard(rid, host):
+    """Placement for a NEW room. Existing rooms are always routed via the catalog."""
+    if SHARD_COUNT == 1: return 0
+    if SHARD_STRATEGY == 'cohort':
+        return zlib.crc32((host or "").strip().lower().encode()) % SHARD_COUNT
+    return (rid // SHARD_RANGE_SIZE) % SHARD_COUNT
+
+@st.cache_resource
+def get_shard_routes():
+    """Process-wide room -> shard map. A route never changes once assigned."""
+    return {}
+
+def get_room_shard(rid):
+    if SHARD_COUNT == 1: return 0
+    rid = int(rid)
+    routes = get_shard_routes()
+    if rid not in routes:
+        conn = None
+        try:
+            conn = connect_db(DB_FILE)
+            row = conn.execute("SELECT shard FROM room_shards WHERE room_id = ?", (rid,)).fetchone()
+        except: row = None
+        finally:
+            if conn: conn.close()
+        if not row: return 0 # Unknown room, catalog file answers "not found"
+        routes[rid] = row[0]
+    return routes[rid]
+
+def get_db_connection(rid=None):
+    # rid=None -> catalog (config, routing), otherwise the shard holding that room
+    db_file = DB_FILE if rid is None else get_shard_file(get_room_shard(rid))
+    return connect_db(db_file)
+
+def get_unified_connection():
+    """Catalog connection with every shard attached, exposing TEMP views
+    `all_rooms` / `all_messages` for sidebar listing and analytics."""
+    return unify_shards(get_db_connection(), [get_shard_file(s) for s in range(1, SHARD_COUNT)])
+
+def unify_shards(conn, shard_files):
+    for s, path in enumerate(shard_files, 1):
+        conn.execute(f"ATTACH DATABASE ? AS shard{s}", (path,))
+    for table in ("rooms", "messages"):
+        union = " UNION ALL ".join([f"SELECT * FROM main.{table}"] + [f"SELECT * FROM shard{s}.{table}" for s in range(1, len(shard_files) + 1)])
+        conn.execute(f"CREATE TEMP VIEW all_{table} AS {union}")
+    return conn
+
+def run_query(query, params=(), fetch_mode="all", rid=None):
+    """Helper to ensure connections always close. Pass rid to hit that room's shard.
+    fetch_mode "commit" returns lastrowid, "count" the rows changed (conditional updates)."""
+    conn = None
+    try:
+        conn = get_db_connection(rid)
+        c = conn.cursor()
+        c.execute(query, params)
+        if fetch_mode == "all":
+            return c.fetchall()
+        elif fetch_mode == "one":
+            return c.fetchone()
+        else:
+            conn.commit()
+            return c.rowcount if fetch_mode == "count" else c.lastrowid
+    except Exception as e:
+        return None
+    finally:
+        if conn: conn.close()
+
+def now_ms():
+    return int(time.time() * 1000)
+
+def format_ts(ms, fmt='%Y-%m-%d %H:%M:%S'):
+    """Epoch-ms -> local time string. Only called where a timestamp is actually shown."""
+    if ms is None or pd.isna(ms): return ""
+    return datetime.datetime.fromtimestamp(int(ms) / 1000).strftime(fmt)
+
+def migrate_ts_ms(c, columns):
+    """MIGRATION: Integer epoch-ms timestamps. ALTER only, so the unified views keep column
+    order; legacy TIMESTAMP text (local time) is converted once, then left unused."""
+    for table, col, legacy in columns:
+        try: c.execute(f"ALTER TABLE {table} ADD COLUMN {col} INTEGER")
+        except: pass
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{col} ON {table} ({col})")
+        c.execute(f"UPDATE {table} SET {col} = CAST(ROUND((julianday({legacy}, 'utc') - 2440587.5) * 86400000) AS INTEGER) WHERE {col} IS NULL AND {legacy} IS NOT NULL")
+
+def init_db():
+    # Every shard file carries rooms + messages. The catalog (shard 0) also holds config and routing.
+    for shard in range(SHARD_COUNT):
+        conn = None
+        try:
+            conn = connect_db(get_shard_file(shard))
+            c = conn.cursor()
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL") # Takes effect on new files only (existing ones need a VACUUM)
+            # Readers in one worker never block another worker's commit. Sticks to the file once set
+            if MULTI_WORKER:
+                try: c.execute("PRAGMA journal_mode = WAL")
+                except: pass # Another worker holds the file mid-switch; it sets the same mode
+            c.execute('''CREATE TABLE IF NOT EXISTS rooms (id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT, agent TEXT, status TEXT, created_at TIMESTAMP, last_activity TIMESTAMP, scenario TEXT)''')
+            c.execute('''CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id INTEGER, sender TEXT, role TEXT, text TEXT, timestamp TIMESTAMP)''')
+            c.execute("CREATE INDEX IF NOT EXISTS idx_messages_room ON messages (room_id, id)")
+
+            migrate_ts_ms(c, TS_MS_COLUMNS)
+
+            # MIGRATION: Compliance flags set on write: NULL = not scanned (older rows), '' = clean
+            try: c.execute("ALTER TABLE messages ADD COLUMN flags TEXT")
+            except: pass
+
+            # MIGRATION: Change watermark for the sidebar room index, bumped by every rooms UPDATE
+            try: c.execute("ALTER TABLE rooms ADD COLUMN updated_at_ms INTEGER")
+            except: pass
+            c.execute("CREATE INDEX IF NOT EXISTS idx_rooms_updated_at_ms ON rooms (updated_at_ms)")
+            c.execute("UPDATE rooms SET updated_at_ms = COALESCE(last_activity_ms, created_at_ms, 0) WHERE updated_at_ms IS NULL")
+
+            if shard == 0:
+                c.execute('''CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)''')
+                # MIGRATION: Bumped by update_config so every process can spot stale cached config
+                try: c.execute("ALTER TABLE config ADD COLUMN version INTEGER DEFAULT 0")
+                except: pass
+                c.execute('''CREATE TABLE IF NOT EXISTS room_shards (room_id INTEGER PRIMARY KEY AUTOINCREMENT, shard INTEGER, cohort TEXT)''')
+                c.execute('''CREATE TABLE IF NOT EXISTS attachments (id INTEGER PRIMARY KEY AUTOINCREMENT, sha256 TEXT, room_id INTEGER, uploader TEXT, filename TEXT, mime TEXT, size INTEGER, created_at TIMESTAMP)''')
+                c.execute("CREATE INDEX IF NOT EXISTS idx_attachments_sha ON attachments (sha256)")
+                migrate_ts_ms(c, CATALOG_TS_MS_COLUMNS)
+                # Tombstones let the room index notice deletes without rescanning every room
+                c.execute('''CREATE TABLE IF NOT EXISTS room_deletions (room_id INTEGER PRIMARY KEY, deleted_at_ms INTEGER)''')
+                c.execute("CREATE INDEX IF NOT EXISTS idx_room_deletions_at ON room_deletions (deleted_at_ms)")
+
+                # Scenario rows are never edited: a changed scenario is a new row (deduplicated by hash)
+                c.execute('''CREATE TABLE IF NOT EXISTS scenarios (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, product TEXT, issue TEXT, difficulty TEXT, content_hash TEXT UNIQUE, created_by TEXT, created_at_ms INTEGER)''')
+                c.execute("SELECT 1 FROM scenarios LIMIT 1")
+                if not c.fetchone():
+                    for sc in DEFAULT_SCENARIOS: upsert_scenario(conn, sc, 'system')
+
+                # Check if scorecard exists
+                c.execute("SELECT * FROM config WHERE key='scorecard'")
+                if not c.fetchone():
+                    c.execute("INSERT INTO config (key, value) VALUES (?, ?)", ('scorecard', json.dumps(DEFAULT_SCORECARD)))
+
+                # MIGRATION: Rooms created before sharding live in the catalog file
+                if SHARD_COUNT > 1:
+                    c.execute("INSERT OR IGNORE INTO room_shards (room_id, shard, cohort) SELECT id, 0, host FROM rooms")
+
+            # MIGRATION: Ensure 'scenario' column exists
+            try:
+                c.execute("ALTER TABLE rooms ADD COLUMN scenario TEXT")
+            except:
+                pass 
+            # MIGRATION: Rooms point at the scenario catalog; the JSON column is legacy, read once below
+            try: c.execute("ALTER TABLE rooms ADD COLUMN scenario_id INTEGER")
+            except: pass
+            # MIGRATION: Set when a manager grades the room; retention policies can key on it
+            try: c.execute("ALTER TABLE rooms ADD COLUMN graded_at_ms INTEGER")
+            except: pass
+            # MIGRATION: Clear-and-recreate claim: -claimed_at_ms while running, then the replacement room id
+            try: c.execute("ALTER TABLE rooms ADD COLUMN replaced_by INTEGER")
+            except: pass
+            if shard == 0:
+                try: c.execute("ALTER TABLE room_deletions ADD COLUMN replaced_by INTEGER")
+                except: pass
+
+            conn.commit()
+        finally:
+            if conn: conn.close()
+    migrate_room_scenarios()
+
+def migrate_room_scenarios():
+    """Moves legacy per-room scenario JSON into the catalog (identical blobs share a row)."""
+    catalog = None
+    try:
+        catalog = connect_db(get_shard_file(0))
+        for shard in range(SHARD_COUNT):
+            conn = catalog if shard == 0 else connect_db(get_shard_file(shard))
+            try:
+                rows = conn.execute("SELECT id, scenario FROM rooms WHERE scenario_id IS NULL AND scenario IS NOT NULL").fetchall()
+                for rid, blob in rows:
+                    try: sc = json.loads(blob)
+                    except: continue
+                    if isinstance(sc, dict):
+                        conn.execute("UPDATE rooms SET scenario_id = ? WHERE id = ?", (upsert_scenario(catalog, sc, 'migration'), rid))
+                catalog.commit()
+                conn.commit()
+            finally:
+                if conn is not catalog: conn.close()
+    finally:
+        if catalog: catalog.close()
+
+@traced("get_rooms")
+def get_rooms():
+    try: return pd.DataFrame(get_storage().list_rooms(), columns=ROOM_FIELDS)
+    except: return pd.DataFrame()
+
+@traced("create_room")
+def create_room(host, scenario_id=None):
+    rid = get_storage().create_room(host, scenario_id)
+    if rid: get_room_index().touch()
+    return rid
+
+@traced("join_room")
+def join_room(rid, agent):
+    """Claims a waiting room. Conditional on agent = 'Waiting...', so of two agents (in any
+    worker) racing for a room exactly one gets it. True if `agent` holds the room afterwards."""
+    claimed, holder = get_storage().claim_room(rid, agent)
+    if not claimed:
+        if holder: get_room_hub().update_room(rid, agent=holder) # Our copy was stale
+        return holder == agent
+    get_room_hub().update_room(rid, agent=agent)
+    get_room_index().touch()
+    publish_room_event(rid, 'status', agent=agent)
+    return True
+
+@traced("delete_room")
+def delete_room(rid):
+    return get_storage().delete_rooms([rid])
+
+def mark_graded(rid):
+    get_storage().mark_graded(rid)
+
+def write_message_batch(conn, batch):
+    """Inserts a batch of queued messages in order and bumps each room's last_activity once.
+    Fills in the new row id and timestamp_ms on every ticket, or an error on tickets whose
+    room is gone (deleted by any worker: no orphaned messages). Caller commits."""
+    last_seen = {}
+    for t in batch:
+        t['timestamp_ms'] = now_ms()
+        cur = conn.execute(
+            "INSERT INTO messages (room_id, sender, role, text, timestamp_ms, flags) SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM rooms WHERE id = ?)",
+            (t['rid'], t['sender'], t['role'], t['text'], t['timestamp_ms'], t['flags'], t['rid'])
+        )
+        if not cur.rowcount:
+            t['error'] = LookupError(f"room {t['rid']} no longer exists")
+            continue
+        t['id'] = cur.lastrowid
+        last_seen[t['rid']] = t['timestamp_ms']
+    conn.executemany("UPDATE rooms SET last_activity_ms = ?, updated_at_ms = ? WHERE id = ?", [(ts, ts, rid) for rid, ts in last_seen.items()])
+
+class MessageWriteQueue:
+    """One writer thread folds send_msg calls from every session into group commits.
+    Callers block until the batch holding their message is committed (durable ack).
+    FIFO queue + single writer keeps per-room ordering identical to submission order."""
+    def __init__(self, storage, window_ms=GROUP_COMMIT_WINDOW_MS, max_batch=GROUP_COMMIT_MAX_BATCH):
+        self.storage = storage
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self.q = queue.Queue()
+        self.stats = {'messages': 0, 'batches': 0, 'commits': 0, 'errors': 0}
+        self.listeners = [] # Called with each committed list of tickets, in commit order
+        self.thread = threading.Thread(target=self._run, name="lenovo-msg-writer", daemon=True)
+        self.thread.start()
+
+    def submit(self, rid, sender, role, text, timeout=30, flags=None):
+        ticket = {'rid': int(rid), 'sender': sender, 'role': role, 'text': text, 'flags': flags,
+                  'done': threading.Event(), 'error': None}
+        self.q.put(ticket)
+        if not ticket['done'].wait(timeout):
+            raise TimeoutError("Message writer did not acknowledge in time")
+        if ticket['error']: raise ticket['error']
+        return ticket
+
+    def _run(self):
+        while True:
+            batch = [self.q.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try: batch.append(self.q.get(timeout=remaining))
+                except queue.Empty: break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                for t in batch:
+                    t['error'] = t['error'] or e
+                    t['done'].set()
+
+    def _commit(self, batch):
+        self.stats['batches'] += 1
+        by_shard = {}
+        for t in batch:
+            by_shard.setdefault(get_room_shard(t['rid']), []).append(t)
+
+        for shard, tickets in by_shard.items():
+            error = None
+            t0 = time.perf_counter()
+            try:
+                self.storage.add_messages(tickets) # One shard: one transaction
+                self.stats['commits'] += 1
+            except Exception as e:
+                error = e
+                self.stats['errors'] += 1
+                for t in tickets: t['error'] = e
+            get_rate_limiter().observe_write((time.perf_counter() - t0) * 1000, error)
+
+            written = [t for t in tickets if not t['error']]
+            self.stats['messages'] += len(written)
+            if written:
+                for listener in self.listeners:
+                    try: listener(written)
+                    except: pass
+            for t in tickets: t['done'].set()
+
+@st.cache_resource
+def get_write_queue():
+    wq = MessageWriteQueue(get_storage())
+    wq.listeners.append(get_room_hub().on_messages)
+    side = get_side_channel()
+    if side: wq.listeners.append(side.on_messages)
+    return wq
+
+@traced("send_msg")
+def send_msg(rid, sender, role, text):
+    if not text.strip(): return
+    get_presence().clear_typing(rid, sender)
+    flags = scan_compliance(role, text) # Before queueing: the single writer thread stays lean
+    if GROUP_COMMIT:
+        get_write_queue().submit(rid, sender, role, text, flags=flags)
+        return
+
+    ticket = {'rid': int(rid), 'sender': sender, 'role': role, 'text': text, 'flags': flags, 'error': None}
+    t0, error = time.perf_counter(), None
+    try:
+        get_storage().add_messages([ticket])
+        if ticket['error']: raise ticket['error']
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        get_rate_limiter().observe_write((time.perf_counter() - t0) * 1000, error)
+    get_room_hub().on_messages([ticket])
+    publish_room_event(rid, 'message', id=ticket['id'], flags=flags)
+
+# --- RATE LIMITING / BACKPRESSURE ---
+class RateLimiter:
+    """Token buckets per user and per room for sends coming from the UI, plus a process-wide
+    backpressure level: an EWMA of message-write latency (SQLite busy waits show up there).
+    Above BACKPRESSURE_WRITE_MS refills slow down and admitted sends are delayed a little, so
+    writers back off instead of piling onto the lock. admit() never raises."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {} # (scope, key) -> [tokens, last monotonic]
+        self.write_ms = 0.0
+        self.stats = {'admitted': 0, 'shed_user': 0, 'shed_room': 0, 'delayed': 0, 'delay_ms': 0, 'write_errors': 0, 'pruned': 0}
+
+    def observe_write(self, ms, error=None):
+        with self.lock:
+            self.write_ms = ms if not self.write_ms else self.write_ms * 0.8 + ms * 0.2
+            if error is not None: self.stats['write_errors'] += 1
+
+    def backpressure(self):
+        return self.write_ms > BACKPRESSURE_WRITE_MS
+
+    def _fill(self, key, rate, burst, now):
+        b = self.buckets.get(key)
+        if b is None: b = self.buckets[key] = [float(burst), now]
+        b[0] = min(float(burst), b[0] + (now - b[1]) * rate)
+        b[1] = now
+        return b
+
+    def _prune(self, now):
+        # A bucket idle long enough to have refilled is the same as no bucket
+        idle = max(RATE_USER_BURST / RATE_USER_PER_S, RATE_ROOM_BURST / RATE_ROOM_PER_S) / BACKPRESSURE_RATE_FACTOR
+        for key in [k for k, b in self.buckets.items() if now - b[1] > idle]:
+            del self.buckets[key]
+            self.stats['pruned'] += 1
+
+    def admit(self, rid, user):
+        """(scope, seconds): scope None means go ahead after `seconds` of backpressure delay;
+        'user' / 'room' means shed, retry after `seconds`. Both buckets are checked before
+        either is charged."""
+        now = time.monotonic()
+        with self.lock:
+            factor = BACKPRESSURE_RATE_FACTOR if self.backpressure() else 1.0
+            limits = (('user', user, RATE_USER_PER_S * factor, RATE_USER_BURST),
+                      ('room', int(rid), RATE_ROOM_PER_S * factor, RATE_ROOM_BURST))
+            buckets = [(scope, rate, self._fill((scope, key), rate, burst, now)) for scope, key, rate, burst in limits]
+            for scope, rate, b in buckets:
+                if b[0] < 1.0:
+                    self.stats[f'shed_{scope}'] += 1
+                    return scope, (1.0 - b[0]) / rate
+            for _, _, b in buckets: b[0] -= 1.0
+            self.stats['admitted'] += 1
+            if len(self.buckets) > RATE_MAX_BUCKETS: self._prune(now)
+            if factor == 1.0: return None, 0.0
+            delay = min(BACKPRESSURE_MAX_DELAY_S, self.write_ms / 1000.0)
+            self.stats['delayed'] += 1
+            self.stats['delay_ms'] += int(delay * 1000)
+            return None, delay
+
+@st.cache_resource
+def get_rate_limiter():
+    return RateLimiter()
+
+def post_message(rid, sender, role, text):
+    """send_msg for interactive sessions: rate limited and backpressured. Returns None once
+    sent, else a short reason to show the user (the message was not written)."""
+    if not text.strip(): return None
+    if RATE_LIMITS:
+        scope, wait = get_rate_limiter().admit(rid, sender)
+        if scope: return f"SLOW DOWN: {'YOU ARE' if scope == 'user' else 'THIS ROOM IS'} SENDING TOO FAST. RETRY IN {max(wait, 0.1):.1f}S."
+        if wait: time.sleep(wait)
+    try: send_msg(rid, sender, role, text)
+    except Exception as e: return f"NOT SENT: {e}"
+    return None
+
+@traced("get_msgs")
+def get_msgs(rid, limit=50):
+    try: return pd.DataFrame(get_storage().get_messages(rid, limit), columns=MESSAGE_FIELDS)
+    except: return pd.DataFrame()
+
+def get_msgs_between(start_ms, end_ms, host=None, limit=EXPORT_MAX_ROWS, snapshot=True):
+    """Messages with start_ms <= timestamp_ms < end_ms across every shard, read from the
+    snapshot by default. Range scan on idx_messages_timestamp_ms (the filter is pushed into
+    each shard's branch)."""
+    conn = None
+    try:
+        conn = get_snapshot().connect() if snapshot else get_unified_connection()
+        query = f"""
+            SELECT m.room_id, r.host, r.agent, m.sender, m.role, m.text, m.timestamp_ms
+            FROM all_messages m JOIN all_rooms r ON r.id = m.room_id
+            WHERE m.timestamp_ms >= ? AND m.timestamp_ms < ? {"AND r.host = ?" if host else ""}
+            ORDER BY m.timestamp_ms, m.id LIMIT ?
+        """
+        return pd.read_sql_query(query, conn, params=(start_ms, end_ms) + ((host,) if host else ()) + (limit,))
+    except: return pd.DataFrame()
+    finally:
+        if conn: conn.close()
+
+def export_range_csv(start_date, end_date, host=None):
+    """Date inputs are local calendar days, end inclusive. Timestamps are formatted only here."""
+    start = datetime.datetime.combine(start_date, datetime.time.min)
+    end = datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min)
+    df = get_msgs_between(int(start.timestamp() * 1000), int(end.timestamp() * 1000), host)
+    if df.empty: return None, 0
+    df.insert(0, 'time', df['timestamp_ms'].map(format_ts))
+    df['text'] = df['text'].map(format_message_text)
+    return df.to_csv(index=False).encode('utf-8'), len(df)
+
+def get_room_details(rid):
+    """Room's scenario (shared, read-only). Hub row + catalog cache: no DB work once both are warm."""
+    try:
+        room = get_room_hub().get_room(rid)
+        return get_scenarios().get(room.get('scenario_id')) if room else None
+    except: return None
+
+def load_config(key):
+    try: value = get_storage().get_config(key)
+    except: value = None
+    if value is None and key == 'scorecard': return DEFAULT_SCORECARD
+    if value is None and key == 'retention': return DEFAULT_RETENTION
+    return [] if value is None else value
+
+def get_config(key):
+    """Shared, cached value: treat as read-only (copy before editing)."""
+    return get_config_cache().get(key)['value']
+
+def get_config_meta(key):
+    """Cache entry: version, value and pre-derived structures (see derive_config)."""
+    return get_config_cache().get(key)
+
+def update_config(key, val):
+    get_storage().set_config(key, val)
+    get_config_cache().invalidate(key)
+
+def get_ip():
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(("8.8.8.8", 80))
+            ip = s.getsockname()[0]
+        except:
+            ip = "127.0.0.1"
+        s.close()
+        return ip
+    except: return "127.0.0.1"
+
+def derive_room_status(status, agent_name, last_act, last_role, now=None):
+    """Timer/turn rules shared by check_room_status and the wall view. No DB access.
+    last_act / now are epoch ms, so the check is plain integer arithmetic."""
+    if agent_name == 'Waiting...': return status, 0, False
+
+    is_agent_turn = (last_role != 'Agent') # True if last msg was NOT Agent
+
+    if not last_act: return status, 0, is_agent_turn
+
+    diff = ((now or now_ms()) - last_act) / 1000.0
+
+    if status == 'Active' and is_agent_turn:
+        if diff > 600: return 'Offline', diff, is_agent_turn
+        if diff > 300: return 'Expired', diff, is_agent_turn
+    return status, diff, is_agent_turn
+
+@traced("check_room_status")
+def check_room_status(rid):
+    try:
+        room = get_room_hub().get_room(rid)
+        if not room: return "Unknown", 0, False
+
+        status = room['status']
+        new_status, diff, is_agent_turn = derive_room_status(status, room['agent'], room['last_activity_ms'], room['last_role'])
+
+        if new_status != status:
+            # Compare-and-set on what the decision was based on: a message or another worker's
+            # transition landing first wins, and this copy is re-read instead of overwriting it
+            hub = get_room_hub()
+            if get_storage().set_status(rid, new_status, status, room['last_activity_ms']):
+                hub.update_room(rid, status=new_status)
+                hub.transitions += 1
+                publish_room_event(rid, 'status', status=new_status)
+            else:
+                hub.conflicts += 1
+                hub.evict(rid)
+                room = hub.get_room(rid)
+                if not room: return "Unknown", 0, False
+                new_status = room['status']
+                _, diff, is_agent_turn = derive_room_status(new_status, room['agent'], room['last_activity_ms'], room['last_role'])
+        return new_status, diff, is_agent_turn
+    except:
+        return "Error", 0, False
+
+def get_wall_rows(host=None, limit=WALL_MAX_ROOMS, window=WALL_WINDOW):
+    """ONE query for the whole wall: watched rooms joined to each room's latest `window`
+    messages (index range scan on messages(room_id, id)). Returns {rid: room dict + 'msgs'}."""
+    conn = None
+    try:
+        conn = get_unified_connection()
+        rows = conn.execute(f"""
+            WITH watched AS (
+                SELECT id, host, agent, status, last_activity_ms,
+                       (SELECT MIN(id) FROM (SELECT id FROM all_messages WHERE room_id = r.id ORDER BY id DESC LIMIT ?)) AS cutoff
+                FROM all_rooms r
+                WHERE status = 'Active' {"AND host = ?" if host else ""}
+                ORDER BY id DESC LIMIT ?
+            )
+            SELECT w.id, w.host, w.agent, w.status, w.last_activity_ms, m.id, m.sender, m.role, m.text, m.flags
+            FROM watched w
+            LEFT JOIN all_messages m ON m.room_id = w.id AND m.id >= w.cutoff
+            ORDER BY w.id DESC, m.id ASC
+        """, (window,) + ((host,) if host else ()) + (limit,)).fetchall()
+    except: return {}
+    finally:
+        if conn: conn.close()
+
+    rooms = {}
+    for rid, r_host, agent, status, last_act, mid, sender, role, text, flags in rows:
+        room = rooms.get(rid)
+        if room is None:
+            room = rooms[rid] = {'id': rid, 'host': r_host, 'agent': agent, 'status': status,
+                                 'last_activity_ms': last_act, 'msgs': []}
+        if mid is not None:
+            room['msgs'].append({'id': mid, 'sender': sender, 'role': role, 'text': text, 'flags': flags})
+    return rooms
+
+# --- STORAGE BACKENDS ---
+class StorageBackend(abc.ABC):
+    """What the data layer asks of a store: rooms, messages, config, grades and presence.
+    Rooms and messages travel as plain dicts (ROOM_FIELDS / MESSAGE_FIELDS); every method is
+    called from many threads. A backend missing a method fails when it is constructed;
+    tools/bench_storage.py holds the conformance checks and the benchmark workload it has to pass."""
+    name = None
+
+    # Rooms
+    @abc.abstractmethod
+    def create_room(self, host, scenario_id=None):
+        """New 'Active' room waiting for an agent. Its id, or None."""
+    @abc.abstractmethod
+    def get_room(self, rid): ...
+    @abc.abstractmethod
+    def list_rooms(self):
+        """Every room, newest first."""
+    @abc.abstractmethod
+    def claim_room(self, rid, agent):
+        """Sets the agent only while it is 'Waiting...'. (claimed, agent holding the room or None)."""
+    @abc.abstractmethod
+    def set_status(self, rid, status, expect_status, expect_last_activity_ms):
+        """Compare-and-set: True if the room still had both expected values and now has `status`."""
+    @abc.abstractmethod
+    def delete_rooms(self, rids):
+        """Deletes the rooms with their messages. Rooms deleted."""
+
+    # Messages
+    @abc.abstractmethod
+    def add_messages(self, tickets):
+        """Stores tickets ({'rid', 'sender', 'role', 'text', 'flags'}) in order, setting 'id' and
+        'timestamp_ms' on each, or 'error' where the room is gone, and bumps last_activity_ms.
+        All-or-nothing: raises if the batch could not be written."""
+    @abc.abstractmethod
+    def get_messages(self, rid, limit=50):
+        """The newest `limit` messages of a room (all if falsy), oldest first."""
+
+    # Config
+    @abc.abstractmethod
+    def get_config(self, key):
+        """Parsed value, or None if the key was never set."""
+    @abc.abstractmethod
+    def get_config_version(self, key):
+        """Bumped by every set_config; None if the key was never set."""
+    @abc.abstractmethod
+    def set_config(self, key, value): ...
+
+    # Grades
+    @abc.abstractmethod
+    def mark_graded(self, rid): ...
+
+    # Presence: heartbeats are process memory in both backends (see PresenceTracker)
+    def beat(self, rid, user, role, typing=None):
+        return self.presence.beat(rid, user, role, typing)
+    def room_presence(self, rid):
+        return self.presence.room(rid)
+
+class SQLiteStorage(StorageBackend):
+    """The shard files (see DATABASE): rooms are routed by get_room_shard, the catalog holds config."""
+    name = "sqlite"
+
+    def __init__(self):
+        self.presence = get_presence()
+
+    def create_room(self, host, scenario_id=None):
+        now = now_ms()
+        if SHARD_COUNT == 1:
+            # Uses helper to ensure close
+            return run_query(
+                "INSERT INTO rooms (host, agent, status, created_at_ms, last_activity_ms, updated_at_ms, scenario_id) VALUES (?, ?, ?, ?, ?, ?, ?)", 
+                (host, 'Waiting...', 'Active', now, now, now, scenario_id), 
+                fetch_mode="commit"
+            )
+
+        # Sharded: the catalog hands out ids so they stay unique across files
+        conn = None
+        try:
+            conn = get_db_connection()
+            rid = conn.execute("INSERT INTO room_shards (cohort) VALUES (?)", (host,)).lastrowid
+            shard = pick_shard(rid, host)
+            conn.execute("UPDATE room_shards SET shard = ? WHERE room_id = ?", (shard, rid))
+            conn.commit()
+        except: return None
+        finally:
+            if conn: conn.close()
+
+        get_shard_routes()[rid] = shard
+        if run_query(
+            "INSERT INTO rooms (id, host, agent, status, created_at_ms, last_activity_ms, updated_at_ms, scenario_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (rid, host, 'Waiting...', 'Active', now, now, now, scenario_id),
+            fetch_mode="commit", rid=rid
+        ) is None:
+            # Shard write failed: drop the route so the id does not point at a room that never existed
+            run_query("DELETE FROM room_shards WHERE room_id = ?", (rid,), fetch_mode="commit")
+            get_shard_routes().pop(rid, None)
+            return None
+        return rid
+
+    def get_room(self, rid):
+        conn = None
+        try: # Not run_query: a locked file must raise, not read as "no such room"
+            conn = get_db_connection(rid)
+            row = conn.execute(f"SELECT {', '.join(ROOM_FIELDS)} FROM rooms WHERE id = ?", (rid,)).fetchone()
+        finally:
+            if conn: conn.close()
+        return dict(zip(ROOM_FIELDS, row)) if row else None
+
+    def list_rooms(self):
+        conn = None
+        try:
+            conn = get_unified_connection()
+            rows = conn.execute(f"SELECT {', '.join(ROOM_FIELDS)} FROM all_rooms ORDER BY created_at_ms DESC, id DESC").fetchall()
+        finally:
+            if conn: conn.close()
+        return [dict(zip(ROOM_FIELDS, r)) for r in rows]
+
+    def claim_room(self, rid, agent):
+        if run_query("UPDATE rooms SET agent = ?, updated_at_ms = ? WHERE id = ? AND agent = 'Waiting...'",
+                     (agent, now_ms(), rid), fetch_mode="count", rid=rid):
+            return True, agent
+        row = run_query("SELECT agent FROM rooms WHERE id = ?", (rid,), fetch_mode="one", rid=rid)
+        return False, row[0] if row else None
+
+    def set_status(self, rid, status, expect_status, expect_last_activity_ms):
+        return bool(run_query("UPDATE rooms SET status = ?, updated_at_ms = ? WHERE id = ? AND status = ? AND last_activity_ms IS ?",
+                              (status, now_ms(), rid, expect_status, expect_last_activity_ms), fetch_mode="count", rid=rid))
+
+    def delete_rooms(self, rids):
+        # Same batched path as the retention purge (attachments and routing go with it)
+        by_shard = {}
+        for rid in rids: by_shard.setdefault(get_room_shard(rid), []).append(int(rid))
+        return get_retention().purge_rooms(by_shard)['rooms']
+
+    def add_messages(self, tickets):
+        by_shard = {}
+        for t in tickets: by_shard.setdefault(get_room_shard(t['rid']), []).append(t)
+        for shard, batch in by_shard.items():
+            conn = None
+            try:
+                conn = connect_db(get_shard_file(shard))
+                write_message_batch(conn, batch)
+                conn.commit()
+            finally:
+                if conn: conn.close()
+
+    def get_messages(self, rid, limit=50):
+        conn = None
+        try:
+            conn = get_db_connection(rid)
+            rows = conn.execute(
+                f"SELECT * FROM (SELECT {', '.join(MESSAGE_FIELDS)} FROM messages WHERE room_id = ? ORDER BY id DESC LIMIT ?) ORDER BY id ASC",
+                (rid, limit or -1)
+            ).fetchall()
+        finally:
+            if conn: conn.close()
+        return [dict(zip(MESSAGE_FIELDS, r)) for r in rows]
+
+    def get_config(self, key):
+        row = run_query("SELECT value FROM config WHERE key=?", (key,), fetch_mode="one")
+        if not row: return None
+        try: return json.loads(row[0])
+        except: return []
+
+    def get_config_version(self, key):
+        conn = None
+        try: # Not run_query: a missing table must raise, not read as "key never set"
+            conn = get_db_connection()
+            row = conn.execute("SELECT version FROM config WHERE key=?", (key,)).fetchone()
+        finally:
+            if conn: conn.close()
+        return row[0] if row else None
+
+    def set_config(self, key, value):
+        run_query(
+            "INSERT INTO config (key, value, version) VALUES (?, ?, 1) ON CONFLICT(key) DO UPDATE SET value = excluded.value, version = COALESCE(version, 0) + 1",
+            (key, json.dumps(value)), fetch_mode="commit"
+        )
+
+    def mark_graded(self, rid):
+        run_query("UPDATE rooms SET graded_at_ms = ? WHERE id = ?", (now_ms(), rid), fetch_mode="commit", rid=rid)
+
+class MemoryStorage(StorageBackend):
+    """Everything in process memory behind one lock: rooms by id, and per room an id-ordered
+    list of its messages (appends only, so the newest `limit` is a slice). For tests and
+    benchmarks; nothing outlives the process and other workers can't see it."""
+    name = "memory"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}   # rid -> room dict (ROOM_FIELDS)
+        self.msgs = {}    # rid -> [message dict], ascending id
+        self.config = {}  # key -> (json text, version): every get parses a private copy
+        self.next_room = 1
+        self.next_msg = 1
+        self.presence = PresenceTracker()
+
+    def create_room(self, host, scenario_id=None):
+        now = now_ms()
+        with self.lock:
+            rid = self.next_room
+            self.next_room += 1
+            self.rooms[rid] = {'id': rid, 'host': host, 'agent': 'Waiting...', 'status': 'Active', 'scenario_id': scenario_id,
+                               'created_at_ms': now, 'last_activity_ms': now, 'graded_at_ms': None, 'updated_at_ms': now}
+            self.msgs[rid] = []
+        return rid
+
+    def get_room(self, rid):
+        with self.lock:
+            room = self.rooms.get(int(rid))
+            return dict(room) if room else None
+
+    def list_rooms(self):
+        with self.lock: rooms = [dict(r) for r in self.rooms.values()]
+        return sorted(rooms, key=lambda r: (r['created_at_ms'], r['id']), reverse=True)
+
+    def claim_room(self, rid, agent):
+        with self.lock:
+            room = self.rooms.get(int(rid))
+            if room is None: return False, None
+            if room['agent'] != 'Waiting...': return False, room['agent']
+            room['agent'], room['updated_at_ms'] = agent, now_ms()
+            return True, agent
+
+    def set_status(self, rid, status, expect_status, expect_last_activity_ms):
+        with self.lock:
+            room = self.rooms.get(int(rid))
+            if room is None or (room['status'], room['last_activity_ms']) != (expect_status, expect_last_activity_ms): return False
+            room['status'], room['updated_at_ms'] = status, now_ms()
+            return True
+
+    def delete_rooms(self, rids):
+        with self.lock:
+            n = 0
+            for rid in rids:
+                n += self.rooms.pop(int(rid), None) is not None
+                self.msgs.pop(int(rid), None)
+            return n
+
+    def add_messages(self, tickets):
+        with self.lock:
+            for t in tickets:
+                t['timestamp_ms'] = now_ms()
+                room = self.rooms.get(t['rid'])
+                if room is None:
+                    t['error'] = LookupError(f"room {t['rid']} no longer exists")
+                    continue
+                t['id'] = self.next_msg
+                self.next_msg += 1
+                self.msgs[t['rid']].append({'id': t['id'], 'room_id': t['rid'], 'sender': t['sender'], 'role': t['role'],
+                                            'text': t['text'], 'timestamp_ms': t['timestamp_ms'], 'flags': t.get('flags')})
+                room['last_activity_ms'] = room['updated_at_ms'] = t['timestamp_ms']
+
+    def get_messages(self, rid, limit=50):
+        with self.lock:
+            msgs = self.msgs.get(int(rid), [])
+            return [dict(m) for m in (msgs[-limit:] if limit else msgs)]
+
+    def get_config(self, key):
+        with self.lock: entry = self.config.get(key)
+        return json.loads(entry[0]) if entry else None
+
+    def get_config_version(self, key):
+        with self.lock: entry = self.config.get(key)
+        return entry[1] if entry else None
+
+    def set_config(self, key, value):
+        text = json.dumps(value)
+        with self.lock:
+            entry = self.config.get(key)
+            self.config[key] = (text, entry[1] + 1 if entry else 1)
+
+    def mark_graded(self, rid):
+        with self.lock:
+            room = self.rooms.get(int(rid))
+            if room: room['graded_at_ms'] = now_ms()
+
+# Every implementation, by name: tools/bench_storage.py runs each of them
+STORAGE_BACKENDS = {'sqlite': SQLiteStorage, 'memory': MemoryStorage}
+
+@st.cache_resource
+def get_storage():
+    # The hub's multi-worker sync, the room index, snapshots, retention and analytics still read
+    # the shard files directly, so the app itself always runs on SQLite
+    return SQLiteStorage()
+
+# --- ROOM HUB (SHARED ACROSS SESSIONS) ---
+class RoomHub:
+    """Process-wide ring buffers of recent messages plus the current room row for hot rooms.
+    send_msg / join_room / status changes write through, so a customer, an agent and a
+    watching manager all read one copy instead of each polling SQLite. In multi-worker mode a
+    sync thread folds in what other processes committed (see sync)."""
+    def __init__(self, max_rooms=HUB_MAX_ROOMS, ring_size=HUB_RING_SIZE):
+        self.max_rooms = max_rooms
+        self.ring_size = ring_size
+        self.lock = threading.Lock()
+        self.rooms = OrderedDict() # rid -> entry, least recently used first
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.transitions = 0 # Status changes this process won (check_room_status)
+        self.conflicts = 0   # ...and lost to a newer row
+        self.synced = 0      # Messages picked up from other connections by sync()
+        self.watch = {}      # shard -> {'conn', 'version', 'last_id', 'since'} (see start_sync)
+        self.sync_error = None
+        self.alerts = deque(maxlen=COMPLIANCE_ALERTS_MAX) # Flagged messages, oldest first
+
+    def _load(self, rid):
+        storage = get_storage()
+        row = storage.get_room(rid)
+        msgs = storage.get_messages(rid, self.ring_size)
+        room = None
+        if row:
+            room = {'status': row['status'], 'last_activity_ms': row['last_activity_ms'], 'agent': row['agent'],
+                    'scenario_id': row['scenario_id'], 'last_role': msgs[-1]['role'] if msgs else None}
+        return room, msgs
+
+    def _entry(self, rid):
+        """Returns a ready entry, loading it on a miss. None if another session is mid-load."""
+        rid = int(rid)
+        with self.lock:
+            e = self.rooms.get(rid)
+            if e is not None:
+                if not e['ready']: return None
+                self.rooms.move_to_end(rid)
+                self.hits += 1
+                return e
+            self.misses += 1
+            # Placeholder: writes landing during the load are parked in 'pending'
+            e = {'ready': False, 'room': None, 'msgs': deque(maxlen=self.ring_size), 'pending': []}
+            self.rooms[rid] = e
+
+        try:
+            room, msgs = self._load(rid)
+        except:
+            with self.lock: self.rooms.pop(rid, None)
+            raise
+
+        with self.lock:
+            if e['room'] is None: e['room'] = room
+            elif room: e['room'] = {**room, **e['room']} # Keep updates made during the load
+            e['msgs'].extend(msgs)
+            for m in e['pending']: self._merge(e, m)
+            e['pending'] = []
+            e['ready'] = True
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+                self.evictions += 1
+        return e
+
+    def _apply(self, e, m):
+        e['msgs'].append(m)
+        if e['room']:
+            e['room']['last_activity_ms'] = m['timestamp_ms']
+            e['room']['last_role'] = m['role']
+
+    def _merge(self, e, m):
+        """Adds m unless the ring already has it: write-through and sync() may both deliver a
+        message, and a sync can see another worker's older id after a local newer one."""
+        ring = e['msgs']
+        if not ring or m['id'] > ring[-1]['id']:
+            self._apply(e, m)
+            return True
+        if (len(ring) == ring.maxlen and m['id'] < ring[0]['id']) or any(x['id'] == m['id'] for x in ring): return False
+        e['msgs'] = deque(sorted([*ring, m], key=lambda x: x['id']), maxlen=self.ring_size)
+        return True
+
+    def get_room(self, rid):
+        e = self._entry(rid)
+        if e is None: return self._load(rid)[0]
+        with self.lock:
+            return dict(e['room']) if e['room'] else None
+
+    def get_msgs(self, rid, limit=50):
+        e = self._entry(rid)
+        if e is None:
+            msgs = self._load(rid)[1]
+        else:
+            with self.lock: msgs = list(e['msgs'])
+        return msgs[-limit:] if limit else msgs
+
+    def _alert(self, m):
+        """Keeps flagged messages for the managers' alert list, whichever path delivers them."""
+        if m['flags'] and not any(a['id'] == m['id'] and a['room_id'] == m['room_id'] for a in self.alerts):
+            self.alerts.append(m)
+
+    def get_alerts(self, limit=10):
+        with self.lock: return list(self.alerts)[-limit:][::-1]
+
+    def on_messages(self, tickets):
+        """Write-through hook for committed messages (called in commit order)."""
+        with self.lock:
+            for t in tickets:
+                m = {'id': t['id'], 'room_id': t['rid'], 'sender': t['sender'], 'role': t['role'],
+                     'text': t['text'], 'timestamp_ms': t['timestamp_ms'], 'flags': t.get('flags')}
+                self._alert(m)
+                e = self.rooms.get(t['rid'])
+                if e is None: continue # Cold room: next read loads it from SQLite
+                if e['ready']: self._merge(e, m)
+                else: e['pending'].append(m)
+
+    def start_sync(self, interval=WORKER_SYNC_S):
+        # Start positions are taken now, before any room is cached, so no commit falls in between
+        self.watch = {shard: self._watch(shard) for shard in range(SHARD_COUNT)}
+        threading.Thread(target=self._sync_loop, args=(interval,), name="lenovo-hub-sync", daemon=True).start()
+
+    def _watch(self, shard):
+        conn = None
+        try:
+            conn = connect_db(get_shard_file(shard))
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+        except: last_id = None # Not readable yet (tables missing, locked): taken on the first sync
+        finally:
+            if conn: conn.close()
+        return {'conn': None, 'version': None, 'since': now_ms(), 'last_id': last_id}
+
+    def _sync_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.sync()
+                self.sync_error = None
+            except Exception as e:
+                # Commits may have been missed: start over and drop every cached room (reloaded on read)
+                self.sync_error = str(e)
+                for w in self.watch.values():
+                    if w['conn']: w['conn'].close()
+                self.watch = {shard: self._watch(shard) for shard in range(SHARD_COUNT)}
+                with self.lock: self.rooms.clear()
+
+    def sync(self):
+        """Folds commits made through other connections (other workers) into the cached rooms:
+        new messages by id, room rows by updated_at_ms, deletions by tombstone. A shard is only
+        read when its PRAGMA data_version moved. Ids only grow in commit order (one writer per
+        file), so `id > last seen` never skips a message."""
+        for shard, w in self.watch.items():
+            if w['conn'] is None: w['conn'] = connect_db(get_shard_file(shard)) # Owned by the sync thread
+            conn = w['conn']
+            if w['last_id'] is None: w['last_id'] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+            version = conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == w['version']: continue
+            w['version'] = version
+            started, since = now_ms(), w['since'] - ROOM_INDEX_SLACK_MS
+            msgs = conn.execute("SELECT id, room_id, sender, role, text, timestamp_ms, flags FROM messages WHERE id > ? ORDER BY id", (w['last_id'],)).fetchall()
+            rows = conn.execute("SELECT id, status, agent, last_activity_ms FROM rooms WHERE updated_at_ms > ?", (since,)).fetchall()
+            gone = conn.execute("SELECT room_id FROM room_deletions WHERE deleted_at_ms > ?", (since,)).fetchall() if shard == 0 else []
+            if msgs: w['last_id'] = msgs[-1][0]
+            w['since'] = started
+            self._fold(msgs, rows, gone)
+
+    def _fold(self, msgs, rows, gone):
+        fresh, changed, deleted = {}, [], []
+        with self.lock:
+            for row in msgs:
+                m = dict(zip(MESSAGE_FIELDS, row))
+                self._alert(m)
+                e = self.rooms.get(m['room_id'])
+                if e is None: fresh[m['room_id']] = m['id'] # Not cached here, but a stream may be open
+                elif not e['ready']: e['pending'].append(m)
+                elif self._merge(e, m):
+                    fresh[m['room_id']] = m['id']
+                    self.synced += 1
+            for rid, status, agent, last_act in rows:
+                e = self.rooms.get(rid)
+                if e is None or not e['ready'] or not e['room']: continue
+                room = e['room']
+                if (room.get('status'), room.get('agent')) != (status, agent): changed.append((rid, status, agent))
+                room.update(status=status, agent=agent)
+                if last_act and last_act > (room.get('last_activity_ms') or 0): room['last_activity_ms'] = last_act
+            for (rid,) in gone:
+                if self.rooms.pop(rid, None) is not None: deleted.append(rid)
+        for rid, mid in fresh.items(): publish_room_event(rid, 'message', id=mid)
+        for rid, status, agent in changed: publish_room_event(rid, 'status', status=status, agent=agent)
+        for rid in deleted: publish_room_event(rid, 'status', status='Deleted')
+
+    def update_room(self, rid, **fields):
+        with self.lock:
+            e = self.rooms.get(int(rid))
+            if e is None: return
+            if e['room'] is None: e['room'] = {}
+            e['room'].update(fields)
+
+    def evict(self, rid):
+        """Drops the cached room only; the next read reloads it. Alerts stay (see drop_alerts)."""
+        with self.lock: self.rooms.pop(int(rid), None)
+
+    def drop_alerts(self, rid):
+        """Forgets a deleted room's compliance alerts. Not part of evict: alerts only arrive with
+        new messages, so a reload could never bring them back."""
+        with self.lock:
+            self.alerts = deque((a for a in self.alerts if a['room_id'] != int(rid)), maxlen=self.alerts.maxlen)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'rooms': len(self.rooms), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'hit_rate': (self.hits / total) if total else 0.0,
+                    'transitions': self.transitions, 'conflicts': self.conflicts, 'synced': self.synced}
+
+@st.cache_resource
+def get_room_hub():
+    hub = RoomHub()
+    if MULTI_WORKER: hub.start_sync()
+    return hub
+
+@traced("get_live_msgs")
+def get_live_msgs(rid, limit=50):
+    """Hub-backed equivalent of get_msgs() for the live feed and sentiment meter."""
+    try:
+        return pd.DataFrame(get_room_hub().get_msgs(rid, limit), columns=MESSAGE_FIELDS)
+    except: return get_msgs(rid, limit)
+
+# --- ROOM INDEX (SIDEBAR) ---
+class RoomIndex:
+    """Process-wide copy of the few room columns the sidebar shows. A refresh re-reads only
+    rooms whose updated_at_ms passed the watermark (index range scan per shard) plus new
+    tombstones from room_deletions, instead of the whole rooms table on every rerun."""
+    def __init__(self, interval=ROOM_INDEX_REFRESH_S, slack_ms=ROOM_INDEX_SLACK_MS):
+        self.interval = interval
+        self.slack_ms = slack_ms
+        self.lock = threading.Lock()
+        self.rooms = {}         # rid -> row tuple (ROOM_INDEX_FIELDS)
+        self.watermark = None   # None until the first (full) load
+        self.next_check = 0.0
+        self.ordered = None     # Newest-first list, rebuilt only after a change
+        self.stats = {'full': 0, 'incremental': 0, 'rows': 0, 'skipped': 0}
+
+    def touch(self):
+        # Local writes: the next listing refreshes right away
+        with self.lock: self.next_check = 0.0
+
+    def refresh(self):
+        now = time.monotonic()
+        with self.lock:
+            if now < self.next_check:
+                self.stats['skipped'] += 1
+                return
+            self.next_check = now + self.interval
+            wm = self.watermark
+            if wm is not None and now_ms() - wm > TOMBSTONE_TTL_MS: wm = None # Tombstones since then may be purged
+        since = -1 if wm is None else wm - self.slack_ms
+        started = now_ms()
+        conn = None
+        try:
+            conn = get_unified_connection()
+            rows = conn.execute(f"SELECT {', '.join(ROOM_INDEX_FIELDS)} FROM all_rooms WHERE updated_at_ms > ?", (since,)).fetchall()
+            gone = conn.execute("SELECT room_id FROM room_deletions WHERE deleted_at_ms > ?", (since,)).fetchall() if wm is not None else []
+        except:
+            with self.lock: self.next_check = 0.0
+            return
+        finally:
+            if conn: conn.close()
+
+        with self.lock:
+            changed = False
+            if wm is None and self.rooms:
+                self.rooms = {}
+                changed = True
+            for row in rows:
+                if self.rooms.get(row[0]) != row:
+                    self.rooms[row[0]] = row
+                    changed = True
+            for (rid,) in gone:
+                changed = self.rooms.pop(rid, None) is not None or changed
+            if changed: self.ordered = None
+            self.watermark = started if wm is None else max(wm, started)
+            self.stats['full' if wm is None else 'incremental'] += 1
+            self.stats['rows'] += len(rows)
+
+    @traced("room_page", method=True)
+    def page(self, status="ALL", host=None, agent=None, page=0, size=ROOM_PAGE_SIZE):
+        """Filtered page as a list of dicts plus the total match count. Filters run on the
+        in-memory index; only the visible page is turned into dicts/widgets."""
+        self.refresh()
+        with self.lock:
+            if self.ordered is None:
+                self.ordered = sorted(self.rooms.values(), key=lambda r: (r[4] or 0, r[0]), reverse=True)
+            ordered = self.ordered
+        want = None if status == "ALL" else status.title()
+        hits = [r for r in ordered
+                if (want is None or r[3] == want)
+                and (host is None or r[1] == host)
+                and (agent is None or r[2] in (agent, 'Waiting...'))]
+        return [dict(zip(ROOM_INDEX_FIELDS, r)) for r in hits[page * size:(page + 1) * size]], len(hits)
+
+@st.cache_resource
+def get_room_index():
+    return RoomIndex()
+
+# --- PRESENCE (IN-MEMORY, TTL) ---
+class PresenceTracker:
+    """Per-room map of user -> last heartbeat / typing deadline. Nothing touches SQLite:
+    a closed tab just stops beating and ages out after PRESENCE_TTL_S."""
+    def __init__(self, ttl=PRESENCE_TTL_S, typing_ttl=TYPING_TTL_S):
+        self.ttl = ttl
+        self.typing_ttl = typing_ttl
+        self.lock = threading.Lock()
+        self.rooms = {} # rid -> {user: {'role', 'seen', 'typing_until'}}
+        self.stats = {'beats': 0, 'expired': 0}
+
+    def beat(self, rid, user, role, typing=None):
+        """typing=True/False sets/clears the typing flag; None is a plain heartbeat.
+        Returns True when the user's visible typing state flipped."""
+        now = time.monotonic()
+        with self.lock:
+            room = self.rooms.setdefault(int(rid), {})
+            e = room.get(user)
+            if e is None: e = room[user] = {'role': role, 'seen': now, 'typing_until': 0.0}
+            was_typing = e['typing_until'] > now
+            e['seen'] = now
+            e['role'] = role
+            if typing: e['typing_until'] = now + self.typing_ttl
+            elif typing is not None: e['typing_until'] = 0.0
+            self.stats['beats'] += 1
+            return was_typing != (e['typing_until'] > now)
+
+    def clear_typing(self, rid, user):
+        with self.lock:
+            e = self.rooms.get(int(rid), {}).get(user)
+            if e: e['typing_until'] = 0.0
+
+    def _expire(self, rid, room, now):
+        for user in [u for u, e in room.items() if now - e['seen'] > self.ttl]:
+            del room[user]
+            self.stats['expired'] += 1
+        if not room: del self.rooms[rid]
+
+    def room(self, rid):
+        """Live users of a room as [{'user', 'role', 'typing'}]."""
+        now = time.monotonic()
+        with self.lock:
+            room = self.rooms.get(int(rid))
+            if not room: return []
+            self._expire(int(rid), room, now)
+            return [{'user': u, 'role': e['role'], 'typing': e['typing_until'] > now} for u, e in room.items()]
+
+    def sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            for rid in list(self.rooms): self._expire(rid, self.rooms[rid], now)
+
+    def counts(self):
+        with self.lock:
+            return len(self.rooms), sum(len(r) for r in self.rooms.values())
+
+@st.cache_resource
+def get_presence():
+    return PresenceTracker()
+
+# --- SIDE CHANNEL (ASYNCIO HTTP) ---
+class SideChannel:
+    """Minimal HTTP/1.1 server on its own thread + event loop, beside Streamlit's server.
+    Browsers post presence beacons here (navigator.sendBeacon, text/plain: no CORS preflight),
+    so keystrokes never cause a Streamlit rerun, and hold one Server-Sent Events stream per
+    open room (GET /events) that carries change hints pushed by publish(). Requests carry the
+    session token the page was rendered with; only rooms granted to it are accepted. If the port
+    is taken the app carries on without it (error is kept for the diagnostics tab)."""
+    def __init__(self, port=SIDE_CHANNEL_PORT, host=SIDE_CHANNEL_HOST, presence=None):
+        self.port = port
+        self.host = host
+        self.presence = presence
+        self.routes = {('POST', '/presence'): self.handle_presence, ('GET', '/health'): self.handle_health,
+                       ('GET', '/events'): self.handle_events}
+        self.stats = {'requests': 0, 'bad_requests': 0, 'forbidden': 0, 'published': 0, 'delivered': 0, 'coalesced': 0, 'rejected': 0}
+        self.grants = {}      # (token, rid) -> (user, role, expires); written by script threads
+        self.subscribers = {} # rid -> set of asyncio.Queue (loop thread only)
+        self.clients = {}     # (token, rid) -> open streams; read by script threads
+        self.error = None
+        self.loop = None
+        self.ready = threading.Event()
+        threading.Thread(target=self._serve, name="lenovo-side-channel", daemon=True).start()
+        self.ready.wait(2.0)
+
+    def _serve(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.server = self.loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        except OSError as e:
+            self.error = str(e)
+            self.ready.set()
+            return
+        self.ready.set()
+        self.loop.call_later(PRESENCE_TTL_S, self._sweep)
+        self.loop.run_forever()
+
+    def _sweep(self):
+        if self.presence: self.presence.sweep()
+        now = time.monotonic()
+        for key, g in list(self.grants.items()):
+            if g[2] < now: self.grants.pop(key, None)
+        self.loop.call_later(PRESENCE_TTL_S, self._sweep)
+
+    @property
+    def running(self):
+        return self.ready.is_set() and self.error is None
+
+    async def _handle(self, reader, writer):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            request_line, *header_lines = head.decode('latin-1').split("\r\n")
+            method, target, _ = request_line.split(" ", 2)
+            headers = {k.strip().lower(): v.strip() for k, v in (l.split(":", 1) for l in header_lines if ":" in l)}
+            length = int(headers.get('content-length') or 0)
+            if length > SIDE_CHANNEL_MAX_BODY: raise ValueError("body too large")
+            body = await asyncio.wait_for(reader.readexactly(length), 5) if length else b""
+            path, _, query = target.partition("?")
+            self.stats['requests'] += 1
+            if method == 'OPTIONS':
+                await self._respond(writer, 204, b"")
+                return
+            handler = self.routes.get((method, path))
+            if handler is None:
+                await self._respond(writer, 404, b"not found")
+                return
+            await handler(writer, body, dict(p.split("=", 1) for p in query.split("&") if "=" in p))
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError, KeyError, TypeError):
+            self.stats['bad_requests'] += 1
+            try: await self._respond(writer, 400, b"bad request")
+            except ConnectionError: pass
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body, content_type="text/plain"):
+        reason = {200: "OK", 204: "No Content", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                  503: "Service Unavailable"}.get(status, "OK")
+        writer.write((f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                      "Access-Control-Allow-Origin: *\r\nAccess-Control-Allow-Headers: Content-Type\r\n"
+                      "Connection: close\r\n\r\n").encode() + body)
+        await writer.drain()
+
+    async def handle_presence(self, writer, body, query):
+        beat = json.loads(body or b"{}")
+        rid = int(beat['room'])
+        grant = self.granted(str(beat.get('token', ''))[:64], rid)
+        if grant is None:
+            self.stats['forbidden'] += 1
+            await self._respond(writer, 403, b"forbidden")
+            return
+        user, role = grant # Who is typing comes from the session, not the beacon body
+        typing = beat.get('typing')
+        if self.presence.beat(rid, user, role, None if typing is None else bool(typing)):
+            self._fanout(rid, {'kind': 'presence', 'room': rid})
+        await self._respond(writer, 204, b"")
+
+    async def handle_health(self, writer, body, query):
+        await self._respond(writer, 200, b"ok")
+
+    async def handle_events(self, writer, body, query):
+        """SSE stream for one room. Events are refresh hints ({kind, room, ...}); the page
+        re-reads through the hub, so a coalesced or missed event costs nothing but latency."""
+        rid, token = int(query['room']), urllib.parse.unquote(query.get('token', ''))[:64]
+        if self.granted(token, rid) is None:
+            self.stats['forbidden'] += 1
+            await self._respond(writer, 403, b"forbidden")
+            return
+        if sum(len(s) for s in self.subscribers.values()) >= PUSH_MAX_SUBSCRIBERS:
+            self.stats['rejected'] += 1
+            await self._respond(writer, 503, b"too many subscribers")
+            return
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Access-Control-Allow-Origin: *\r\nX-Accel-Buffering: no\r\n\r\n"
+                     + f"retry: {int(PUSH_POLL_SECONDS * 1000)}\n\n".encode())
+        await writer.drain()
+        q = asyncio.Queue()
+        self.subscribers.setdefault(rid, set()).add(q)
+        self.clients[(token, rid)] = self.clients.get((token, rid), 0) + 1
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(q.get(), PUSH_PING_SECONDS)
+                    writer.write(f"event: {event['kind']}\ndata: {json.dumps(event)}\n\n".encode())
+                except asyncio.TimeoutError:
+                    writer.write(b": ping\n\n")
+                await writer.drain()
+        finally:
+            self.subscribers[rid].discard(q)
+            if not self.subscribers[rid]: del self.subscribers[rid]
+            self.clients[(token, rid)] -= 1
+            if not self.clients[(token, rid)]: del self.clients[(token, rid)]
+
+    def _fanout(self, rid, event):
+        # Loop thread. One pending hint per stream is enough: the client re-reads everything
+        for q in self.subscribers.get(rid, ()):
+            if q.empty():
+                q.put_nowait(event)
+                self.stats['delivered'] += 1
+            else: self.stats['coalesced'] += 1
+
+    def publish(self, rid, kind, **data):
+        """Thread-safe: queue a room event for every open stream of `rid`."""
+        if not self.running: return
+        self.stats['published'] += 1
+        self.loop.call_soon_threadsafe(self._fanout, int(rid), dict(data, kind=kind, room=int(rid)))
+
+    def on_messages(self, tickets):
+        """Write-queue listener: one event per room per committed batch."""
+        last = {}
+        for t in tickets: last[t['rid']] = t
+        for rid, t in last.items(): self.publish(rid, 'message', id=t['id'], flags=t.get('flags'))
+
+    def grant(self, token, rid, user, role):
+        """Script thread: lets this session's token beacon and stream for `rid` as user/role."""
+        self.grants[(token, int(rid))] = (user, role, time.monotonic() + SIDE_CHANNEL_GRANT_TTL_S)
+
+    def revoke(self, token, rid):
+        self.grants.pop((token, int(rid)), None)
+
+    def granted(self, token, rid):
+        """(user, role) the token may act as in `rid`, or None."""
+        g = self.grants.get((token, int(rid)))
+        return g[:2] if g and g[2] >= time.monotonic() else None
+
+    def subscribed(self, token, rid):
+        return self.clients.get((token, int(rid)), 0) > 0
+
+    def subscriber_count(self):
+        return sum(list(self.clients.values()))
+
+@st.cache_resource
+def get_side_channel():
+    return SideChannel(presence=get_presence()) if SIDE_CHANNEL_PORT > 0 else None
+
+def publish_room_event(rid, kind, **data):
+    side = get_side_channel()
+    if side: side.publish(rid, kind, **data)
+
+PRESENCE_JS = """
+<script>
+(function() {
+    const cfg = __CFG__;
+    const host = window.parent.location;
+    const url = host.protocol + "//" + host.hostname + ":" + cfg.port + "/presence";
+    const doc = window.parent.document;
+    let lastTyping = 0;
+    function send(typing) {
+        const body = JSON.stringify({room: cfg.room, token: cfg.token, typing: typing});
+        try { navigator.sendBeacon(url, new Blob([body], {type: "text/plain"})); } catch (e) {}
+    }
+    // One listener per page: the iframe is rebuilt on room change, so replace the old one
+    if (window.parent.__lenovoPresenceKey) doc.removeEventListener("keydown", window.parent.__lenovoPresenceKey, true);
+    const onKey = function(e) {
+        if (!e.target || !e.target.closest || !e.target.closest('[data-testid="stChatInput"]')) return;
+        if (e.key === "Enter" && !e.shiftKey) { lastTyping = 0; send(false); return; }
+        const now = Date.now();
+        if (now - lastTyping > cfg.throttle) { lastTyping = now; send(true); }
+    };
+    window.parent.__lenovoPresenceKey = onKey;
+    doc.addEventListener("keydown", onKey, true);
+    send(null);
+    setInterval(function() { if (!doc.hidden) send(null); }, cfg.heartbeat);
+})();
+</script>
+"""
+
+PUSH_JS = """
+<script>
+(function() {
+    const cfg = __CFG__;
+    if (!window.EventSource) return; // Polling fallback only
+    const host = window.parent.location;
+    const url = host.protocol + "//" + host.hostname + ":" + cfg.port + "/events?room=" + cfg.room + "&token=" + cfg.token;
+    const doc = window.parent.document;
+    let pending = null;
+    function refresh() {
+        if (pending) return;
+        pending = setTimeout(function() {
+            pending = null;
+            // Clicking the hidden button reruns only the live-updates fragment
+            const btn = doc.querySelector(".st-key-" + cfg.button + " button");
+            if (btn) btn.click();
+        }, cfg.debounce);
+    }
+    const es = new EventSource(url); // Reconnects by itself after `retry` ms
+    ["message", "status", "presence"].forEach(function(kind) { es.addEventListener(kind, refresh); });
+    window.addEventListener("pagehide", function() { es.close(); });
+})();
+</script>
+"""
+
+def push_token():
+    """Per-session secret for the side channel: grants rooms to beacons and event streams, and
+    lets the fragment see that its own stream is live."""
+    if 'push_token' not in st.session_state: st.session_state['push_token'] = os.urandom(16).hex()
+    return st.session_state['push_token']
+
+def push_connected(rid):
+    side = get_side_channel()
+    return bool(side and side.running and side.subscribed(push_token(), rid))
+
+def inject_side_channel_client(rid):
+    """Zero-height component: heartbeats + throttled typing beacons to the side channel,
+    and the room's event stream that pokes the live-updates fragment."""
+    side = get_side_channel()
+    if not side or not side.running: return
+    side.grant(push_token(), rid, st.session_state['user'], st.session_state['role'])
+    cfg = {'port': side.port, 'room': int(rid),
+           'heartbeat': PRESENCE_HEARTBEAT_MS, 'throttle': TYPING_THROTTLE_MS,
+           'token': push_token(), 'button': f"push_refresh_{int(rid)}", 'debounce': PUSH_DEBOUNCE_MS}
+    cfg_js = json.dumps(cfg).replace("</", "<\\/")
+    embed_script(PRESENCE_JS.replace("__CFG__", cfg_js) + PUSH_JS.replace("__CFG__", cfg_js))
+
+def embed_script(src):
+    # Scripts only run inside an iframe; st.iframe supersedes components.html in newer Streamlit
+    if hasattr(st, "iframe"): st.iframe(src, height=1)
+    else: components.html(src, height=0)
+
+# --- CONFIG CACHE ---
+def derive_config(key, value):
+    """Structures computed once per config version instead of on every score/grade."""
+    if key != 'scorecard': return {}
+    weights = {}
+    for item in value:
+        weights[item['name']] = weights.get(item['name'], 0.0) + float(item['weight'])
+    return {'hash': hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()[:16],
+            'weights': weights, 'total_weight': sum(weights.values())}
+
+class ConfigCache:
+    """Parsed config values shared by every session in the process. An entry is re-validated
+    with a one-column version lookup at most every CONFIG_CHECK_SECONDS, so writes from
+    other processes show up within that window; update_config invalidates locally at once."""
+    def __init__(self, check_seconds=CONFIG_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.stats = {'hits': 0, 'checks': 0, 'reloads': 0}
+
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            e = self.entries.get(key)
+            if e and now - e['checked'] < self.check_seconds:
+                self.stats['hits'] += 1
+                return e
+            self.stats['checks'] += 1
+
+        try:
+            version = get_storage().get_config_version(key)
+            if version is None: version = CONFIG_MISSING # Never saved: defaults, cached until a row shows up
+        except Exception: version = None # Not initialized yet (no config table)
+        if e and version is not None and version == e['version']:
+            with self.lock: e['checked'] = now
+            return e
+
+        value = load_config(key)
+        e = {'version': version, 'value': value, 'checked': now, **derive_config(key, value)}
+        with self.lock:
+            self.stats['reloads'] += 1
+            if version is not None: self.entries[key] = e # Lookup failed (pre-init_db): don't cache
+        return e
+
+    def invalidate(self, key):
+        with self.lock: self.entries.pop(key, None)
+
+@st.cache_resource
+def get_config_cache():
+    return ConfigCache()
+
+# --- SCENARIO CATALOG ---
+def scenario_hash(sc):
+    return hashlib.sha1(json.dumps([sc.get(f) for f in SCENARIO_FIELDS]).encode()).hexdigest()[:16]
+
+def normalize_scenario(sc):
+    sc = {f: (str(sc.get(f)).strip() if sc.get(f) else None) for f in SCENARIO_FIELDS}
+    if sc['difficulty']: sc['difficulty'] = sc['difficulty'].upper()
+    return sc
+
+def upsert_scenario(conn, sc, created_by=None):
+    """Catalog id for a scenario dict on the catalog connection, inserting it if new (caller commits)."""
+    sc = normalize_scenario(sc)
+    h = scenario_hash(sc)
+    conn.execute(
+        "INSERT OR IGNORE INTO scenarios (name, product, issue, difficulty, content_hash, created_by, created_at_ms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (sc['name'], sc['product'], sc['issue'], sc['difficulty'], h, created_by, now_ms())
+    )
+    return conn.execute("SELECT id FROM scenarios WHERE content_hash = ?", (h,)).fetchone()[0]
+
+class ScenarioCatalog:
+    """Parsed scenarios by id, shared by every session in the process. Rows are immutable, so
+    an entry never goes stale: the mission brief on every live tick is a dict lookup. The
+    launcher listing is re-checked (MAX(id)) at most every CONFIG_CHECK_SECONDS."""
+    def __init__(self, check_seconds=CONFIG_CHECK_SECONDS):
+        self.check_seconds = check_seconds
+        self.lock = threading.Lock()
+        self.by_id = {}
+        self.listing = None
+        self.top = None
+        self.checked = 0.0
+        self.stats = {'hits': 0, 'misses': 0, 'lists': 0}
 
-CRITICAL_DEFINITIONS = {
-    "CX Critical": ["Rude attitude or sarcasm.", "Providing misleading information.", "Chat Dumping."],
-    "Business Critical": ["Stacking discounts.", "Unauthorized prices.", "Misrepresenting specs."],
-    "Compliance Critical": ["PCI DSS: Asking for Credit Card info.", "GDPR: Sharing personal data."]
-}
+    def _store(self, row):
+        sc = dict(zip(['id'] + SCENARIO_FIELDS, row))
+        with self.lock: self.by_id.setdefault(sc['id'], sc)
+        return sc
 
-# --- DATABASE (STABILITY FIX) ---
-def get_db_connection():
-    # Use a timeout to handle concurrent writes better
-    return sqlite3.connect(DB_FILE, timeout=10)
+    def get(self, sid):
+        """Shared dict: treat as read-only."""
+        if sid is None: return None
+        with self.lock:
+            sc = self.by_id.get(sid)
+            self.stats['hits' if sc else 'misses'] += 1
+        if sc: return sc
+        row = run_query("SELECT id, name, product, issue, difficulty FROM scenarios WHERE id = ?", (sid,), fetch_mode="one")
+        return self._store(row) if row else None
 
-def run_query(query, params=(), fetch_mode="all"):
-    """Helper to ensure connections always close."""
-    conn = None
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute(query, params)
-        if fetch_mode == "all":
-            return c.fetchall()
-        elif fetch_mode == "one":
-            return c.fetchone()
-        else:
+    def list(self):
+        now = time.monotonic()
+        if self.listing is not None and now - self.checked < self.check_seconds: return self.listing
+        row = run_query("SELECT MAX(id) FROM scenarios", fetch_mode="one")
+        top = row[0] if row else None
+        if self.listing is None or top != self.top:
+            rows = run_query("SELECT id, name, product, issue, difficulty FROM scenarios ORDER BY id") or []
+            self.listing = [self._store(r) for r in rows]
+            self.top = top
+            self.stats['lists'] += 1
+        self.checked = now
+        return self.listing
+
+    def add(self, sc, created_by=None):
+        conn = None
+        try:
+            conn = get_db_connection()
+            sid = upsert_scenario(conn, sc, created_by)
             conn.commit()
-            return c.lastrowid
-    except Exception as e:
-        return None
-    finally:
-        if conn: conn.close()
+        finally:
+            if conn: conn.close()
+        self.checked = 0.0 # Show it in this process's launcher right away
+        return sid
 
-def init_db():
-    conn = None
-    try:
-        conn = get_db_connection()
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS rooms (id INTEGER PRIMARY KEY AUTOINCREMENT, host TEXT, agent TEXT, status TEXT, created_at TIMESTAMP, last_activity TIMESTAMP, scenario TEXT)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY AUTOINCREMENT, room_id INTEGER, sender TEXT, role TEXT, text TEXT, timestamp TIMESTAMP)''')
-        c.execute('''CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT)''')
-        
-        # Check if scorecard exists
-        c.execute("SELECT * FROM config WHERE key='scorecard'")
-        if not c.fetchone():
-            c.execute("INSERT INTO config (key, value) VALUES (?, ?)", ('scorecard', json.dumps(DEFAULT_SCORECARD)))
-        
-        # MIGRATION: Ensure 'scenario' column exists
+@st.cache_resource
+def get_scenarios():
+    return ScenarioCatalog()
+
+def scenario_label(sc):
+    label = f"{sc['name'] or 'N/A'} · {sc['product'] or 'N/A'}"
+    return f"[{sc['difficulty']}] {label}" if sc.get('difficulty') else label
+
+# --- READ SNAPSHOT ---
+class SnapshotManager:
+    """Copies every shard file into SNAPSHOT_DIR with the sqlite3 online backup API, so long
+    manager reads (exports, grading sweeps, analytics) never hold locks on the live files.
+    The copy runs in SNAPSHOT_PAGES_PER_STEP steps and is swapped in with os.replace: open
+    readers keep the copy they started on. Each shard is consistent on its own; shards are
+    copied one after another, not at a single instant."""
+    def __init__(self, directory=SNAPSHOT_DIR, interval=SNAPSHOT_INTERVAL_S):
+        self.dir = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock() # One refresh at a time
+        self.timing = QueryStats()   # Refresh duration histogram + failures
+        self.stats = {'refreshes': 0, 'failures': 0, 'restarts': 0, 'reads': 0, 'fallbacks': 0}
+        self.error = None
+        self.meta = self._load_meta()
+        if interval > 0:
+            threading.Thread(target=self._schedule, args=(interval,), name="lenovo-snapshot", daemon=True).start()
+
+    def path(self, shard):
+        return os.path.join(self.dir, os.path.basename(get_shard_file(shard)))
+
+    def _load_meta(self):
+        # A snapshot left by an earlier process is still usable if the layout matches
         try:
-            c.execute("ALTER TABLE rooms ADD COLUMN scenario TEXT")
-        except:
-            pass 
+            with open(os.path.join(self.dir, "snapshot.json")) as f: meta = json.load(f)
+            if meta.get('shards') == SHARD_COUNT and all(os.path.exists(self.path(s)) for s in range(SHARD_COUNT)): return meta
+        except: pass
+        return None
 
-        conn.commit()
-    finally:
-        if conn: conn.close()
+    def _schedule(self, interval):
+        while True:
+            time.sleep(interval)
+            if MULTI_WORKER: self.meta = self._load_meta() or self.meta # Another worker may have just refreshed
+            age = self.age_s()
+            if age is None or age >= interval: self.refresh()
 
-def get_rooms():
-    conn = None
-    try:
-        conn = get_db_connection()
-        df = pd.read_sql_query("SELECT * FROM rooms ORDER BY created_at DESC", conn)
-        return df
-    except: return pd.DataFrame()
-    finally:
-        if conn: conn.close()
+    def age_s(self):
+        meta = self.meta
+        return None if not meta else max(0.0, (now_ms() - meta['taken_at_ms']) / 1000)
 
-def create_room(host, scenario=None):
-    sc_json = json.dumps(scenario) if scenario else None
-    now = datetime.datetime.now()
-    # Uses helper to ensure close
-    return run_query(
-        "INSERT INTO rooms (host, agent, status, created_at, last_activity, scenario) VALUES (?, ?, ?, ?, ?, ?)", 
-        (host, 'Waiting...', 'Active', now, now, sc_json), 
-        fetch_mode="commit"
-    )
+    def refresh(self):
+        """Copy all shards; returns the new metadata, or None (error kept in self.error)."""
+        with self.lock:
+            t0, taken = time.perf_counter(), now_ms()
+            pages, size, restarts, error = 0, 0, [0], None
 
-def join_room(rid, agent):
-    run_query("UPDATE rooms SET agent = ? WHERE id = ?", (agent, rid), fetch_mode="commit")
+            def progress(status, remaining, total, last=[None]):
+                # A write to the source between steps restarts the copy from page 0
+                if last[0] is not None and remaining > last[0]: restarts[0] += 1
+                last[0] = remaining
+            try:
+                for shard in range(SHARD_COUNT):
+                    target = self.path(shard)
+                    tmp = f"{target}.{os.getpid()}.tmp"
+                    src, dst = connect_db(get_shard_file(shard)), sqlite3.connect(tmp)
+                    try:
+                        src.backup(dst, pages=SNAPSHOT_PAGES_PER_STEP, progress=progress, sleep=SNAPSHOT_STEP_SLEEP_S)
+                        dst.execute("PRAGMA journal_mode = DELETE") # A WAL source makes a WAL copy; read-only opens need rollback
+                        pages += dst.execute("PRAGMA page_count").fetchone()[0]
+                    finally:
+                        dst.close()
+                        src.close()
+                    os.replace(tmp, target)
+                    size += os.path.getsize(target)
+            except Exception as e:
+                error = e
+            ms = (time.perf_counter() - t0) * 1000
+            self.timing.record('refresh', ms, error)
+            self.stats['restarts'] += restarts[0]
+            if error:
+                self.stats['failures'] += 1
+                self.error = str(error)
+                return None
+            self.stats['refreshes'] += 1
+            self.error = None
+            self.meta = {'taken_at_ms': taken, 'duration_ms': round(ms, 1), 'bytes': size, 'pages': pages,
+                         'shards': SHARD_COUNT, 'restarts': restarts[0]}
+            try:
+                with open(os.path.join(self.dir, "snapshot.json"), "w") as f: json.dump(self.meta, f)
+            except: pass
+            return self.meta
 
-def delete_room(rid):
-    conn = None
-    try:
-        conn = get_db_connection()
-        conn.execute("DELETE FROM rooms WHERE id = ?", (rid,))
-        conn.execute("DELETE FROM messages WHERE room_id = ?", (rid,))
-        conn.commit()
-    finally:
-        if conn: conn.close()
+    def connect(self, max_age_s=SNAPSHOT_MAX_AGE_S):
+        """Read-only unified connection (all_rooms / all_messages) on the snapshot, refreshed
+        first when missing or older than max_age_s. Falls back to the live files if no copy
+        can be made, so callers always get an answer."""
+        age = self.age_s()
+        if age is None or age > max_age_s: self.refresh()
+        if not self.meta:
+            self.stats['fallbacks'] += 1
+            return get_unified_connection()
+        self.stats['reads'] += 1
+        uri = lambda shard: "file:" + urllib.parse.quote(os.path.abspath(self.path(shard))) + "?mode=ro"
+        conn = sqlite3.connect(uri(0), uri=True, timeout=10, factory=InstrumentedConnection)
+        conn.stats = get_query_stats()
+        return unify_shards(conn, [uri(s) for s in range(1, SHARD_COUNT)])
 
-def send_msg(rid, sender, role, text):
-    if not text.strip(): return
-    conn = None
-    try:
-        conn = get_db_connection()
-        now = datetime.datetime.now()
-        conn.execute("INSERT INTO messages (room_id, sender, role, text, timestamp) VALUES (?, ?, ?, ?, ?)", (rid, sender, role, text, now))
-        conn.execute("UPDATE rooms SET last_activity = ? WHERE id = ?", (now, rid))
-        conn.commit()
-    finally:
-        if conn: conn.close()
+@st.cache_resource
+def get_snapshot():
+    return SnapshotManager()
 
-def get_msgs(rid, limit=50):
-    conn = None
+def snapshot_caption(snap):
+    meta, age = snap.meta, snap.age_s()
+    if not meta: return "SNAPSHOT: NONE YET" + (f" (LAST ERROR: {snap.error})" if snap.error else "")
+    return (f"SNAPSHOT AS OF {format_ts(meta['taken_at_ms'], '%H:%M:%S')} ({int(age)}s OLD) · "
+            f"{meta['bytes'] / 1e6:.1f} MB IN {meta['duration_ms']:.0f} MS")
+
+# --- ATTACHMENTS (CONTENT-ADDRESSED BLOB STORE) ---
+def blob_path(sha):
+    # Two-level fan-out keeps directories small: attachments/ab/abcdef...
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+def thumb_path(sha):
+    return os.path.join(BLOB_DIR, "thumbs", sha + ".png")
+
+def write_file_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def store_attachment(rid, uploader, filename, data, mime):
+    """Saves the bytes once per content hash and records the upload. Returns the attachment id."""
+    sha = hashlib.sha256(data).hexdigest()
+    # Row first: retention only removes a blob no row references (see RetentionManager._forget),
+    # so once the row is in, a missing file here means it is ours to write
+    aid = run_query(
+        "INSERT INTO attachments (sha256, room_id, uploader, filename, mime, size, created_at_ms) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (sha, rid, uploader, filename, mime, len(data), now_ms()),
+        fetch_mode="commit"
+    )
+    if not aid: return None
     try:
-        conn = get_db_connection()
-        query = f"""
-            SELECT * FROM (
-                SELECT * FROM messages 
-                WHERE room_id = ? 
-                ORDER BY id DESC 
-                LIMIT {limit}
-            ) ORDER BY id ASC
-        """
-        df = pd.read_sql_query(query, conn, params=(rid,))
-        return df
-    except: return pd.DataFrame()
-    finally:
-        if conn: conn.close()
+        if not os.path.exists(blob_path(sha)): write_file_atomic(blob_path(sha), data)
+    except OSError:
+        run_query("DELETE FROM attachments WHERE id = ?", (aid,), fetch_mode="commit")
+        return None
+    return aid
 
-def get_room_details(rid):
-    row = run_query("SELECT scenario FROM rooms WHERE id = ?", (rid,), fetch_mode="one")
+def send_attachment(rid, sender, role, filename, data, mime):
+    """Stores and posts an upload. Returns None once sent, else the reason (see post_message)."""
+    if RATE_LIMITS:
+        scope, wait = get_rate_limiter().admit(rid, sender) # Checked before the bytes are stored
+        if scope: return f"SLOW DOWN: RETRY THE UPLOAD IN {max(wait, 0.1):.1f}S."
+        if wait: time.sleep(wait)
+    aid = store_attachment(rid, sender, filename, data, mime)
+    if not aid: return "NOT SENT: ATTACHMENT COULD NOT BE STORED"
+    try: send_msg(rid, sender, role, f"{ATTACHMENT_PREFIX}{aid}")
+    except Exception as e: return f"NOT SENT: {e}"
+    return None
+
+@st.cache_data(max_entries=1000, show_spinner=False)
+def get_attachment(aid):
+    row = run_query("SELECT id, sha256, filename, mime, size FROM attachments WHERE id = ?", (aid,), fetch_mode="one")
+    return dict(zip(['id', 'sha256', 'filename', 'mime', 'size'], row)) if row else None
+
+def get_thumbnail(att):
+    """Path of the cached PNG thumbnail, generated on first request. None if not an image."""
+    if not att or not HAS_PIL or not (att['mime'] or "").startswith("image/"): return None
+    path = thumb_path(att['sha256'])
+    if os.path.exists(path): return path
     try:
-        return json.loads(row[0]) if row and row[0] else None
+        with Image.open(blob_path(att['sha256'])) as img:
+            img.thumbnail(THUMB_SIZE)
+            if img.mode not in ("RGB", "RGBA"): img = img.convert("RGBA")
+            buf = io.BytesIO()
+            img.save(buf, format="PNG")
+        write_file_atomic(path, buf.getvalue())
+        return path
     except: return None
 
-def get_config(key):
-    row = run_query("SELECT value FROM config WHERE key=?", (key,), fetch_mode="one")
-    if not row and key == 'scorecard': return DEFAULT_SCORECARD
-    try:
-        return json.loads(row[0]) if row else []
-    except: return []
+def parse_attachment_ref(text):
+    if not text.startswith(ATTACHMENT_PREFIX): return None
+    try: return int(text[len(ATTACHMENT_PREFIX):])
+    except ValueError: return None
 
-def update_config(key, val):
-    run_query("REPLACE INTO config (key, value) VALUES (?, ?)", (key, json.dumps(val)), fetch_mode="commit")
+def format_message_text(text):
+    """Transcript-friendly text: attachment references become their file name."""
+    aid = parse_attachment_ref(text)
+    if aid is None: return text
+    att = get_attachment(aid)
+    if not att: return "[ATTACHMENT: missing]"
+    return f"[ATTACHMENT: {att['filename']} ({att['size'] // 1024 or 1} KB)]"
 
-def get_ip():
-    try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-        except:
-            ip = "127.0.0.1"
-        s.close()
-        return ip
-    except: return "127.0.0.1"
+# --- RETENTION (BATCHED PURGE) ---
+def retention_policy_error(policy):
+    """Problem with one policy as text, or None if it is usable."""
+    if not isinstance(policy, dict): return "not an object"
+    try: days = float(policy.get('older_than_days'))
+    except (TypeError, ValueError): return "older_than_days must be a number"
+    if days <= 0: return "older_than_days must be > 0"
+    if not isinstance(policy.get('statuses', []), list): return "statuses must be a list"
+    if policy.get('graded') not in (None, True, False): return "graded must be true, false or null"
+    return None
 
-def check_room_status(rid):
-    conn = None
-    try:
-        conn = get_db_connection()
-        row = conn.execute("SELECT status, last_activity, agent FROM rooms WHERE id = ?", (rid,)).fetchone()
-        if not row: return "Unknown", 0, False
-            
-        status, last_act_str, agent_name = row
-        
-        if agent_name == 'Waiting...': return status, 0, False
+def retention_where(policy, now):
+    """WHERE clause + params for the rooms one policy purges. Age is time since last activity."""
+    clauses = ["COALESCE(last_activity_ms, created_at_ms, 0) < ?"]
+    params = [now - int(float(policy['older_than_days']) * 86400000)]
+    statuses = policy.get('statuses') or []
+    if statuses:
+        clauses.append(f"status IN ({', '.join('?' * len(statuses))})")
+        params += statuses
+    if policy.get('graded') is not None:
+        clauses.append(f"graded_at_ms IS {'NOT ' if policy['graded'] else ''}NULL")
+    return " AND ".join(clauses), params
+
+class RetentionManager:
+    """Purges the rooms matched by the retention policies (status, age, graded or not) and
+    everything hanging off them: messages, attachment rows and then blobs nobody references,
+    routing, and tombstones past TOMBSTONE_TTL_MS. Messages are deleted in transactions of
+    `batch` rows that adapt towards RETENTION_MAX_LOCK_MS, with a pause in between, so a
+    send_msg never queues behind more than one short batch. Freed pages go back to the OS via
+    incremental_vacuum where the file was created with auto_vacuum=INCREMENTAL."""
+    def __init__(self, interval=RETENTION_INTERVAL_S):
+        self.lock = threading.Lock() # One policy run at a time
+        self.batch = RETENTION_BATCH_ROWS
+        self.max_batch_ms = 0.0      # Longest batch of the current run
+        self.timing = QueryStats()   # Per-batch lock time + whole runs
+        self.stats = {'runs': 0, 'batches': 0, 'rooms': 0, 'messages': 0, 'attachments': 0, 'blobs': 0,
+                      'tombstones': 0, 'pages_freed': 0}
+        self.last = None
+        self.error = None
+        if interval > 0:
+            threading.Thread(target=self._schedule, args=(interval,), name="lenovo-retention", daemon=True).start()
+
+    def _schedule(self, interval):
+        while True:
+            time.sleep(interval)
+            try: self.run()
+            except Exception as e: self.error = str(e)
 
-        msg_row = conn.execute("SELECT role FROM messages WHERE room_id = ? ORDER BY id DESC LIMIT 1", (rid,)).fetchone()
-        last_role = msg_row[0] if msg_row else None
-        is_agent_turn = (last_role != 'Agent') # True if last msg was NOT Agent
+    def candidates(self, policies, now=None):
+        """{shard: [room ids]} matched by any valid policy. Rooms with someone present are kept."""
+        now = now or now_ms()
+        policies = [p for p in policies if not retention_policy_error(p)]
+        presence = get_presence()
+        out = {}
+        for shard in range(SHARD_COUNT):
+            conn = None
+            rids = set()
+            try:
+                conn = connect_db(get_shard_file(shard))
+                for p in policies:
+                    where, params = retention_where(p, now)
+                    rids.update(r[0] for r in conn.execute(f"SELECT id FROM rooms WHERE {where}", params))
+            finally:
+                if conn: conn.close()
+            rids = sorted(rid for rid in rids if not presence.room(rid))
+            if rids: out[shard] = rids
+        return out
 
-        if not last_act_str: return status, 0, is_agent_turn
+    def preview(self, policies=None):
+        """Dry run: how many rooms and messages a run would purge right now."""
+        found = self.candidates(get_config('retention') if policies is None else policies)
+        messages = 0
+        for shard, rids in found.items():
+            conn = None
+            try:
+                conn = connect_db(get_shard_file(shard))
+                for i in range(0, len(rids), RETENTION_ROOMS_PER_BATCH):
+                    chunk = rids[i:i + RETENTION_ROOMS_PER_BATCH]
+                    messages += conn.execute(f"SELECT COUNT(*) FROM messages WHERE room_id IN ({', '.join('?' * len(chunk))})", chunk).fetchone()[0]
+            finally:
+                if conn: conn.close()
+        return {'rooms': sum(len(r) for r in found.values()), 'messages': messages}
 
-        try: last_act = pd.to_datetime(last_act_str).to_pydatetime()
-        except: last_act = datetime.datetime.now()
+    def run(self, policies=None):
+        """Scheduled or manual purge; the report is also kept in self.last."""
+        with self.lock:
+            t0 = time.perf_counter()
+            self.max_batch_ms = 0.0
+            report = self.purge_rooms(self.candidates(get_config('retention') if policies is None else policies))
+            report['tombstones'] = self.purge_tombstones()
+            report['pages_freed'], report['free_pages'], report['page_size'] = self.vacuum()
+            ms = (time.perf_counter() - t0) * 1000
+            self.timing.record('run', ms)
+            report.update(duration_ms=round(ms, 1), finished_at_ms=now_ms(), max_batch_ms=round(self.max_batch_ms, 1))
+            self.stats['runs'] += 1
+            self.stats['tombstones'] += report['tombstones']
+            self.stats['pages_freed'] += report['pages_freed']
+            self.error = None
+            self.last = report
+            return report
 
-        diff = (datetime.datetime.now() - last_act).total_seconds()
+    def _delete(self, conn, sql, params):
+        """One short write transaction. Halves the batch when it held the lock too long."""
+        t0 = time.perf_counter()
+        n = conn.execute(sql, params).rowcount
+        conn.commit()
+        ms = (time.perf_counter() - t0) * 1000
+        self.timing.record('batch', ms)
+        self.stats['batches'] += 1
+        self.max_batch_ms = max(self.max_batch_ms, ms)
+        if ms > RETENTION_MAX_LOCK_MS: self.batch = max(50, self.batch // 2)
+        elif ms < RETENTION_MAX_LOCK_MS / 4: self.batch = min(RETENTION_BATCH_ROWS * 4, self.batch * 2)
+        return n
 
-        if status == 'Active' and is_agent_turn:
-            new_status = status
-            if diff > 600: new_status = 'Offline'
-            elif diff > 300: new_status = 'Expired'
-            
-            if new_status != status:
-                conn.execute("UPDATE rooms SET status = ? WHERE id = ?", (new_status, rid))
+    def purge_rooms(self, by_shard):
+        """Deletes rooms ({shard: [rid]}) with their messages and attachments."""
+        report = {'rooms': 0, 'messages': 0, 'attachments': 0, 'blobs': 0}
+        for shard, rids in by_shard.items():
+            conn = None
+            try:
+                conn = connect_db(get_shard_file(shard))
+                for i in range(0, len(rids), RETENTION_ROOMS_PER_BATCH):
+                    chunk = rids[i:i + RETENTION_ROOMS_PER_BATCH]
+                    qs = ', '.join('?' * len(chunk))
+                    # Messages first: a run cut short leaves whole rooms, never orphaned messages
+                    while True:
+                        limit = self.batch
+                        n = self._delete(conn, f"DELETE FROM messages WHERE id IN (SELECT id FROM messages WHERE room_id IN ({qs}) LIMIT ?)", (*chunk, limit))
+                        report['messages'] += n
+                        if n < limit: break
+                        time.sleep(RETENTION_PAUSE_S * (10 if get_rate_limiter().backpressure() else 1)) # Live sends first
+                    # Room rows, plus anything that raced in after the last batch
+                    report['messages'] += conn.execute(f"DELETE FROM messages WHERE room_id IN ({qs})", chunk).rowcount
+                    report['rooms'] += self._delete(conn, f"DELETE FROM rooms WHERE id IN ({qs})", chunk)
+                    self._forget(chunk, report)
+                    time.sleep(RETENTION_PAUSE_S)
+            finally:
+                if conn: conn.close()
+        for k in ('rooms', 'messages', 'attachments', 'blobs'): self.stats[k] += report[k]
+        return report
+
+    def _forget(self, rids, report):
+        """Catalog side of a purged batch: attachments, tombstones, routing, caches."""
+        qs = ', '.join('?' * len(rids))
+        conn = None
+        try:
+            conn = get_db_connection()
+            shas = [r[0] for r in conn.execute(f"SELECT DISTINCT sha256 FROM attachments WHERE room_id IN ({qs})", rids)]
+            report['attachments'] += conn.execute(f"DELETE FROM attachments WHERE room_id IN ({qs})", rids).rowcount
+            conn.executemany("REPLACE INTO room_deletions (room_id, deleted_at_ms) VALUES (?, ?)", [(rid, now_ms()) for rid in rids])
+            if SHARD_COUNT > 1: conn.execute(f"DELETE FROM room_shards WHERE room_id IN ({qs})", rids)
+            conn.commit()
+            if shas:
+                # Content-addressed: a blob goes only when no other upload shares its bytes. The
+                # re-check and the removes hold the catalog write lock, so an upload's row (written
+                # before its blob) lands either first and keeps the file, or after and rewrites it
+                conn.execute("BEGIN IMMEDIATE")
+                shared = {r[0] for r in conn.execute(f"SELECT DISTINCT sha256 FROM attachments WHERE sha256 IN ({', '.join('?' * len(shas))})", shas)}
+                for sha in shas:
+                    if sha in shared: continue
+                    for path in (blob_path(sha), thumb_path(sha)):
+                        try: os.remove(path)
+                        except OSError: pass
+                    report['blobs'] += 1
                 conn.commit()
-            return new_status, diff, is_agent_turn
-            
-        return status, diff, is_agent_turn
-    except:
-        return "Error", 0, False
-    finally:
-        if conn: conn.close()
+        finally:
+            if conn: conn.close()
+
+        hub, routes = get_room_hub(), get_shard_routes()
+        for rid in rids:
+            hub.evict(rid)
+            hub.drop_alerts(rid)
+            routes.pop(rid, None)
+            publish_room_event(rid, 'status', status='Deleted')
+        get_room_index().touch()
+
+    def purge_tombstones(self):
+        conn = None
+        try:
+            conn = get_db_connection()
+            n = conn.execute("DELETE FROM room_deletions WHERE deleted_at_ms < ?", (now_ms() - TOMBSTONE_TTL_MS,)).rowcount
+            conn.commit()
+            return n
+        finally:
+            if conn: conn.close()
+
+    def vacuum(self):
+        """incremental_vacuum in small steps on every shard: (pages freed, pages still free,
+        page size). Files from before auto_vacuum=INCREMENTAL keep free pages for reuse."""
+        freed = left = 0
+        page_size = 4096
+        for shard in range(SHARD_COUNT):
+            conn = None
+            try:
+                conn = connect_db(get_shard_file(shard))
+                page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+                free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                    while free:
+                        t0 = time.perf_counter()
+                        # executescript steps the pragma to completion; execute() frees a single page
+                        conn.executescript(f"PRAGMA incremental_vacuum({RETENTION_VACUUM_PAGES});")
+                        self.timing.record('vacuum', (time.perf_counter() - t0) * 1000)
+                        after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+                        if after >= free: break
+                        freed += free - after
+                        free = after
+                        time.sleep(RETENTION_PAUSE_S)
+                left += free
+            finally:
+                if conn: conn.close()
+        return freed, left, page_size
+
+@st.cache_resource
+def get_retention():
+    return RetentionManager(RETENTION_INTERVAL_S if WORKER_ID == 0 else 0) # One scheduled purger per box
+
+def retention_caption(ret):
+    last = ret.last
+    if not last: return "RETENTION: NO RUN YET" + (f" (LAST ERROR: {ret.error})" if ret.error else "")
+    return (f"LAST PURGE {format_ts(last['finished_at_ms'], '%m-%d %H:%M')}: {last['rooms']} ROOMS · {last['messages']} MSGS · "
+            f"{last['attachments']} FILES ({last['blobs']} BLOBS) · {last['pages_freed'] * last['page_size'] / 1e6:.1f} MB RECLAIMED · "
+            f"{last['duration_ms']:.0f} MS (BATCH MAX {last['max_batch_ms']:.0f} MS)")
 
 # --- SENTIMENT ENGINE ---
 def calculate_sentiment(text):
@@ -639,6 +3106,7 @@ def analyze_conversation_sentiment(msgs):
     return int(total_score / len(recent_msgs))
 
 # --- PDF GENERATION ---
+@profiled("pdf build")
 def generate_pdf_report(rid, msgs, score, breakdown, crit, scenario):
     if not HAS_FPDF:
         return None
@@ -663,9 +3131,9 @@ def generate_pdf_report(rid, msgs, score, breakdown, crit, scenario):
     pdf.cell(0, 10, f"Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", 0, 1)
     
     if scenario:
-        pdf.cell(0, 10, f"Scenario: {scenario.get('name', 'N/A')} - {scenario.get('product', 'N/A')}", 0, 1)
+        pdf.cell(0, 10, f"Scenario: {scenario.get('name') or 'N/A'} - {scenario.get('product') or 'N/A'}", 0, 1)
         pdf.set_font("Arial", 'I', 10)
-        pdf.multi_cell(0, 5, f"Issue: {scenario.get('issue', 'N/A')}")
+        pdf.multi_cell(0, 5, f"Issue: {scenario.get('issue') or 'N/A'}")
         pdf.ln(5)
 
     # 2. Score
@@ -676,7 +3144,7 @@ def generate_pdf_report(rid, msgs, score, breakdown, crit, scenario):
         pdf.set_font("Arial", size=10)
         pdf.cell(0, 10, f"Reason: {crit}", 0, 1)
     else:
-        color = (0, 200, 0) if score >= 85 else (200, 0, 0)
+        color = (0, 200, 0) if score >= PASS_SCORE else (200, 0, 0)
         pdf.set_text_color(*color)
         pdf.cell(0, 10, f"FINAL SCORE: {score}%", 0, 1)
     
@@ -700,14 +3168,81 @@ def generate_pdf_report(rid, msgs, score, breakdown, crit, scenario):
     for _, m in msgs.iterrows():
         prefix = "AGENT: " if m['role'] == 'Agent' else f"{m['sender'].upper()}: "
         # Clean text
-        clean_text = m['text'].encode('latin-1', 'replace').decode('latin-1')
-        pdf.multi_cell(0, 5, f"[{m['timestamp']}] {prefix}{clean_text}")
+        clean_text = format_message_text(m['text']).encode('latin-1', 'replace').decode('latin-1')
+        pdf.multi_cell(0, 5, f"[{format_ts(m['timestamp_ms'])}] {prefix}{clean_text}")
         pdf.ln(1)
         
     return pdf.output(dest='S').encode('latin-1')
 
 
 # --- GRADING ENGINE ---
+def critical_phrases(agent_msgs, agent_text):
+    """Critical phrases in the Agent messages: their stored flags, plus one scan over the rows
+    without any (written before flags existed, or transcripts that never went through send_msg)."""
+    if 'flags' not in agent_msgs.columns: return set(scan_text(agent_text).split("|")) - {""}
+    stored = agent_msgs['flags']
+    found = {p for f in stored.dropna() if f for p in f.split("|")}
+    todo = agent_msgs.loc[stored.isna(), 'text']
+    if len(todo): found.update(scan_text(" ".join(todo.astype(str).str.lower().tolist())).split("|"))
+    return found - {""}
+
+def item_rule(item):
+    return item['rule'] if 'rule' in item else default_rule(item)
+
+def compile_pattern(phrases, regexes=()):
+    """Phrases (literal) and regexes folded into ONE case-insensitive alternation."""
+    alts = [re.escape(p.lower()) for p in phrases if p] + [r for r in regexes if r]
+    return re.compile("|".join(f"(?:{a})" for a in alts), re.IGNORECASE) if alts else None
+
+def compile_rule(rule):
+    return {'pos': compile_pattern(rule.get('phrases', []), rule.get('regex', [])),
+            'neg': compile_pattern(rule.get('negative', [])),
+            'roles': tuple(sorted(rule.get('roles') or ['Agent'])),
+            'min_count': max(1, int(rule.get('min_count', 1)))}
+
+def rule_error(rule):
+    """Validation for the CONFIG tab. None if every rule compiles."""
+    try:
+        for r in (rule if isinstance(rule, list) else [rule]): compile_rule(r)
+    except re.error as e: return f"bad regex: {e}"
+    except (TypeError, ValueError, AttributeError) as e: return f"bad rule: {e}"
+    return None
+
+def scorecard_version(sc):
+    meta = get_config_meta('scorecard')
+    if sc is meta['value']: return meta['hash'] # Cached scorecard: hashed once per version
+    return derive_config('scorecard', sc)['hash']
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def compile_scorecard(version, _sc):
+    """Keyed by the scorecard version hash: an edit compiles once, old versions age out.
+    Holds copies only, so later edits to the caller's dicts can't leak in."""
+    compiled = []
+    for item in _sc:
+        rule = item_rule(item)
+        rules = rule if isinstance(rule, list) else [rule]
+        entry = {'name': item['name'], 'rules': [], 'error': rule_error(rule),
+                 'hint': list(next((r['phrases'] for r in rules if r.get('phrases')), KEYWORDS.get(item.get('id'), ['...'])))}
+        if not entry['error']: entry['rules'] = [compile_rule(r) for r in rules]
+        compiled.append(entry)
+    return compiled
+
+def role_text(msgs, roles, texts):
+    """Lower-cased transcript of the given roles, built once per grading call."""
+    if roles not in texts:
+        texts[roles] = " ".join(msgs[msgs['role'].isin(roles)]['text'].astype(str).str.lower().tolist())
+    return texts[roles]
+
+def rule_passes(r, text):
+    if r['neg'] and r['neg'].search(text): return False
+    if r['pos'] is None: return True # Subjective item
+    if r['min_count'] == 1: return r['pos'].search(text) is not None
+    hits = 0
+    for _ in r['pos'].finditer(text):
+        hits += 1
+        if hits >= r['min_count']: return True
+    return False
+
 def auto_grade_chat(msgs, sc):
     """Initial Auto-Grading using Keywords/Regex"""
     if msgs.empty: return {}, None, []
@@ -724,44 +3259,23 @@ def auto_grade_chat(msgs, sc):
     crit = None
     tips = []
 
-    # 1. Criticals
-    for kw_list in [KEYWORDS['cxCritical'], KEYWORDS['compCritical']]:
-        for w in kw_list:
-            if w in agent_text:
-                crit = f"Critical Fail: Found '{w}'"
-                break
-        if crit: break
+    # 1. Criticals: flagged when each message was written, scanned now only where missing
+    found = critical_phrases(agent_msgs, agent_text)
+    w = next((p for p in compliance_phrases() if p in found), None)
+    if w: crit = f"Critical Fail: Found '{w}'"
     
     if not crit:
-        # 2. Scorecard Logic with Regex & Keywords
-        for item in sc:
-            passed = False
-            cid = item['id']
-            
-            # Smart Logic
-            if cid == 'greet':
-                if re.search(INTENT_REGEX['greeting'], agent_text): passed = True
-            elif cid == 'discovery':
-                if re.search(INTENT_REGEX['question'], agent_text) or len(re.findall(r'\?', agent_text)) >= 2: passed = True
-            elif cid == 'warranty':
-                if re.search(INTENT_REGEX['warranty'], agent_text): passed = True
-            elif cid == 'empathy':
-                if re.search(INTENT_REGEX['empathy'], agent_text): passed = True
-            elif cid == 'end_prof':
-                if re.search(INTENT_REGEX['closing'], agent_text): passed = True
-            elif cid == 'product':
-                if any(p in agent_text for p in KEYWORDS['products']): passed = True
-            elif cid == 'objection':
-                if any(o in agent_text for o in KEYWORDS['objection']): passed = True
-            else:
-                kw_key = item.get('keywords', '')
-                kws = KEYWORDS.get(kw_key, [])
-                if kws and any(k in agent_text for k in kws): passed = True
-                elif not kws: passed = True # Default pass for subjective
+        # 2. Scorecard rules, compiled once per scorecard version
+        texts = {('Agent',): agent_text}
+        for item in compile_scorecard(scorecard_version(sc), sc):
+            passed = not item['error'] and any(
+                rule_passes(r, role_text(msgs, r['roles'], texts)) for r in item['rules'])
             
             breakdown[item['name']] = "PASS" if passed else "FAIL"
-            if not passed:
-                 tips.append(f"{item['name']}: Try using words like {', '.join(KEYWORDS.get(cid, ['...'])[:3])}")
+            if item['error']:
+                 tips.append(f"{item['name']}: Rule error ({item['error']})")
+            elif not passed:
+                 tips.append(f"{item['name']}: Try using words like {', '.join(item['hint'][:3])}")
 
     return breakdown, crit, tips
 
@@ -770,15 +3284,15 @@ def calculate_final_score(breakdown, crit, sc):
     if crit: return 0
     if not breakdown: return 0
     
-    score = 0
-    max_score = 0
-    
-    for item in sc:
-        w = float(item['weight'])
-        max_score += w
-        if breakdown.get(item['name']) == "PASS":
-            score += w
-            
+    meta = get_config_meta('scorecard')
+    if sc is not meta['value']: meta = derive_config('scorecard', sc)
+    score = passed_weight(breakdown, meta['weights'])
+    return score_percent(score, meta['total_weight'])
+
+def passed_weight(breakdown, weights):
+    return sum(weights.get(name, 0.0) for name, v in breakdown.items() if v == "PASS")
+
+def score_percent(score, max_score):
     return int((score / max_score) * 100) if max_score > 0 else 0
 
 def generate_export_text(rid, msgs, score, breakdown, crit, scenario):
@@ -794,7 +3308,7 @@ def generate_export_text(rid, msgs, score, breakdown, crit, scenario):
     if crit: lines.append(f"CRITICAL FAIL: {crit}")
     lines.append("\n--- CHAT TRANSCRIPT ---")
     for _, m in msgs.iterrows():
-        lines.append(f"[{m['timestamp']}] {m['sender']} ({m['role']}): {m['text']}")
+        lines.append(f"[{format_ts(m['timestamp_ms'])}] {m['sender']} ({m['role']}): {format_message_text(m['text'])}")
     
     lines.append("\n--- GRADING BREAKDOWN ---")
     for k, v in breakdown.items():
@@ -802,42 +3316,620 @@ def generate_export_text(rid, msgs, score, breakdown, crit, scenario):
         
     return "\n".join(lines)
 
+# --- CORPUS ANALYTICS (VECTORIZED) ---
+def sentiment_terms():
+    """calculate_sentiment as a weight vector over phrase terms."""
+    weights = {}
+    for polarity, sign in (('negative', -1), ('positive', 1)):
+        for level, pts in (('high', 15), ('medium', 5)):
+            for w in SENTIMENT_DICT[polarity][level]:
+                weights['p:' + w] = weights.get('p:' + w, 0) + sign * pts
+    return list(weights), list(weights.values())
+
+def analytics_terms(compiled):
+    """Every column the corpus report reads. 'p:<phrase>' = phrase occurs in the message (the
+    substring test calculate_sentiment and the criticals use); 'r:<regex>' = matches of a
+    compiled rule pattern."""
+    terms = dict.fromkeys('p:' + w.lower() for words in KEYWORDS.values() for w in words)
+    terms.update(dict.fromkeys(sentiment_terms()[0]))
+    for item in compiled:
+        for r in item['rules']:
+            for pat in (r['pos'], r['neg']):
+                if pat: terms['r:' + pat.pattern] = None
+    return list(terms)
+
+@functools.lru_cache(maxsize=8)
+def phrase_scanner(phrases):
+    """Lookahead regex shaped like a trie of `phrases`: at every position it reports the
+    longest phrase starting there, visiting each character once per branch instead of once
+    per phrase. prefixes[i] lists phrase i and the phrases that are prefixes of it (-1 padded),
+    which start at the same position and so are matched too: together that is exactly
+    `phrase in text` for every phrase."""
+    trie = {}
+    for p in phrases:
+        node = trie
+        for ch in p: node = node.setdefault(ch, {})
+        node[''] = {}
+    def branch(node):
+        alts = [re.escape(ch) + branch(child) for ch, child in sorted(node.items()) if ch]
+        body = "" if not alts else alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return f"(?:{body})?" if '' in node and body else body
+    index = {p: i for i, p in enumerate(phrases)}
+    covered = [[index[q] for q in phrases if p.startswith(q)] for p in phrases]
+    prefixes = np.full((len(phrases), max(map(len, covered))), -1, np.int64)
+    for i, c in enumerate(covered): prefixes[i, :len(c)] = c
+    return re.compile("(?=(" + branch(trie) + "))"), prefixes
+
+class TermMatrix:
+    """Sparse term-by-message matrix over the whole corpus, column-compressed (per term: row
+    indices + counts) and cached on disk at ANALYTICS_CACHE. update() reads only messages
+    newer than the watermark, tokenizes only terms it does not hold yet, and drops the rows
+    of deleted rooms, so a refresh costs roughly the new traffic, not the corpus."""
+    FORMAT = 1
+
+    def __init__(self, path=ANALYTICS_CACHE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.room_id, self.msg_id, self.ts = (np.zeros(0, np.int64) for _ in range(3))
+        self.role = np.zeros(0, np.int8) # Index into RULE_ROLES, len(RULE_ROLES) = other
+        self.cols = {} # term -> (rows int32, counts int32)
+        self.wm = 0
+        self.stats = {'rows_read': 0, 'last_read': 0, 'rows_dropped': 0, 'terms_tokenized': 0, 'update_ms': 0.0}
+        self._load()
+
+    @property
+    def n(self):
+        return len(self.msg_id)
+
+    def _load(self):
+        try:
+            with np.load(self.path, allow_pickle=False) as z:
+                if int(z['format']) != self.FORMAT: return
+                terms, indptr, indices, data = json.loads(str(z['terms'])), z['indptr'], z['indices'], z['data']
+                self.room_id, self.msg_id, self.ts, self.role, self.wm = z['room_id'], z['msg_id'], z['ts'], z['role'], int(z['wm'])
+            self.cols = {t: (indices[indptr[i]:indptr[i + 1]], data[indptr[i]:indptr[i + 1]]) for i, t in enumerate(terms)}
+        except: pass # Missing or unreadable cache: next update rebuilds it
+
+    def save(self):
+        terms = list(self.cols)
+        indptr = np.concatenate([[0], np.cumsum([len(self.cols[t][0]) for t in terms], dtype=np.int64)])
+        empty = np.zeros(0, np.int32)
+        tmp = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp, format=self.FORMAT, terms=json.dumps(terms), indptr=indptr,
+                 indices=np.concatenate([self.cols[t][0] for t in terms] or [empty]),
+                 data=np.concatenate([self.cols[t][1] for t in terms] or [empty]),
+                 room_id=self.room_id, msg_id=self.msg_id, ts=self.ts, role=self.role, wm=self.wm)
+        os.replace(tmp, self.path)
+
+    @staticmethod
+    def tokenize(texts, terms):
+        """{term: (rows, counts)} over a Series of lower-cased texts. All phrase terms come out
+        of ONE scan (see phrase_scanner); rule regexes are counted one by one."""
+        out = {}
+        phrases = sorted({t[2:] for t in terms if t.startswith('p:')})
+        if phrases:
+            pat, prefixes = phrase_scanner(tuple(phrases))
+            index = {p: i for i, p in enumerate(phrases)}
+            found = list(map(pat.findall, texts))
+            lens = np.fromiter(map(len, found), np.int64, len(found))
+            codes = np.fromiter((index[h] for f in found for h in f), np.int64, int(lens.sum()))
+            # Longest phrase at each position -> it and every phrase that is a prefix of it
+            exp = prefixes[codes]
+            keep = exp >= 0
+            key = np.repeat(np.repeat(np.arange(len(found)), lens), prefixes.shape[1])[keep.ravel()] * len(phrases) + exp[keep]
+            key, counts = np.unique(key, return_counts=True)
+            rows, cols = key // len(phrases), key % len(phrases)
+            order = np.lexsort((rows, cols))
+            bounds = np.searchsorted(cols[order], np.arange(len(phrases) + 1))
+            for i, p in enumerate(phrases):
+                sel = order[bounds[i]:bounds[i + 1]]
+                out['p:' + p] = (rows[sel].astype(np.int32), counts[sel].astype(np.int32))
+        for t in terms:
+            if t.startswith('r:'):
+                counts = texts.str.count(re.compile(t[2:], re.IGNORECASE)).to_numpy(np.int32) if len(texts) else np.zeros(0, np.int32)
+                rows = np.flatnonzero(counts).astype(np.int32)
+                out[t] = (rows, counts[rows])
+        return out
+
+    def _keep(self, keep):
+        remap = (np.cumsum(keep) - 1).astype(np.int32)
+        for t, (rows, counts) in self.cols.items():
+            m = keep[rows]
+            self.cols[t] = (remap[rows[m]], counts[m])
+        self.stats['rows_dropped'] += int((~keep).sum())
+        self.room_id, self.msg_id, self.ts, self.role = self.room_id[keep], self.msg_id[keep], self.ts[keep], self.role[keep]
+
+    def update(self, conn, terms):
+        t0 = time.perf_counter()
+        # 1. Rows of rooms that no longer exist (clear chat deletes room + messages)
+        live = pd.read_sql_query("SELECT id FROM all_rooms", conn)['id'].to_numpy(np.int64)
+        keep = np.isin(self.room_id, live)
+        if not keep.all(): self._keep(keep)
+        self.cols = {t: self.cols[t] for t in terms if t in self.cols} # Old scorecard versions' regexes
+
+        # 2. Messages past the watermark (minus slack), skipping ones already held
+        since = self.wm - ANALYTICS_SLACK_MS
+        new = pd.read_sql_query(f"""
+            SELECT room_id, id, role, COALESCE(timestamp_ms, 0) AS ts, text FROM all_messages
+            {"WHERE timestamp_ms > ?" if self.n else ""}
+        """, conn, params=(since,) if self.n else ())
+        if self.n and not new.empty:
+            recent = self.ts > since
+            held = pd.MultiIndex.from_arrays([self.room_id[recent], self.msg_id[recent]])
+            new = new[~pd.MultiIndex.from_arrays([new['room_id'], new['id']]).isin(held)]
+        new = new[new['room_id'].isin(live)]
+        self.stats['rows_read'] += len(new)
+        self.stats['last_read'] = len(new)
+
+        base = self.n
+        texts = new['text'].fillna("").astype(str).str.lower().reset_index(drop=True)
+        roles = new['role'].map({r: i for i, r in enumerate(RULE_ROLES)}).fillna(len(RULE_ROLES)).to_numpy(np.int8)
+        self.room_id = np.concatenate([self.room_id, new['room_id'].to_numpy(np.int64)])
+        self.msg_id = np.concatenate([self.msg_id, new['id'].to_numpy(np.int64)])
+        self.ts = np.concatenate([self.ts, new['ts'].to_numpy(np.int64)])
+        self.role = np.concatenate([self.role, roles])
+        if len(new): self.wm = max(self.wm, int(new['ts'].max()))
+
+        # 3. New rows: every term. Terms not held yet also need the older rows, read once
+        missing = [t for t in terms if t not in self.cols]
+        older = {}
+        if missing and base:
+            full = pd.read_sql_query("SELECT room_id, id, text FROM all_messages", conn)
+            at = pd.MultiIndex.from_arrays([full['room_id'], full['id']]).get_indexer(pd.MultiIndex.from_arrays([self.room_id[:base], self.msg_id[:base]]))
+            older = self.tokenize(pd.Series(np.where(at >= 0, full['text'].fillna("").astype(str).str.lower().to_numpy()[at], "")), missing)
+        self.stats['terms_tokenized'] += len(missing)
+        added = self.tokenize(texts, terms)
+        empty = (np.zeros(0, np.int32), np.zeros(0, np.int32))
+        for t in terms:
+            rows, counts = self.cols.get(t) or older.get(t, empty)
+            self.cols[t] = (np.concatenate([rows, added[t][0] + base]).astype(np.int32), np.concatenate([counts, added[t][1]]).astype(np.int32))
+        self.stats['update_ms'] = (time.perf_counter() - t0) * 1000
+
+    def matrix(self, terms, presence=False):
+        """rows x terms sparse matrix (SciPy only); presence=True turns counts into 0/1."""
+        rows = [self.cols[t][0] for t in terms]
+        indptr = np.concatenate([[0], np.cumsum([len(r) for r in rows])])
+        data = np.concatenate([self.cols[t][1] for t in terms] or [np.zeros(0, np.int32)]).astype(np.float64)
+        if presence: data[:] = 1.0
+        return sp.csc_matrix((data, np.concatenate(rows or [np.zeros(0, np.int32)]), indptr), shape=(self.n, len(terms)))
+
+    def row_dot(self, terms, weights, presence=False):
+        """X·w: per-message weighted sum of the given terms."""
+        if HAS_SCIPY: return self.matrix(terms, presence) @ np.asarray(weights, np.float64)
+        out = np.zeros(self.n)
+        for t, w in zip(terms, weights):
+            rows, counts = self.cols[t]
+            out[rows] += w if presence else w * counts # Rows are unique within a column
+        return out
+
+    def room_sums(self, terms, row_mask, room_index, n_rooms):
+        """rooms x terms: each term's count summed over the masked rows of every room."""
+        if HAS_SCIPY:
+            pick = np.flatnonzero(row_mask)
+            R = sp.csr_matrix((np.ones(len(pick)), (room_index[pick], pick)), shape=(n_rooms, self.n))
+            return (R @ self.matrix(terms)).toarray()
+        out = np.zeros((n_rooms, len(terms)))
+        for j, t in enumerate(terms):
+            rows, counts = self.cols[t]
+            m = row_mask[rows]
+            out[:, j] = np.bincount(room_index[rows[m]], weights=counts[m], minlength=n_rooms)
+        return out
+
+@st.cache_resource
+def get_term_matrix():
+    return TermMatrix()
+
+def corpus_report(tm, sc):
+    """auto_grade_chat, calculate_final_score and analyze_conversation_sentiment for every
+    room at once, plus how each KEYWORDS / SENTIMENT_DICT phrase relates to passing.
+    Terms are matched per message, so a phrase split across two messages is not counted."""
+    if not tm.n: return None
+    rooms, room_index = np.unique(tm.room_id, return_inverse=True)
+    n_rooms = len(rooms)
+    agent = tm.role == RULE_ROLES.index('Agent')
+    has_agent = np.bincount(room_index[agent], minlength=n_rooms) > 0
+
+    # Mood: mean sentiment of each room's last 5 non-agent messages (50 if none)
+    s_terms, s_weights = sentiment_terms()
+    msg_sent = np.clip(50 + tm.row_dot(s_terms, s_weights, presence=True), 0, 100)
+    order = np.lexsort((tm.msg_id, room_index))
+    cust = order[~agent[order]]
+    last5 = cust[pd.Series(room_index[cust]).groupby(room_index[cust]).cumcount(ascending=False).to_numpy() < 5]
+    n5 = np.bincount(room_index[last5], minlength=n_rooms)
+    mood = np.where(n5 > 0, (np.bincount(room_index[last5], weights=msg_sent[last5], minlength=n_rooms) / np.maximum(n5, 1)).astype(int), 50)
+
+    # Criticals zero the score and skip the breakdown, as in auto_grade_chat
+    crit_terms = list(dict.fromkeys('p:' + w for w in KEYWORDS['cxCritical'] + KEYWORDS['compCritical']))
+    crit = has_agent & (tm.room_sums(crit_terms, agent, room_index, n_rooms) > 0).any(axis=1)
+
+    compiled = compile_scorecard(scorecard_version(sc), sc)
+    masks, passed = {}, {}
+    for item in compiled:
+        ok = np.zeros(n_rooms, bool)
+        for r in item['rules']:
+            if r['roles'] not in masks: masks[r['roles']] = np.isin(tm.role, [RULE_ROLES.index(x) for x in r['roles'] if x in RULE_ROLES])
+            mask, hit = masks[r['roles']], np.ones(n_rooms, bool)
+            if r['neg']: hit &= tm.room_sums(['r:' + r['neg'].pattern], mask, room_index, n_rooms)[:, 0] == 0
+            if r['pos']: hit &= tm.room_sums(['r:' + r['pos'].pattern], mask, room_index, n_rooms)[:, 0] >= r['min_count']
+            ok |= hit
+        passed[item['name']] = ok & (item['error'] is None) # Duplicate names: last one wins, like the breakdown dict
+    meta = derive_config('scorecard', sc)
+    total = np.zeros(n_rooms)
+    for name, ok in passed.items(): total = total + ok * meta['weights'].get(name, 0.0)
+    score = np.where(crit, 0, ((total / meta['total_weight']) * 100).astype(int) if meta['total_weight'] > 0 else 0)
+    graded = has_agent
+    won = graded & (score >= PASS_SCORE)
+    n_graded, n_pass = int(graded.sum()), int(won.sum())
+
+    # Phrases vs passing: hit rate, pass rate with/without, phi correlation (graded rooms only)
+    phrase_rows = []
+    sides = [(f"KEYWORDS/{k}", 'AGENT', agent, v) for k, v in KEYWORDS.items()] + \
+            [(f"SENTIMENT/{pol}/{lvl}", 'CUSTOMER', ~agent, v) for pol, d in SENTIMENT_DICT.items() for lvl, v in d.items()]
+    for list_name, side, mask, words in sides:
+        terms = list(dict.fromkeys('p:' + w.lower() for w in words))
+        for i in range(0, len(terms), ANALYTICS_TERM_CHUNK):
+            chunk = terms[i:i + ANALYTICS_TERM_CHUNK]
+            present = (tm.room_sums(chunk, mask, room_index, n_rooms) > 0) & graded[:, None]
+            n_with = present.sum(axis=0)
+            pass_with = (present & won[:, None]).sum(axis=0)
+            n_without, pass_without = n_graded - n_with, n_pass - pass_with
+            with np.errstate(divide='ignore', invalid='ignore'):
+                phi = (n_graded * pass_with - n_with * n_pass) / np.sqrt(n_with * n_without * n_pass * (n_graded - n_pass))
+            for j, t in enumerate(chunk):
+                phrase_rows.append({'PHRASE': t[2:], 'LIST': list_name, 'SIDE': side,
+                                    'HIT %': round(100 * n_with[j] / n_graded, 1) if n_graded else 0.0,
+                                    'PASS % WITH': round(100 * pass_with[j] / n_with[j], 1) if n_with[j] else None,
+                                    'PASS % WITHOUT': round(100 * pass_without[j] / n_without[j], 1) if n_without[j] else None,
+                                    'CORR': round(float(phi[j]), 3) if np.isfinite(phi[j]) else None})
+    phrases = pd.DataFrame(phrase_rows).sort_values('CORR', ascending=False, na_position='last')
+    ok_rooms = graded & ~crit
+    criteria = pd.DataFrame([{'CRITERION': name, 'PASS %': round(100 * float((ok & ok_rooms).sum()) / max(1, int(ok_rooms.sum())), 1)}
+                             for name, ok in passed.items()])
+    rooms_df = pd.DataFrame({'room_id': rooms, 'graded': graded, 'score': score, 'critical': crit, 'mood': mood})
+    mood_corr = np.corrcoef(mood[graded], score[graded])[0, 1] if n_graded > 1 and score[graded].std() and mood[graded].std() else None
+    return {'rooms': rooms_df, 'criteria': criteria, 'phrases': phrases,
+            'summary': {'messages': tm.n, 'rooms': n_rooms, 'graded': n_graded, 'pass_rate': n_pass / n_graded if n_graded else 0.0,
+                        'critical_rate': float(crit.sum()) / n_graded if n_graded else 0.0, 'mean_mood': float(mood[graded].mean()) if n_graded else 50.0,
+                        'mood_score_corr': None if mood_corr is None else float(mood_corr)}}
+
+# --- COMPLIANCE SCANNER (WRITE PATH) ---
+@functools.lru_cache(maxsize=1) # Per message: a st.cache_resource lookup would cost more than the scan
+def compliance_phrases():
+    """Lower-cased, deduplicated, in report order. At a couple dozen phrases, str `in` per
+    phrase (~3 us per message) beats one pass of the phrase_scanner trie regex (~7 us)."""
+    return tuple(dict.fromkeys(w.lower() for name in COMPLIANCE_LISTS for w in KEYWORDS[name]))
+
+def scan_text(text):
+    """Critical phrases in already lower-cased text, '|'-joined in report order."""
+    return "|".join([p for p in compliance_phrases() if p in text])
+
+def scan_compliance(role, text):
+    """messages.flags for a new message: '' if clean or not from a scanned role."""
+    return scan_text(text.lower()) if role in COMPLIANCE_ROLES else ""
+
+def compliance_kind(phrase):
+    return "PCI" if phrase in KEYWORDS['compCritical'] else "CONDUCT"
+
+# --- BACKGROUND JOBS ---
+class JobPool:
+    """Small thread pool for manager work that used to block the script thread.
+    submit() returns a job id at once; a job whose key matches one still queued or running
+    is shared instead of run twice, and pure jobs may reuse a finished result with the same
+    key. Sessions poll get() and keep only the id."""
+    def __init__(self, workers=JOB_WORKERS, keep=JOB_KEEP):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="lenovo-job")
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict() # id -> job, oldest first
+        self.by_key = {}          # key -> id of the newest job with that key
+        self.seq = 0
+        self.timing = QueryStats() # Per-kind run-time histogram + failures, same shape as query stats
+        self.stats = {'submitted': 0, 'deduped': 0, 'reused': 0, 'done': 0, 'failed': 0}
+        self.wait_ms = 0.0
+
+    def submit(self, kind, key, fn, *args, reuse_done=True):
+        key = (kind,) + tuple(key)
+        with self.lock:
+            job = self.jobs.get(self.by_key.get(key))
+            if job and job['status'] in ('queued', 'running'):
+                self.stats['deduped'] += 1
+                return job['id']
+            if job and reuse_done and job['status'] == 'done':
+                self.stats['reused'] += 1
+                return job['id']
+            self.seq += 1
+            job = {'id': self.seq, 'kind': kind, 'key': key, 'status': 'queued', 'result': None, 'error': None,
+                   'submitted': time.perf_counter(), 'started': None, 'finished': None}
+            self.jobs[job['id']] = job
+            self.by_key[key] = job['id']
+            self.stats['submitted'] += 1
+            self._prune()
+        self.executor.submit(self._run, job, fn, args)
+        return job['id']
+
+    def _run(self, job, fn, args):
+        with self.lock:
+            job['status'] = 'running'
+            job['started'] = time.perf_counter()
+            self.wait_ms += (job['started'] - job['submitted']) * 1000
+        error = None
+        try: result = fn(*args)
+        except Exception as e: result, error = None, e
+        with self.lock:
+            job['finished'] = time.perf_counter()
+            job['result'] = result
+            job['error'] = str(error) if error else None
+            job['status'] = 'failed' if error else 'done'
+            self.stats[job['status']] += 1
+        self.timing.record(job['kind'], (job['finished'] - job['started']) * 1000, error)
+
+    def _prune(self):
+        # Oldest finished jobs go first; queued/running ones are never dropped
+        excess = len(self.jobs) - self.keep
+        for jid in list(self.jobs):
+            if excess <= 0: break
+            job = self.jobs[jid]
+            if job['status'] in ('done', 'failed'):
+                del self.jobs[jid]
+                if self.by_key.get(job['key']) == jid: del self.by_key[job['key']]
+                excess -= 1
+
+    def get(self, jid):
+        with self.lock:
+            job = self.jobs.get(jid)
+            return dict(job) if job else None
+
+    def depth(self):
+        with self.lock:
+            queued = sum(1 for j in self.jobs.values() if j['status'] == 'queued')
+            running = sum(1 for j in self.jobs.values() if j['status'] == 'running')
+        return queued, running
+
+@st.cache_resource
+def get_job_pool():
+    return JobPool()
+
+def last_msg_id(rid):
+    msgs = get_room_hub().get_msgs(rid, 1)
+    return msgs[-1]['id'] if msgs else 0
+
+def job_grade(rid, sc):
+    return auto_grade_chat(get_msgs(rid, limit=1000), sc)
+
+def job_report(rid, score, grading, crit):
+    msgs = get_msgs(rid, limit=1000)
+    scenario = get_room_details(rid)
+    if HAS_FPDF: return "pdf", generate_pdf_report(rid, msgs, score, grading, crit, scenario)
+    return "txt", generate_export_text(rid, msgs, score, grading, crit, scenario)
+
+def job_grade_sweep(host, sc):
+    """Auto-grade every room (of `host`, or all) from the snapshot: one scan, grouped per room.
+    Returns (csv_bytes, rooms_graded, snapshot_taken_at_ms)."""
+    snap = get_snapshot()
+    conn = None
+    try:
+        conn = snap.connect()
+        taken = (snap.meta or {}).get('taken_at_ms') # None = live fallback
+        df = pd.read_sql_query(f"""
+            SELECT m.room_id, r.host, r.agent, m.role, m.text, m.flags
+            FROM all_messages m JOIN all_rooms r ON r.id = m.room_id
+            {"WHERE r.host = ?" if host else ""}
+            ORDER BY m.room_id, m.id
+        """, conn, params=(host,) if host else ())
+    finally:
+        if conn: conn.close()
+    rows = []
+    for rid, msgs in df.groupby('room_id', sort=False):
+        breakdown, crit, _ = auto_grade_chat(msgs, sc)
+        rows.append({'room_id': rid, 'host': msgs['host'].iat[0], 'agent': msgs['agent'].iat[0], 'messages': len(msgs),
+                     'score': calculate_final_score(breakdown, crit, sc), 'critical': crit or "", **breakdown})
+    if not rows: return None, 0, taken
+    return pd.DataFrame(rows).to_csv(index=False).encode('utf-8'), len(rows), taken
+
+def job_corpus_analytics(sc):
+    """Brings the cached term matrix up to the snapshot, then scores the whole corpus."""
+    tm = get_term_matrix()
+    conn = None
+    with tm.lock:
+        try:
+            conn = get_snapshot().connect()
+            tm.update(conn, analytics_terms(compile_scorecard(scorecard_version(sc), sc)))
+        finally:
+            if conn: conn.close()
+        tm.save()
+        t0 = time.perf_counter()
+        report = corpus_report(tm, sc)
+    if report: report['timing'] = {'update_ms': tm.stats['update_ms'], 'report_ms': (time.perf_counter() - t0) * 1000,
+                                   'rows_read': tm.stats['last_read'], 'snapshot_ms': (get_snapshot().meta or {}).get('taken_at_ms')}
+    return report
+
+def job_clear_room(rid, host):
+    """Delete + recreate with the same scenario; returns the new room id. The old row is claimed
+    first (conditional UPDATE), so when two managers or workers clear the same room at once only
+    one replacement is made and both get its id. A claim older than CLEAR_WAIT_S is taken over."""
+    now = now_ms()
+    if not run_query("UPDATE rooms SET replaced_by = ? WHERE id = ? AND (replaced_by IS NULL OR (replaced_by < 0 AND -replaced_by < ?))",
+                     (-now, rid, now - int(CLEAR_WAIT_S * 1000)), fetch_mode="count", rid=rid):
+        return wait_for_replacement(rid)
+    row = run_query("SELECT scenario_id FROM rooms WHERE id = ?", (rid,), fetch_mode="one", rid=rid)
+    new = create_room(host, row[0] if row else None)
+    if new is None: # Release the claim so a retry can go ahead
+        run_query("UPDATE rooms SET replaced_by = NULL WHERE id = ?", (rid,), fetch_mode="commit", rid=rid)
+        return None
+    run_query("UPDATE rooms SET replaced_by = ? WHERE id = ?", (new, rid), fetch_mode="commit", rid=rid)
+    delete_room(rid)
+    run_query("UPDATE room_deletions SET replaced_by = ? WHERE room_id = ?", (new, rid), fetch_mode="commit")
+    return new
+
+def wait_for_replacement(rid):
+    """Id of the room that replaced `rid` (a clear running elsewhere), or None after CLEAR_WAIT_S."""
+    deadline = time.monotonic() + CLEAR_WAIT_S
+    while True:
+        row = run_query("SELECT replaced_by FROM rooms WHERE id = ?", (rid,), fetch_mode="one", rid=rid)
+        if not row: row = run_query("SELECT replaced_by FROM room_deletions WHERE room_id = ?", (rid,), fetch_mode="one")
+        if row and row[0] and row[0] > 0: return row[0]
+        if time.monotonic() > deadline: return None
+        time.sleep(0.05)
+
+# --- SESSION STATE (PER-ROOM NAMESPACES) ---
+def room_state(rid):
+    """This session's state for room `rid` ({'last_seen', 'grading', 'crit', 'tips', 'tally'}).
+    Rooms are kept most recently used last; beyond SESSION_MAX_ROOMS the oldest is forgotten."""
+    if 'rooms' not in st.session_state: st.session_state['rooms'] = OrderedDict()
+    rooms, rid = st.session_state['rooms'], int(rid)
+    ns = rooms.get(rid)
+    if ns is not None:
+        rooms.move_to_end(rid)
+        return ns
+    ns = rooms[rid] = {'last_seen': None, 'grading': {}, 'crit': None, 'tips': [], 'tally': None}
+    while len(rooms) > SESSION_MAX_ROOMS:
+        forget_room_state(next(iter(rooms)))
+        get_session_registry().stats['rooms_evicted'] += 1
+    return ns
+
+def forget_room_state(rid):
+    """Drops a room's namespace and the widget keys built from its id."""
+    st.session_state.get('rooms', {}).pop(int(rid), None)
+    side = get_side_channel()
+    if side and 'push_token' in st.session_state: side.revoke(st.session_state['push_token'], rid)
+    names = [k.format(rid=int(rid)) for k in ROOM_WIDGET_KEYS]
+    for key in [k for k in st.session_state if isinstance(k, str) and any(k == n or k.startswith(n + "_") for n in names)]:
+        del st.session_state[key]
+
+def open_room(rid):
+    st.session_state['active_room'] = rid
+    if rid: room_state(rid)
+
+def state_size(value):
+    """Rough bytes held by one session_state value: frames by their buffers, the rest pickled."""
+    if isinstance(value, (bytes, bytearray, str)): return len(value)
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(deep=True).sum())
+    try: return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception: return 0 # Unpicklable (widget internals): not counted
+
+def session_report():
+    """{'bytes', 'keys', 'rooms', 'top': [(key, bytes), ...]} for the calling browser session."""
+    sizes = {str(k): state_size(st.session_state[k]) for k in list(st.session_state.keys())}
+    top = sorted(sizes.items(), key=lambda kv: -kv[1])[:8]
+    return {'bytes': sum(sizes.values()), 'keys': len(sizes), 'rooms': len(st.session_state.get('rooms', {})), 'top': top}
+
+class SessionRegistry:
+    """Latest size report of every browser session in this process, for the server-wide total.
+    Sessions report themselves (throttled); one not seen for SESSION_STALE_S is assumed closed."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {} # session id -> report + 'at'
+        self.stats = {'reports': 0, 'rooms_evicted': 0}
+
+    def track(self):
+        """Marks the calling session alive and re-measures it when due; returns its latest report."""
+        ctx = get_script_run_ctx(suppress_warning=True)
+        sid = ctx.session_id if ctx else threading.current_thread().name
+        now = time.monotonic()
+        with self.lock:
+            rep = self.sessions.get(sid)
+        if rep is None or now - rep['measured'] >= SESSION_REPORT_SECONDS:
+            rep = dict(session_report(), measured=now)
+            self.stats['reports'] += 1
+        else:
+            rep = dict(rep, keys=len(st.session_state), rooms=len(st.session_state.get('rooms', {}))) # Sizes wait, counts are cheap
+        rep['at'] = now
+        with self.lock:
+            self.sessions[sid] = rep
+            for k in [k for k, r in self.sessions.items() if now - r['at'] > SESSION_STALE_S]: del self.sessions[k]
+        return rep
+
+    def totals(self):
+        """(sessions, bytes, largest session bytes, rooms held) over live sessions."""
+        now = time.monotonic()
+        with self.lock:
+            live = [r for r in self.sessions.values() if now - r['at'] <= SESSION_STALE_S]
+        return len(live), sum(r['bytes'] for r in live), max((r['bytes'] for r in live), default=0), sum(r['rooms'] for r in live)
+
+@st.cache_resource
+def get_session_registry():
+    return SessionRegistry()
+
+def format_bytes(n):
+    if n >= 1e6: return f"{n / 1e6:.1f} MB"
+    return f"{n / 1e3:.1f} KB" if n >= 1e3 else f"{n} B"
+
 # --- UI FRAGMENTS (Modern Streamlit) ---
-@st.fragment(run_every=2.5)
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_job_wait(jid, label):
+    """Placeholder while a job runs; reruns the page once it has finished."""
+    job = get_job_pool().get(jid)
+    if job and job['status'] in ('queued', 'running'):
+        st.caption(f"⏳ {label}... ({job['status'].upper()})")
+    else:
+        st.rerun()
+
+def take_finished_job(slot, rid, label):
+    """Returns the job held in session slot `slot` once it has finished (and forgets it).
+    While it runs, renders the polling placeholder and returns None."""
+    held = st.session_state.get(slot)
+    if not held: return None
+    job = get_job_pool().get(held[1])
+    if held[0] != rid or job is None: # Room changed, or the job was pruned
+        st.session_state.pop(slot, None)
+        return None
+    if job['status'] in ('queued', 'running'):
+        render_job_wait(held[1], label)
+        return None
+    st.session_state.pop(slot, None)
+    return job
+
 def render_live_updates(rid):
-    """Refreshes chat messages & checks timer every 1 second."""
-    
+    """Chat feed: event-driven when this browser holds the room's push stream, polled otherwise."""
+    if push_connected(rid): live_updates_pushed(rid)
+    else: live_updates_polled(rid)
+
+@st.fragment(run_every=PUSH_POLL_SECONDS)
+@profiled("fragment: live updates")
+def live_updates_polled(rid):
+    if push_connected(rid): st.rerun() # Stream came up: switch to the pushed fragment
+    live_updates_body(rid)
+
+@st.fragment(run_every=PUSH_FALLBACK_POLL_SECONDS)
+@profiled("fragment: live updates (push)")
+def live_updates_pushed(rid):
+    if not push_connected(rid): st.rerun() # Stream dropped: back to polling
+    live_updates_body(rid)
+
+def live_updates_body(rid):
+    """Refreshes chat messages & checks timer."""
+    # Target for the push client; hidden by CSS, a click reruns just this fragment
+    side = get_side_channel()
+    if side and side.running:
+        st.button("↻", key=f"push_refresh_{int(rid)}")
+        side.grant(push_token(), rid, st.session_state.get('user'), st.session_state.get('role')) # Keeps the grant alive
+    get_session_registry().track() # Fragment-only reruns keep a parked session counted
+
     # 1. Check Status
     status, diff, is_agent_turn = check_room_status(rid)
     user_role = st.session_state.get('role')
+
+    # Each tick doubles as a server-side heartbeat; typing comes from the browser beacon
+    presence = get_presence()
+    presence.beat(rid, st.session_state.get('user'), user_role)
+    others = [p for p in presence.room(rid) if p['user'] != st.session_state.get('user') and (p['role'] == 'Agent') != (user_role == 'Agent')]
+    other_label = "CUSTOMER" if user_role == 'Agent' else "AGENT"
     
     # 2. Render Timer/Status Badge (VISIBLE OUTSIDE CHAT BOX)
     if status == 'Active':
-        # Burst Mode Logic: Allow multiple messages for 5 seconds before switching turn visual
-        if diff < 5.0:
-            # If I just sent the message, show "Sent/Add More"
-            # If Agent just sent (is_agent_turn is False)
-            if not is_agent_turn and user_role == 'Agent':
-                st.markdown(f"<div class='timer-badge timer-ok'>✅ SENT (Type to add more...)</div>", unsafe_allow_html=True)
-            elif is_agent_turn and user_role != 'Agent': # Customer just sent
-                 st.markdown(f"<div class='timer-badge timer-ok'>✅ SENT (Type to add more...)</div>", unsafe_allow_html=True)
-            else:
-                 # I am waiting, but it's fresh. Show "Typing..."
-                 target = "AGENT" if not is_agent_turn else "CUSTOMER"
-                 st.markdown(f"<div class='timer-badge typing-indicator'>{target} TYPING...</div>", unsafe_allow_html=True)
-
+        my_turn = is_agent_turn == (user_role == 'Agent')
+        if any(p['typing'] for p in others):
+            st.markdown(f"<div class='timer-badge typing-indicator'>✍️ {other_label} TYPING...</div>", unsafe_allow_html=True)
+        elif not my_turn and diff < 5.0:
+            # Burst Mode: I just sent, more can follow before the turn visual switches
+            st.markdown(f"<div class='timer-badge timer-ok'>✅ SENT (Type to add more...)</div>", unsafe_allow_html=True)
+        elif my_turn and user_role == 'Agent':
+            st.markdown(f"<div class='timer-badge timer-warn'>👉 ACTION REQUIRED: YOUR TURN ({int(diff)}s)</div>", unsafe_allow_html=True)
+        elif my_turn:
+            st.markdown(f"<div class='timer-badge timer-ok'>💬 PLEASE REPLY...</div>", unsafe_allow_html=True)
         else:
-            # Standard Turn Logic (After 5s delay)
-            if is_agent_turn:
-                if user_role == 'Agent':
-                    st.markdown(f"<div class='timer-badge timer-warn'>👉 ACTION REQUIRED: YOUR TURN ({int(diff)}s)</div>", unsafe_allow_html=True)
-                else:
-                    st.markdown(f"<div class='timer-badge typing-indicator'>🔴 AGENT WRITING...</div>", unsafe_allow_html=True)
-            else:
-                if user_role == 'Agent':
-                    st.markdown(f"<div class='timer-badge typing-indicator'>👤 CUSTOMER WRITING...</div>", unsafe_allow_html=True)
-                else:
-                    st.markdown(f"<div class='timer-badge timer-ok'>💬 PLEASE REPLY...</div>", unsafe_allow_html=True)
+            st.markdown(f"<div class='timer-badge timer-ok'>⏳ WAITING FOR {other_label}...</div>", unsafe_allow_html=True)
+        st.caption(f"👥 {other_label} {'ONLINE: ' + ', '.join(p['user'] for p in others) if others else 'NOT CONNECTED'}")
 
     elif status == 'Expired':
         st.markdown(f"<div class='timer-badge timer-crit'>💀 CHAT EXPIRED (AGENT TIMEOUT)</div>", unsafe_allow_html=True)
@@ -846,7 +3938,7 @@ def render_live_updates(rid):
 
     # 3. Render Messages inside Scrollable Container
     with st.container(height=550):
-        msgs = get_msgs(rid, limit=50) 
+        msgs = get_live_msgs(rid, limit=50)
         
         # --- SCENARIO DISPLAY (AGENT VIEW) ---
         if user_role == 'Agent':
@@ -855,9 +3947,9 @@ def render_live_updates(rid):
                  st.markdown(f"""
                  <div class='scenario-card'>
                     <div class='scenario-title'>🎯 MISSION BRIEF</div>
-                    <b>CUSTOMER:</b> {sc_data.get('name', 'N/A')}<br>
-                    <b>DEVICE:</b> {sc_data.get('product', 'N/A')}<br>
-                    <b>ISSUE:</b> {sc_data.get('issue', 'N/A')}
+                    <b>CUSTOMER:</b> {sc_data['name'] or 'N/A'}<br>
+                    <b>DEVICE:</b> {sc_data['product'] or 'N/A'}<br>
+                    <b>ISSUE:</b> {sc_data['issue'] or 'N/A'}{f"<br><b>DIFFICULTY:</b> {sc_data['difficulty']}" if sc_data['difficulty'] else ""}
                  </div>
                  """, unsafe_allow_html=True)
         # -------------------------------------
@@ -865,15 +3957,15 @@ def render_live_updates(rid):
         # --- NEW MESSAGE SOUND NOTIFICATION ---
         if not msgs.empty:
             latest_id = msgs['id'].max()
-            last_seen_key = f"last_msg_id_{rid}"
+            ns = room_state(rid)
             
             # Init state if new room
-            if last_seen_key not in st.session_state:
-                st.session_state[last_seen_key] = latest_id
+            if ns['last_seen'] is None:
+                ns['last_seen'] = latest_id
             
             # Detect new message
-            if latest_id > st.session_state[last_seen_key]:
-                new_msgs = msgs[msgs['id'] > st.session_state[last_seen_key]]
+            if latest_id > ns['last_seen']:
+                new_msgs = msgs[msgs['id'] > ns['last_seen']]
                 current_user = st.session_state.get('user')
                 
                 # Sound Logic: Play via global JS function
@@ -888,31 +3980,101 @@ def render_live_updates(rid):
                             </script>
                         """, unsafe_allow_html=True)
                 
+                # Compliance: flagged on write, so the manager hears about it on the next tick
+                if user_role == 'Manager':
+                    for flags in new_msgs['flags'].dropna():
+                        if flags: st.toast(f"🚨 COMPLIANCE: AGENT SAID {', '.join(repr(p) for p in flags.split('|'))}")
+
                 # Update tracker
-                st.session_state[last_seen_key] = latest_id
+                ns['last_seen'] = latest_id
         # --------------------------------------
 
         if msgs.empty:
             st.markdown("<div style='text-align: center; color: #666; margin-top: 50px; font-style: italic;'>DECRYPTION COMPLETE. NO MESSAGES FOUND.<br>INITIATE PROTOCOL...</div>", unsafe_allow_html=True)
         else:
             for _, m in msgs.iterrows():
-                # Handle Image "Simulation"
-                if "[ATTACHMENT SENT]" in m['text']:
+                # Attachments: messages only hold a reference, the thumbnail is cached on disk
+                aid = parse_attachment_ref(m['text'])
+                if aid is not None:
+                    with st.chat_message(m['role'], avatar="👤" if m['role']=='Agent' else "👔"):
+                        st.markdown(f"**{m['sender']}** sent an attachment:")
+                        att = get_attachment(aid)
+                        thumb = get_thumbnail(att)
+                        if thumb:
+                            st.image(thumb, caption=att['filename'])
+                        else:
+                            st.caption(f"📎 {format_message_text(m['text'])}")
+                elif m['text'].startswith(LEGACY_ATTACHMENT_PREFIX):
                     with st.chat_message(m['role'], avatar="👤" if m['role']=='Agent' else "👔"):
                         st.markdown(f"**{m['sender']}** sent an attachment:")
-                        st.image("https://placehold.co/600x400/1a1a1a/e2231a?text=BROKEN+DEVICE+IMAGE", caption="attachment.jpg")
+                        st.caption(f"📎 {m['text'].split(':', 1)[-1].strip()} (simulated, no file stored)")
                 else:
                     with st.chat_message(m['role'], avatar="👤" if m['role']=='Agent' else "👔"):
                         st.write(f"**{m['sender']}**: {m['text']}")
+                        if m['flags'] and user_role == 'Manager':
+                            st.caption(" · ".join(f"🚨 {compliance_kind(p)}: '{p}'" for p in m['flags'].split("|")))
+
+def reset_room_page():
+    st.session_state['room_page'] = 0
+
+def step_room_page(delta):
+    st.session_state['room_page'] = max(0, st.session_state.get('room_page', 0) + delta)
+
+def open_room_from_wall(rid):
+    # Callback: runs before the rerun, so the sidebar toggle may still be changed here
+    open_room(rid)
+    st.session_state['wall_mode'] = False
+
+@st.fragment(run_every=2.5)
+@profiled("fragment: wall")
+def render_wall(host=None):
+    """Manager wall: every watched room from ONE batched query per tick (no per-room polling)."""
+    rooms = get_wall_rows(host=host)
+    if not rooms:
+        st.info("NO ACTIVE SIMULATIONS ON THE FLOOR.")
+        return
+
+    sc = get_config('scorecard')
+    now = now_ms()
+    cols = st.columns(3)
+    for i, room in enumerate(rooms.values()):
+        msgs = pd.DataFrame(room['msgs'], columns=['id', 'sender', 'role', 'text', 'flags'])
+        last_role = room['msgs'][-1]['role'] if room['msgs'] else None
+        status, diff, is_agent_turn = derive_room_status(room['status'], room['agent'], room['last_activity_ms'], last_role, now)
+        sentiment = analyze_conversation_sentiment(msgs)
+
+        # Provisional: graded on the recent window only, not the full transcript
+        bd, crit, _ = auto_grade_chat(msgs, sc)
+        if isinstance(crit, str) and "No Agent messages" in crit: crit, score_txt = None, "—"
+        elif crit: score_txt = "0% ⚠"
+        else: score_txt = f"{calculate_final_score(bd, crit, sc)}%"
+
+        cls = "wall-ok"
+        if status != 'Active' or crit: cls = "wall-crit"
+        elif is_agent_turn and diff > 60: cls = "wall-warn"
+
+        last = room['msgs'][-1] if room['msgs'] else None
+        last_txt = f"{last['sender']}: {format_message_text(last['text'])}" if last else "No messages yet"
+        agent = room['agent'] if room['agent'] != 'Waiting...' else "⏳ waiting"
+
+        with cols[i % 3]:
+            st.markdown(f"""
+            <div class='wall-card {cls}'>
+                <div class='wall-title'>#{room['id']} {html.escape(room['host'])} vs {html.escape(agent)}</div>
+                {status.upper()} · ⏱ {int(diff)}s · MOOD {sentiment}/100 · SCORE {score_txt}
+                <div class='wall-last'>{html.escape(last_txt)}</div>
+            </div>
+            """, unsafe_allow_html=True)
+            st.button("OPEN", key=f"wall_open_{room['id']}", on_click=open_room_from_wall, args=(room['id'],), use_container_width=True)
 
 # --- APP LAYOUT ---
 if 'user' not in st.session_state: st.session_state['user'] = None
-if 'manual_grading' not in st.session_state: st.session_state['manual_grading'] = {} 
 if 'role' not in st.session_state: st.session_state['role'] = "Agent"
 
 # --- INJECT GLOBAL SOUND ENGINE ---
 # We inject the Base64 strings directly into the HTML audio tags
-st.markdown(f"""
+with profile_section("css/audio injection"):
+    st.markdown(f"""
 <audio id="audio-notification" src="{NOTIF_B64}" preload="auto"></audio>
 <audio id="audio-typing" src="{TYPING_B64}" preload="auto"></audio>
 
@@ -972,11 +4134,11 @@ st.markdown(f"""
         }});
     }})();
 </script>
-""", unsafe_allow_html=True)
+    """, unsafe_allow_html=True)
 
-# Update Mute State in JS
-mute_js_bool = "true" if st.session_state.get('mute_sounds', False) else "false"
-st.markdown(f"<script>window.muteAppSounds = {mute_js_bool};</script>", unsafe_allow_html=True)
+    # Update Mute State in JS
+    mute_js_bool = "true" if st.session_state.get('mute_sounds', False) else "false"
+    st.markdown(f"<script>window.muteAppSounds = {mute_js_bool};</script>", unsafe_allow_html=True)
 
 
 # SIDEBAR
@@ -1005,8 +4167,9 @@ with st.sidebar:
             st.markdown("---")
             st.markdown("<h3>📊 LIVE SENTIMENT</h3>", unsafe_allow_html=True)
             # Need to fetch msgs here or pass it? Better to fetch light version
-            current_msgs = get_msgs(st.session_state['active_room'], 20)
-            sentiment_score = analyze_conversation_sentiment(current_msgs)
+            with profile_section("sidebar: sentiment"):
+                current_msgs = get_live_msgs(st.session_state['active_room'], 20)
+                sentiment_score = analyze_conversation_sentiment(current_msgs)
             
             # Color logic
             bar_color = "red"
@@ -1027,16 +4190,16 @@ with st.sidebar:
              st.markdown("<h3>⚡ QUICK COMMS</h3>", unsafe_allow_html=True)
              c1, c2 = st.columns(2)
              if c1.button("👋 Hello"):
-                 send_msg(st.session_state['active_room'], st.session_state['user'], "Agent", "Hello! Thank you for contacting Lenovo Support. My name is " + st.session_state['user'] + ". How can I assist you today?")
+                 st.session_state['send_shed'] = post_message(st.session_state['active_room'], st.session_state['user'], "Agent", "Hello! Thank you for contacting Lenovo Support. My name is " + st.session_state['user'] + ". How can I assist you today?")
                  st.rerun()
              if c2.button("✋ Hold"):
-                 send_msg(st.session_state['active_room'], st.session_state['user'], "Agent", "Please bear with me for a moment while I check that information for you.")
+                 st.session_state['send_shed'] = post_message(st.session_state['active_room'], st.session_state['user'], "Agent", "Please bear with me for a moment while I check that information for you.")
                  st.rerun()
              if c1.button("🙏 Sorry"):
-                 send_msg(st.session_state['active_room'], st.session_state['user'], "Agent", "I apologize for the inconvenience you are facing.")
+                 st.session_state['send_shed'] = post_message(st.session_state['active_room'], st.session_state['user'], "Agent", "I apologize for the inconvenience you are facing.")
                  st.rerun()
              if c2.button("👋 Bye"):
-                 send_msg(st.session_state['active_room'], st.session_state['user'], "Agent", "Thank you for choosing Lenovo. Have a wonderful day!")
+                 st.session_state['send_shed'] = post_message(st.session_state['active_room'], st.session_state['user'], "Agent", "Thank you for choosing Lenovo. Have a wonderful day!")
                  st.rerun()
         # ------------------------------------
 
@@ -1044,6 +4207,7 @@ with st.sidebar:
         if st.button("LOGOUT / DISCONNECT", use_container_width=True):
             st.session_state['user'] = None
             st.session_state['active_room'] = None
+            for old in list(st.session_state.get('rooms', {})): forget_room_state(old)
             st.rerun()
         
         st.markdown("---")
@@ -1052,45 +4216,154 @@ with st.sidebar:
         if st.session_state['role'] == "Manager":
             # --- NEW: Scenario Injection ---
             with st.expander("➕ INITIATE NEW SIM", expanded=False):
+                catalog = get_scenarios()
+                scenarios = {sc['id']: sc for sc in catalog.list()}
+                if scenarios:
+                    pick = st.selectbox("From Catalog", list(scenarios), format_func=lambda sid: scenario_label(scenarios[sid]), key="catalog_pick")
+                    if st.button("LAUNCH FROM CATALOG", use_container_width=True):
+                        open_room(create_room(st.session_state['user'], pick))
+                        st.rerun()
                 with st.form("new_sim_form"):
+                    st.caption("CUSTOM SCENARIO (saved to the catalog)")
                     cust_name = st.text_input("Customer Name", "John Doe")
                     prod_model = st.selectbox("Product", ["ThinkPad X1", "Legion 5 Pro", "Yoga 9i", "IdeaPad 3"])
                     issue_desc = st.text_area("Issue Description", "Blue Screen of Death when launching games.")
+                    difficulty = st.selectbox("Difficulty", SCENARIO_DIFFICULTIES, index=1)
                     if st.form_submit_button("LAUNCH SIMULATION"):
-                        scenario = {"name": cust_name, "product": prod_model, "issue": issue_desc}
-                        rid = create_room(st.session_state['user'], scenario)
-                        st.session_state['active_room'] = rid
-                        st.session_state['manual_grading'] = {} 
+                        scenario = {"name": cust_name, "product": prod_model, "issue": issue_desc, "difficulty": difficulty}
+                        rid = create_room(st.session_state['user'], catalog.add(scenario, st.session_state['user']))
+                        open_room(rid)
                         st.rerun()
             # -------------------------------
+
+            with st.expander("📦 EXPORTS & SWEEPS", expanded=False):
+                # Heavy reads go to the snapshot, never the live chat files
+                snap = get_snapshot()
+                st.caption(snapshot_caption(snap))
+                if st.button("⟳ REFRESH SNAPSHOT", use_container_width=True):
+                    st.session_state['snapshot_job'] = ('snapshot', get_job_pool().submit('snapshot', (), snap.refresh, reuse_done=False))
+                take_finished_job('snapshot_job', 'snapshot', "COPYING DATABASE")
+                today = datetime.date.today()
+                span = st.date_input("Date Range", (today - datetime.timedelta(days=7), today), key="export_range")
+                export_all = st.checkbox("All hosts", key="export_all_hosts")
+                if isinstance(span, (tuple, list)) and len(span) == 2:
+                    if st.button("BUILD EXPORT", use_container_width=True):
+                        st.session_state['range_export'] = (span,) + export_range_csv(span[0], span[1], None if export_all else st.session_state['user'])
+                    built = st.session_state.get('range_export')
+                    if built and built[0] == span:
+                        if built[1]:
+                            st.download_button(f"📥 CSV ({built[2]} MSGS)", built[1], f"transcripts_{span[0]}_{span[1]}.csv", "text/csv", use_container_width=True)
+                        else: st.caption("NO MESSAGES IN RANGE.")
+
+                sweep_host = None if export_all else st.session_state['user']
+                if st.button("GRADE SWEEP", use_container_width=True, help="Auto-grade every room in the snapshot"):
+                    sc = get_config('scorecard')
+                    key = (sweep_host, (snap.meta or {}).get('taken_at_ms'), get_config_meta('scorecard').get('hash'))
+                    st.session_state['sweep_job'] = (sweep_host, get_job_pool().submit('grade_sweep', key, job_grade_sweep, sweep_host, sc))
+                job = take_finished_job('sweep_job', sweep_host, "GRADING SNAPSHOT")
+                if job: st.session_state['sweep_result'] = (sweep_host, job)
+                swept = st.session_state.get('sweep_result')
+                if swept and swept[0] == sweep_host:
+                    if swept[1]['error']: st.error(f"SWEEP FAILED: {swept[1]['error']}")
+                    elif swept[1]['result'][0]:
+                        data, n, taken = swept[1]['result']
+                        st.download_button(f"📥 SCORES ({n} ROOMS{', AS OF ' + format_ts(taken, '%H:%M') if taken else ''})", data,
+                                           "grade_sweep.csv", "text/csv", use_container_width=True)
+                    else: st.caption("NO ROOMS TO GRADE.")
+
+            with st.expander("🧹 RETENTION", expanded=False):
+                ret = get_retention()
+                st.caption(retention_caption(ret))
+                # Policies are edited as raw JSON, like "any of" scorecard rules
+                raw = st.text_area("Policies (JSON)", json.dumps(get_config('retention'), indent=1), height=220, key="retention_policies",
+                                   help='[{"name", "statuses": [...] (empty = any), "older_than_days", "graded": true/false/null}]')
+                policies, problems = None, ["invalid JSON"]
+                try: policies = json.loads(raw)
+                except ValueError: pass
+                if isinstance(policies, list):
+                    problems = [f"#{i + 1}: {retention_policy_error(p)}" for i, p in enumerate(policies) if retention_policy_error(p)]
+                elif policies is not None: problems = ["not a list"]
+                if problems: st.error(" · ".join(problems))
+                c1, c2 = st.columns(2)
+                if c1.button("SAVE", use_container_width=True, disabled=bool(problems), key="retention_save"):
+                    update_config('retention', policies)
+                    st.success("Policies saved")
+                if c2.button("PREVIEW", use_container_width=True, disabled=bool(problems), key="retention_preview"):
+                    st.session_state['retention_estimate'] = ret.preview(policies)
+                preview = st.session_state.get('retention_estimate')
+                if preview: st.caption(f"WOULD PURGE {preview['rooms']} ROOMS · {preview['messages']} MSGS")
+                if st.button("PURGE NOW", use_container_width=True, disabled=bool(problems), key="retention_run"):
+                    update_config('retention', policies)
+                    st.session_state.pop('retention_estimate', None)
+                    st.session_state['retention_job'] = ('retention', get_job_pool().submit('retention', (), ret.run, reuse_done=False))
+                job = take_finished_job('retention_job', 'retention', "PURGING")
+                if job and job['error']: st.error(f"PURGE FAILED: {job['error']}")
+                elif job: st.rerun()
         
+        if st.session_state['role'] == "Manager":
+            st.checkbox("🧱 WALL VIEW", key="wall_mode", help="Monitor every active simulation at once")
+
         if st.button("🔄 REFRESH FEED", use_container_width=True): st.rerun()
+        if st.session_state['role'] == "Manager":
+            hub_stats = get_room_hub().stats()
+            st.caption(f"HUB: {hub_stats['rooms']} ROOMS · {hub_stats['hits']} HIT / {hub_stats['misses']} MISS · {hub_stats['evictions']} EVICTED"
+                       + (f" · WORKER {WORKER_ID} · {hub_stats['synced']} SYNCED" if MULTI_WORKER else ""))
+            alerts = get_room_hub().get_alerts(5)
+            if alerts:
+                st.markdown("**🚨 COMPLIANCE ALERTS**")
+                for a in alerts:
+                    c1, c2 = st.columns([4, 1])
+                    c1.caption(f"#{a['room_id']} {format_ts(a['timestamp_ms'], '%H:%M:%S')} {a['sender']}: "
+                               + ", ".join(f"{compliance_kind(p)} '{p}'" for p in a['flags'].split("|")))
+                    c2.button("▶", key=f"alert_{a['room_id']}_{a['id']}", on_click=open_room_from_wall, args=(a['room_id'],))
         
-        rooms = get_rooms()
-        if not rooms.empty:
-            for _, r in rooms.iterrows():
-                icon = "🟢"
-                if r['status'] == 'Expired': icon = "💀"
-                elif r['status'] == 'Offline': icon = "💤"
+        with profile_section("sidebar: room list"):
+            c1, c2 = st.columns([3, 2])
+            c1.selectbox("STATUS", ROOM_STATUS_FILTERS, key="room_filter_status", label_visibility="collapsed", on_change=reset_room_page)
+            mine = c2.checkbox("MINE", key="room_filter_mine", on_change=reset_room_page)
+            me = st.session_state['user'] if mine else None
+            filters = {'status': st.session_state['room_filter_status'],
+                       'host': me if st.session_state['role'] == "Manager" else None,
+                       'agent': me if st.session_state['role'] == "Agent" else None} # Agents also see rooms still waiting
+            page = st.session_state.get('room_page', 0)
+            rooms, total = get_room_index().page(page=page, **filters)
+            pages = max(1, -(-total // ROOM_PAGE_SIZE))
+            if page >= pages: # List shrank under us
+                st.session_state['room_page'] = page = pages - 1
+                rooms, total = get_room_index().page(page=page, **filters)
+            notice = st.session_state.pop('room_notice', None)
+            if notice: st.warning(notice)
+            if not rooms: st.caption("NO ROOMS MATCH.")
+            else:
+                for r in rooms:
+                    icon = "🟢"
+                    if r['status'] == 'Expired': icon = "💀"
+                    elif r['status'] == 'Offline': icon = "💤"
                 
-                label = f"{icon} #{r['id']} {r['host']}"
-                if r['agent'] != 'Waiting...': label += f" vs {r['agent']}"
+                    label = f"{icon} #{r['id']} {r['host']}"
+                    if r['agent'] != 'Waiting...': label += f" vs {r['agent']}"
                 
-                c1, c2 = st.columns([4, 1])
-                with c1:
-                    if st.button(label, key=f"r_{r['id']}", use_container_width=True):
-                        st.session_state['active_room'] = r['id']
-                        if st.session_state['role'] == 'Agent' and r['agent'] == 'Waiting...':
-                            join_room(r['id'], st.session_state['user'])
-                        st.session_state['manual_grading'] = {} 
-                        st.rerun()
-                with c2:
-                     if st.session_state['role'] == "Manager":
-                         if st.button("✖", key=f"del_{r['id']}"):
-                             delete_room(r['id'])
-                             if st.session_state.get('active_room') == r['id']:
-                                 st.session_state['active_room'] = None
-                             st.rerun()
+                    c1, c2 = st.columns([4, 1])
+                    with c1:
+                        if st.button(label, key=f"r_{r['id']}", use_container_width=True):
+                            if st.session_state['role'] == 'Agent' and r['agent'] == 'Waiting...' and not join_room(r['id'], st.session_state['user']):
+                                st.session_state['room_notice'] = f"ROOM #{r['id']} WAS JUST TAKEN BY ANOTHER AGENT."
+                            else:
+                                open_room(r['id'])
+                            st.rerun()
+                    with c2:
+                         if st.session_state['role'] == "Manager":
+                             if st.button("✖", key=f"del_{r['id']}"):
+                                 delete_room(r['id'])
+                                 forget_room_state(r['id'])
+                                 if st.session_state.get('active_room') == r['id']:
+                                     st.session_state['active_room'] = None
+                                 st.rerun()
+            if pages > 1:
+                c1, c2, c3 = st.columns([1, 2, 1])
+                c1.button("◀", key="room_prev", disabled=page == 0, on_click=step_room_page, args=(-1,))
+                c2.caption(f"PAGE {page + 1}/{pages} · {total} ROOMS")
+                c3.button("▶", key="room_next", disabled=page >= pages - 1, on_click=step_room_page, args=(1,))
 
 # MAIN AREA
 if not st.session_state['user']:
@@ -1112,7 +4385,12 @@ if not st.session_state['user']:
                     init_db()
                     st.rerun()
 else:
-    if 'active_room' in st.session_state and st.session_state['active_room']:
+    if st.session_state['role'] == 'Manager' and st.session_state.get('wall_mode'):
+        c1, c2 = st.columns([3, 1])
+        c1.markdown("<h2>🧱 FLOOR WALL</h2>", unsafe_allow_html=True)
+        wall_scope = c2.radio("SCOPE", ["MY SIMS", "ALL"], horizontal=True, key="wall_scope")
+        render_wall(st.session_state['user'] if wall_scope == "MY SIMS" else None)
+    elif 'active_room' in st.session_state and st.session_state['active_room']:
         rid = st.session_state['active_room']
         col_chat, col_tools = st.columns([2, 1])
         
@@ -1125,60 +4403,86 @@ else:
                 render_live_updates(rid)
             except Exception as e:
                 st.error(f"Feed Connection Interrupted: {e}")
+            inject_side_channel_client(rid)
             
             # Input outside fragment - FIX for "disappearing input"
             # We use a key based on the room to keep it fresh
+            shed = st.session_state.pop('send_shed', None)
+            if shed: st.warning(shed)
             if prompt := st.chat_input("TRANSMIT MESSAGE...", key=f"chat_input_{rid}"):
-                send_msg(rid, st.session_state['user'], st.session_state['role'], prompt)
+                st.session_state['send_shed'] = post_message(rid, st.session_state['user'], st.session_state['role'], prompt)
                 st.rerun()
         
         with col_tools:
             st.markdown("<h2>QA TOOLS</h2>", unsafe_allow_html=True)
             
-            # --- NEW: FILE ATTACHMENT SIMULATION (FOR CUSTOMER/MANAGER) ---
+            # --- FILE ATTACHMENTS (FOR CUSTOMER/MANAGER) ---
             if st.session_state['role'] == 'Manager':
-                if st.button("📎 SIMULATE ATTACHMENT", use_container_width=True):
-                    send_msg(rid, st.session_state['user'], st.session_state['role'], "[ATTACHMENT SENT]: broken_screen.jpg")
+                upload_key = f"upload_{rid}_{st.session_state.get('upload_seq', 0)}"
+                upload = st.file_uploader("📎 ATTACH FILE", key=upload_key, label_visibility="collapsed")
+                if upload is not None and st.button("📎 SEND ATTACHMENT", use_container_width=True):
+                    shed = send_attachment(rid, st.session_state['user'], st.session_state['role'], upload.name, upload.getvalue(), upload.type or "application/octet-stream")
+                    st.session_state['send_shed'] = shed
+                    if not shed: st.session_state['upload_seq'] = st.session_state.get('upload_seq', 0) + 1 # Fresh uploader
                     st.rerun()
-            # --------------------------------------------------------------
+            # ------------------------------------------------
 
             if st.session_state['role'] == 'Manager':
-                tab1, tab2 = st.tabs(["GRADING", "CONFIG"])
-                with tab1:
-                    msgs = get_msgs(rid, limit=1000)
+                tab1, tab2, tab3, tab4 = st.tabs(["GRADING", "CONFIG", "DIAGNOSTICS", "ANALYTICS"])
+                with tab1, profile_section("grading tab"):
                     sc = get_config('scorecard')
+                    jobs = get_job_pool()
+                    ns = room_state(rid)
                     
+                    # Heavy work runs on the job pool; the page only polls for the result
                     if st.button("RUN AUTO-ANALYSIS", use_container_width=True):
-                        bd, crit, tips = auto_grade_chat(msgs, sc)
+                        st.session_state['grade_job'] = (rid, jobs.submit('grade', (rid, last_msg_id(rid), scorecard_version(sc)), job_grade, rid, sc))
+
+                    job = take_finished_job('grade_job', rid, "ANALYZING TRANSCRIPT")
+                    if job and job['error']:
+                        st.error(f"Auto-analysis failed: {job['error']}")
+                    elif job:
+                        bd, crit, tips = job['result']
                         
                         # Fix for empty agent messages
                         if isinstance(crit, str) and "No Agent messages" in crit:
                             st.warning(crit)
                         else:
-                            st.session_state['manual_grading'] = bd 
-                            st.session_state['crit_fail'] = crit
-                            st.session_state['tips'] = tips
+                            ns['grading'] = dict(bd) # Finished results may be shared
+                            mark_graded(rid)
+                            ns['crit'] = crit
+                            ns['tips'] = tips
                             st.rerun()
 
-                    if 'manual_grading' in st.session_state and st.session_state['manual_grading']:
-                        crit = st.session_state.get('crit_fail')
-                        tips = st.session_state.get('tips', [])
+                    if ns['grading']:
+                        crit = ns['crit']
+                        tips = ns['tips']
                         
-                        current_score = calculate_final_score(st.session_state['manual_grading'], crit, sc)
+                        # Full weight pass only when the grading or the scorecard changes; radio edits adjust it
+                        meta = get_config_meta('scorecard')
+                        tally = ns['tally']
+                        if not tally or tally['hash'] != meta['hash'] or tally['grading'] is not ns['grading']:
+                            tally = ns['tally'] = {'hash': meta['hash'], 'grading': ns['grading'],
+                                                   'points': passed_weight(ns['grading'], meta['weights'])}
+                        current_score = 0 if crit else score_percent(tally['points'], meta['total_weight'])
                         
                         if crit:
                             st.markdown(f"<div class='grade-container grade-fail'><div class='grade-score' style='color:#ff3b30'>0%</div><div style='text-align:center; color:#ff3b30'>{crit}</div></div>", unsafe_allow_html=True)
                         else:
-                            cls = "grade-pass" if current_score >= 85 else "grade-fail"
-                            color = "#00ffcc" if current_score >= 85 else "#ff3b30"
+                            cls = "grade-pass" if current_score >= PASS_SCORE else "grade-fail"
+                            color = "#00ffcc" if current_score >= PASS_SCORE else "#ff3b30"
                             st.markdown(f"<div class='grade-container {cls}'><div class='grade-score' style='color:{color}'>{current_score}%</div></div>", unsafe_allow_html=True)
                         
                         # NEW: Manager Clear Chat
                         if st.button("🗑️ CLEAR CHAT HISTORY", use_container_width=True):
-                             delete_room(rid)
-                             scenario_data = get_room_details(rid)
-                             create_room(st.session_state['user'], scenario_data) # Recreate same room
-                             st.rerun()
+                             st.session_state['clear_job'] = (rid, jobs.submit('clear', (rid,), job_clear_room, rid, st.session_state['user'], reuse_done=False))
+                        job = take_finished_job('clear_job', rid, "CLEARING CHAT")
+                        if job:
+                             if job['result']: # Recreated room (same scenario) replaces this one
+                                 forget_room_state(rid)
+                                 open_room(job['result'])
+                                 st.rerun()
+                             st.error(f"Clear failed: {job['error'] or 'room not recreated'}")
 
                         st.write("---")
                         st.markdown("<h4>GRADING MATRIX</h4>", unsafe_allow_html=True)
@@ -1186,18 +4490,19 @@ else:
                         if sc:
                             for item in sc:
                                 name = item['name']
-                                current_val = st.session_state['manual_grading'].get(name, "FAIL")
+                                current_val = ns['grading'].get(name, "FAIL")
                                 
                                 new_val = st.radio(
                                     f"{name} ({item['weight']}%)", 
                                     ["PASS", "FAIL"], 
                                     index=0 if current_val == "PASS" else 1,
                                     horizontal=True,
-                                    key=f"radio_{name}"
+                                    key=f"radio_{rid}_{name}"
                                 )
                                 
                                 if new_val != current_val:
-                                    st.session_state['manual_grading'][name] = new_val
+                                    ns['grading'][name] = new_val
+                                    tally['points'] += meta['weights'].get(name, 0.0) * ((new_val == "PASS") - (current_val == "PASS"))
                                     st.rerun() 
                         else:
                             st.error("Scorecard configuration missing. Check database.")
@@ -1205,23 +4510,28 @@ else:
                         st.write("---")
                         
                         # --- PDF EXPORT LOGIC ---
-                        sc_data = get_room_details(rid)
-                        if HAS_FPDF:
-                            pdf_bytes = generate_pdf_report(rid, msgs, current_score, st.session_state['manual_grading'], crit, sc_data)
+                        # Built in the background; an unchanged grading reuses the finished report
+                        grading = ns['grading']
+                        report_key = (rid, last_msg_id(rid), current_score, crit, json.dumps(grading, sort_keys=True))
+                        report_job = jobs.get(jobs.submit('report', report_key, job_report, rid, current_score, dict(grading), crit))
+                        if report_job['status'] == 'failed':
+                            st.error(f"Report failed: {report_job['error']}")
+                        elif report_job['status'] != 'done':
+                            render_job_wait(report_job['id'], "BUILDING REPORT")
+                        elif report_job['result'][0] == "pdf":
                             st.download_button(
                                 label="📄 EXPORT PDF REPORT",
-                                data=pdf_bytes,
+                                data=report_job['result'][1],
                                 file_name=f"Lenovo_Chat_Report_{rid}.pdf",
                                 mime="application/pdf",
                                 use_container_width=True
                             )
                         else:
                              # Fallback to text
-                            report_text = generate_export_text(rid, msgs, current_score, st.session_state['manual_grading'], crit, sc_data)
                             st.warning("Install 'fpdf' for PDF exports. Using TXT fallback.")
                             st.download_button(
                                 label="📥 EXPORT TXT REPORT",
-                                data=report_text,
+                                data=report_job['result'][1],
                                 file_name=f"Lenovo_Chat_Report_{rid}.txt",
                                 mime="text/plain",
                                 use_container_width=True
@@ -1235,19 +4545,164 @@ else:
                     st.info("System Configuration")
                     curr = get_config('scorecard')
                     new_sc = []
+                    rule_problems = []
                     if curr:
                         for i in curr:
                             with st.expander(i['name']):
                                 w = st.number_input("Weight", value=float(i['weight']), key=f"w_{i['id']}")
                                 n = st.text_input("Name", value=i['name'], key=f"n_{i['id']}")
-                                i['weight'] = w
-                                i['name'] = n
-                                new_sc.append(i)
+                                rule = item_rule(i)
+                                if isinstance(rule, list):
+                                    # "Any of" rules are edited as raw JSON
+                                    raw = st.text_area("Rule (JSON, any of)", json.dumps(rule, indent=1), key=f"rj_{i['id']}")
+                                    try: rule = json.loads(raw)
+                                    except ValueError: rule_problems.append(f"{n}: invalid JSON")
+                                else:
+                                    phrases = st.text_area("Phrases (one per line)", "\n".join(rule.get('phrases', [])), key=f"rp_{i['id']}")
+                                    regex = st.text_area("Regex (one per line)", "\n".join(rule.get('regex', [])), key=f"rx_{i['id']}")
+                                    negative = st.text_area("Negative phrases (fail if present)", "\n".join(rule.get('negative', [])), key=f"rn_{i['id']}")
+                                    c1, c2 = st.columns(2)
+                                    roles = c1.multiselect("Roles", RULE_ROLES, default=[r for r in rule.get('roles', ['Agent']) if r in RULE_ROLES], key=f"rr_{i['id']}")
+                                    min_count = c2.number_input("Min hits", min_value=1, value=int(rule.get('min_count', 1)), key=f"rc_{i['id']}")
+                                    rule = {"phrases": [x.strip() for x in phrases.splitlines() if x.strip()],
+                                            "regex": [x.strip() for x in regex.splitlines() if x.strip()],
+                                            "negative": [x.strip() for x in negative.splitlines() if x.strip()],
+                                            "roles": roles or ['Agent'], "min_count": int(min_count)}
+                                err = rule_error(rule)
+                                if err: rule_problems.append(f"{n}: {err}")
+                                if st.checkbox("Remove criterion", key=f"rm_{i['id']}"): continue
+                                new_sc.append({**i, 'weight': w, 'name': n, 'rule': rule})
                         if st.button("SAVE CONFIGURATION", use_container_width=True):
-                            update_config('scorecard', new_sc)
-                            st.success("System Updated")
+                            if rule_problems: st.error("Not saved. " + " · ".join(rule_problems))
+                            else:
+                                update_config('scorecard', new_sc)
+                                st.success("System Updated")
+
+                        with st.form("new_criterion_form", clear_on_submit=True):
+                            st.markdown("<h4>ADD CRITERION</h4>", unsafe_allow_html=True)
+                            c_name = st.text_input("Name")
+                            c1, c2 = st.columns(2)
+                            c_cat = c1.text_input("Category", "Custom")
+                            c_weight = c2.number_input("Weight", min_value=0.0, value=5.0)
+                            c_phrases = st.text_area("Phrases (one per line)")
+                            if st.form_submit_button("ADD", use_container_width=True) and c_name:
+                                cid = re.sub(r'\W+', '_', c_name.lower()).strip('_') or "custom"
+                                while any(x['id'] == cid for x in curr): cid += "_"
+                                update_config('scorecard', curr + [{"id": cid, "name": c_name, "weight": c_weight, "keywords": "", "category": c_cat,
+                                                                    "rule": {"phrases": [x.strip() for x in c_phrases.splitlines() if x.strip()]}}])
+                                st.rerun()
                     else:
                         st.error("Could not load configuration.")
+
+                with tab3:
+                    stmts, slow_log = get_query_stats().snapshot()
+                    if stmts:
+                        diag = pd.DataFrame([
+                            {'STATEMENT': k, 'CALLS': v['count'], 'AVG MS': round(v['sum_ms'] / v['count'], 2) if v['count'] else 0,
+                             'P95 MS': latency_percentile(v, 0.95), 'MAX MS': round(v['max_ms'], 1), 'ROWS': v['rows'],
+                             'ERRORS': v['errors'], 'LOCKED': v['lock_errors'], 'TOTAL MS': round(v['sum_ms'], 1)}
+                            for k, v in stmts.items()
+                        ]).sort_values('TOTAL MS', ascending=False)
+                        st.dataframe(diag, hide_index=True, use_container_width=True)
+                    else:
+                        st.info("No queries recorded yet.")
+
+                    st.markdown(f"<h4>SLOW QUERIES (&gt; {SLOW_QUERY_MS:g} MS)</h4>", unsafe_allow_html=True)
+                    for entry in reversed(slow_log[-20:]):
+                        with st.expander(f"{entry['ms']:.1f} ms · {entry['at'].strftime('%H:%M:%S')} · {entry['stmt'][:60]}"):
+                            st.code(entry['stmt'], language="sql")
+                            st.code(entry['plan'] or "(no plan captured)")
+
+                    side = get_side_channel()
+                    rooms_live, users_live = get_presence().counts()
+                    side_txt = "DISABLED" if side is None else (f":{side.port} UP · {side.stats['requests']} REQ · {side.subscriber_count()} STREAMS · {side.stats['published']} EVENTS" if side.running else f"DOWN ({side.error})")
+                    st.caption(f"SIDE CHANNEL: {side_txt} · PRESENCE: {users_live} USERS IN {rooms_live} ROOMS")
+                    hub = get_room_hub()
+                    st.caption((f"WORKER {WORKER_ID} (MULTI-WORKER, WAL) · SYNC {hub.synced} MSGS" + (f" · ERROR {hub.sync_error}" if hub.sync_error else "") if MULTI_WORKER else "SINGLE WORKER")
+                               + f" · STATUS CHANGES {hub.transitions} WON / {hub.conflicts} LOST")
+                    snap = get_snapshot()
+                    st.caption(f"{snapshot_caption(snap)} · {snap.stats['refreshes']} REFRESHES · {snap.stats['restarts']} RESTARTS · {snap.stats['reads']} READS")
+                    rl = get_rate_limiter()
+                    st.caption(f"SENDS: {rl.stats['admitted']} ADMITTED · {rl.stats['shed_user']} SHED (USER) · {rl.stats['shed_room']} SHED (ROOM) · "
+                               f"WRITE EWMA {rl.write_ms:.1f} MS · BACKPRESSURE {'ON' if rl.backpressure() else 'OFF'} ({rl.stats['delayed']} DELAYED)"
+                               + ("" if RATE_LIMITS else " · LIMITS DISABLED"))
+                    ret = get_retention()
+                    st.caption(f"{retention_caption(ret)} · {ret.stats['runs']} RUNS · {ret.stats['batches']} BATCHES (NOW {ret.batch} ROWS)")
+                    sessions = get_session_registry()
+                    mine = sessions.track()
+                    n_sessions, total, largest, held = sessions.totals()
+                    st.caption(f"THIS SESSION: {format_bytes(mine['bytes'])} IN {mine['keys']} KEYS · {mine['rooms']}/{SESSION_MAX_ROOMS} ROOMS · "
+                               + ", ".join(f"{k} {format_bytes(n)}" for k, n in mine['top'][:4])
+                               + f" || ALL SESSIONS: {n_sessions} · {format_bytes(total)} (MAX {format_bytes(largest)}) · {held} ROOMS · {sessions.stats['rooms_evicted']} EVICTED")
+                    queued, running = jobs.depth()
+                    timing = jobs.timing.snapshot()[0]
+                    st.caption(f"JOBS: {queued} QUEUED · {running} RUNNING · {jobs.stats['done']} DONE / {jobs.stats['failed']} FAILED · "
+                               f"{jobs.stats['deduped'] + jobs.stats['reused']} DEDUPED · "
+                               + " · ".join(f"{k.upper()} P95 {latency_percentile(v, 0.95):g} MS" for k, v in sorted(timing.items())))
+
+                    c1, c2 = st.columns(2)
+                    if c1.button("💾 DUMP METRICS", use_container_width=True):
+                        st.success(f"Written to {dump_prometheus_metrics()}")
+                    if c2.button("♻️ RESET STATS", use_container_width=True):
+                        get_query_stats().reset()
+                        st.rerun()
+                    st.download_button("📥 PROMETHEUS TEXT", data=render_prometheus_metrics(), file_name="lenovo_chat_metrics.prom",
+                                       mime="text/plain", use_container_width=True)
+
+                    st.markdown("<h4>TRAFFIC RECORDER</h4>", unsafe_allow_html=True)
+                    rec = get_recorder()
+                    recording = st.toggle("⏺ RECORD DATA-LAYER CALLS", value=bool(rec.path), help=f"Process-wide. Trace + DB copy go to {TRACE_DIR}/; replay with tools/replay.py")
+                    if recording and not rec.path: rec.start(os.path.join(TRACE_DIR, f"trace_{datetime.datetime.now():%Y%m%d_%H%M%S}.jsonl"))
+                    elif not recording and rec.path: rec.stop()
+                    if rec.path or rec.stats['recorded']:
+                        st.caption(f"{'RECORDING → ' + rec.path if rec.path else 'STOPPED'} · {rec.stats['recorded']} CALLS · {rec.stats['written']} WRITTEN"
+                                   + (f" · ERROR: {rec.error}" if rec.error else ""))
+
+                    st.markdown("<h4>RERUN PROFILE</h4>", unsafe_allow_html=True)
+                    prof = get_profiler()
+                    prof.enabled = st.toggle("⏱ PROFILE SECTIONS", value=prof.enabled, help="Process-wide, affects every session")
+                    prof.cprofile = st.toggle(f"🧬 CPROFILE DUMPS (SLOWEST {PROFILE_KEEP_SLOWEST} → {PROFILE_DIR}/)", value=prof.cprofile, disabled=not prof.enabled)
+                    prof_rows = prof.summary()
+                    if prof_rows:
+                        st.dataframe(pd.DataFrame(prof_rows).sort_values('TOTAL MS', ascending=False), hide_index=True, use_container_width=True)
+                        for ms, path in prof.slowest:
+                            st.caption(f"{ms:.0f} ms → {path}")
+                        if st.button("♻️ RESET PROFILE", use_container_width=True):
+                            prof.reset()
+                            st.rerun()
+
+                with tab4, profile_section("analytics tab"):
+                    # Whole-corpus stats from the snapshot; the term matrix is cached on disk
+                    snap = get_snapshot()
+                    st.caption(snapshot_caption(snap))
+                    if st.button("RUN CORPUS ANALYTICS", use_container_width=True):
+                        sc = get_config('scorecard')
+                        key = ((snap.meta or {}).get('taken_at_ms'), get_config_meta('scorecard').get('hash'))
+                        st.session_state['analytics_job'] = ('corpus', get_job_pool().submit('analytics', key, job_corpus_analytics, sc))
+                    job = take_finished_job('analytics_job', 'corpus', "ANALYZING CORPUS")
+                    if job: st.session_state['analytics_result'] = job
+                    done = st.session_state.get('analytics_result')
+                    if done and done['error']:
+                        st.error(f"ANALYTICS FAILED: {done['error']}")
+                    elif done and done['result'] is None:
+                        st.caption("NO MESSAGES IN SNAPSHOT.")
+                    elif done:
+                        report = done['result']
+                        summ, timing = report['summary'], report['timing']
+                        c1, c2, c3 = st.columns(3)
+                        c1.metric("ROOMS GRADED", summ['graded'])
+                        c2.metric(f"PASS ≥{PASS_SCORE}", f"{summ['pass_rate'] * 100:.1f}%")
+                        c3.metric("CRITICAL", f"{summ['critical_rate'] * 100:.1f}%")
+                        mood_corr = summ['mood_score_corr']
+                        st.caption(f"{summ['messages']} MSGS · MEAN MOOD {summ['mean_mood']:.0f} · MOOD↔SCORE r={'n/a' if mood_corr is None else f'{mood_corr:.2f}'} · "
+                                   f"{timing['rows_read']} NEW MSGS TOKENIZED IN {timing['update_ms']:.0f} MS · REPORT {timing['report_ms']:.0f} MS"
+                                   + ("" if HAS_SCIPY else " · NUMPY (NO SCIPY)"))
+                        st.markdown("<h4>CRITERION PASS RATES</h4>", unsafe_allow_html=True)
+                        st.dataframe(report['criteria'], hide_index=True, use_container_width=True)
+                        st.markdown("<h4>PHRASES VS PASSING</h4>", unsafe_allow_html=True)
+                        st.dataframe(report['phrases'], hide_index=True, use_container_width=True)
+                        st.download_button("📥 PHRASE REPORT CSV", report['phrases'].to_csv(index=False).encode('utf-8'),
+                                           "phrase_report.csv", "text/csv", use_container_width=True)
             else:
                 st.info("AGENT INTERFACE ACTIVE")
                 st.markdown("Awaiting customer input. Maintain protocol.")
@@ -1258,3 +4713,8 @@ else:
             <p>SELECT SIMULATION TO ENGAGE</p>
         </div>
         """, unsafe_allow_html=True)
+
+get_session_registry().track()
+
+# Rerun completed normally: record its total time (and cProfile dump if among the slowest)
+get_profiler().end_rerun(st.session_state.pop('_profile_run', None))
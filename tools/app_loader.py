@@ -0,0 +1,26 @@
+"""Loads `lenovo chat app.py` as a module so offline tools can drive its data layer.
+
+The app reads its settings (LENOVO_CHAT_DB, LENOVO_CHAT_SHARDS, ...) from the
+environment at import time, so pass overrides as keyword arguments. Streamlit
+runs in "bare mode" here: UI calls are no-ops and only the functions matter.
+"""
+import importlib.util
+import itertools
+import os
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "lenovo chat app.py")
+_counter = itertools.count()
+
+
+def load_app(**env):
+    for key, value in env.items():
+        os.environ[key] = str(value)
+    # Bare mode warns on every st.* call; keep tool output readable
+    import streamlit.config
+    import streamlit.logger
+    streamlit.config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level("error")
+    spec = importlib.util.spec_from_file_location(f"lenovo_chat_app_{next(_counter)}", APP_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,237 @@
+"""Grading regression benchmark: agreement with a labeled corpus + throughput by transcript length.
+
+The corpus (tools/data/grading_corpus.jsonl) holds synthetic and anonymized transcripts, one per
+line: {"id", "source", "messages": [[role, text], ...], "expected": {"critical": bool,
+"breakdown": {criterion_id: "PASS"|"FAIL"}}}. Only the criteria a reviewer judged are labeled;
+an empty expected breakdown means "nothing should be graded".
+
+    python tools/bench_grading.py                                   # report to stdout
+    python tools/bench_grading.py --out report.json                 # stable JSON for diffing branches
+    python tools/bench_grading.py --write-baseline                  # accept current numbers
+    python tools/bench_grading.py --check                           # exit 1 on regression vs baseline
+    python tools/bench_grading.py --anonymize qa_database.db --limit 50 --candidates new.jsonl
+
+--anonymize turns real rooms into corpus candidates (names, emails and numbers scrubbed, labels
+pre-filled from the current grader and marked "reviewed": false) for a human to correct.
+Throughput depends on the machine: compare baselines taken on the same host.
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import re
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from app_loader import load_app
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CORPUS = os.path.join(HERE, "data", "grading_corpus.jsonl")
+BASELINE = os.path.join(HERE, "data", "grading_baseline.json")
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        raw = f.read()
+    items = [json.loads(line) for line in raw.splitlines() if line.strip()]
+    return items, hashlib.sha1(raw.encode()).hexdigest()[:12]
+
+
+def frame(messages):
+    return pd.DataFrame([{'role': role, 'text': text} for role, text in messages], columns=['role', 'text'])
+
+
+def accuracy(app, sc, corpus):
+    names = {item['id']: item['name'] for item in sc}
+    per, mismatches = {}, []
+    crit = {'tp': 0, 'fp': 0, 'fn': 0, 'tn': 0}
+    exact = 0
+    for t in corpus:
+        breakdown, note, _ = app.auto_grade_chat(frame(t['messages']), sc)
+        found = note if note and note.startswith("Critical Fail") else None # Not "No Agent messages..."
+        want = t['expected']
+        ok = True
+        if 'critical' in want:
+            key = ('t' if bool(found) == want['critical'] else 'f') + ('p' if found else 'n')
+            crit[key] += 1
+            if key[0] == 'f':
+                ok = False
+                mismatches.append({'id': t['id'], 'criterion': 'CRITICAL', 'expected': want['critical'], 'actual': found or False})
+        labels = want.get('breakdown', {})
+        if labels == {} and 'breakdown' in want and breakdown:
+            ok = False
+            mismatches.append({'id': t['id'], 'criterion': 'BREAKDOWN', 'expected': {}, 'actual': 'graded'})
+        for cid, expected in sorted(labels.items()):
+            actual = breakdown.get(names.get(cid), "MISSING")
+            stat = per.setdefault(cid, {'labels': 0, 'agree': 0, 'false_pass': 0, 'false_fail': 0})
+            stat['labels'] += 1
+            if actual == expected:
+                stat['agree'] += 1
+                continue
+            ok = False
+            stat['false_pass' if actual == "PASS" else 'false_fail'] += 1
+            mismatches.append({'id': t['id'], 'criterion': cid, 'expected': expected, 'actual': actual})
+        exact += ok
+    labels = sum(s['labels'] for s in per.values())
+    for s in per.values(): s['rate'] = round(s['agree'] / s['labels'], 4)
+    return {
+        'criteria_agreement': round(sum(s['agree'] for s in per.values()) / labels, 4) if labels else 1.0,
+        'critical_accuracy': round((crit['tp'] + crit['tn']) / max(1, sum(crit.values())), 4),
+        'transcript_exact': round(exact / len(corpus), 4) if corpus else 1.0,
+        'critical': crit,
+        'per_criterion': dict(sorted(per.items())),
+        'mismatches': mismatches,
+    }
+
+
+def synthetic(corpus, length, count, seed):
+    """Transcripts of `length` messages recombined from corpus lines (fixed seed)."""
+    rnd = random.Random(seed * 7919 + length)
+    lines = [m for t in corpus for m in t['messages']]
+    return [frame([rnd.choice(lines) for _ in range(length)]) for _ in range(count)]
+
+
+def throughput(app, sc, corpus, lengths, min_seconds, repeats):
+    """Best-of-`repeats` transcripts/second for auto_grade_chat + calculate_final_score."""
+    out = {}
+    for length in lengths:
+        batch = synthetic(corpus, length, 50, 1)
+        best = 0.0
+        for _ in range(repeats):
+            done, t0 = 0, time.perf_counter()
+            while True:
+                for msgs in batch:
+                    breakdown, found, _ = app.auto_grade_chat(msgs, sc)
+                    app.calculate_final_score(breakdown, found, sc)
+                done += len(batch)
+                elapsed = time.perf_counter() - t0
+                if elapsed >= min_seconds: break
+            best = max(best, done / elapsed)
+        out[str(length)] = float(f"{best:.3g}")
+    return out
+
+
+def compare(report, base, max_drop, max_slowdown):
+    failures = []
+    for key in ('criteria_agreement', 'critical_accuracy', 'transcript_exact'):
+        if report['accuracy'][key] < base['accuracy'][key] - max_drop:
+            failures.append(f"{key}: {report['accuracy'][key]:.4f} < baseline {base['accuracy'][key]:.4f} - {max_drop}")
+    for length, tps in report['throughput'].items():
+        ref = base['throughput'].get(length)
+        if ref and tps < ref * (1 - max_slowdown):
+            failures.append(f"throughput @{length} msgs: {tps:g}/s < baseline {ref:g}/s - {max_slowdown:.0%}")
+    return failures
+
+
+ANON_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.]+"), "<email>"),
+    (re.compile(r"\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b"), "<date>"),
+    (re.compile(r"\+?\d[\d\s-]{5,}\d"), "<num>"),
+    (re.compile(r"\b\d{4,}\b"), "<num>"),
+]
+
+
+def anonymize_text(text, people):
+    for name in people:
+        if name: text = re.sub(rf"\b{re.escape(name)}\b", "<name>", text, flags=re.IGNORECASE)
+    for pat, repl in ANON_PATTERNS:
+        text = pat.sub(repl, text)
+    return text
+
+
+def export_candidates(app, sc, args):
+    conn = app.get_unified_connection()
+    try:
+        rooms = conn.execute("SELECT id, host, agent, scenario_id FROM all_rooms ORDER BY id DESC LIMIT ?", (args.limit,)).fetchall()
+        names = {item['name']: item['id'] for item in sc}
+        n = 0
+        with open(args.candidates, "w", encoding="utf-8") as f:
+            for rid, host, agent, scenario_id in rooms:
+                rows = conn.execute("SELECT sender, role, text FROM all_messages WHERE room_id = ? ORDER BY id", (rid,)).fetchall()
+                if not rows: continue
+                people = {host, agent} | {r[0] for r in rows}
+                scenario = app.get_scenarios().get(scenario_id)
+                if scenario: people.add(scenario['name'])
+                people = {p for p in people if p and p != 'Waiting...'}
+                people |= {part for p in people for part in p.split() if len(part) > 2} # "Bob" as well as "Bob Jones"
+                people = sorted(people, key=len, reverse=True)
+                messages = [[role, anonymize_text(str(text), people)] for _, role, text in rows]
+                breakdown, note, _ = app.auto_grade_chat(frame(messages), sc)
+                found = note and note.startswith("Critical Fail")
+                f.write(json.dumps({'id': f"anon-{hashlib.sha1(str(rid).encode()).hexdigest()[:8]}", 'source': "anonymized",
+                                    'reviewed': False, 'messages': messages,
+                                    'expected': {'critical': bool(found), 'breakdown': {names[k]: v for k, v in breakdown.items() if k in names}}}) + "\n")
+                n += 1
+    finally:
+        conn.close()
+    print(f"wrote {n} candidate transcripts to {args.candidates} (review the labels before adding them to the corpus)")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--corpus", default=CORPUS)
+    p.add_argument("--baseline", default=BASELINE)
+    p.add_argument("--out", help="write the JSON report here")
+    p.add_argument("--lengths", type=int, nargs="+", default=[5, 20, 100, 500], help="messages per transcript")
+    p.add_argument("--min-seconds", type=float, default=0.5, help="per length and repeat")
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--check", action="store_true", help="exit 1 if worse than the baseline")
+    p.add_argument("--write-baseline", action="store_true")
+    p.add_argument("--max-accuracy-drop", type=float, default=0.0, help="allowed drop (fraction) in any accuracy figure")
+    p.add_argument("--max-slowdown", type=float, default=0.25, help="allowed throughput loss (fraction) per length")
+    p.add_argument("--anonymize", metavar="DB", help="export rooms from this database as corpus candidates")
+    p.add_argument("--limit", type=int, default=50)
+    p.add_argument("--candidates", default="grading_candidates.jsonl")
+    args = p.parse_args()
+
+    db = args.anonymize or os.path.join(tempfile.mkdtemp(prefix="bench_grading_"), "qa_database.db")
+    app = load_app(LENOVO_CHAT_DB=db, LENOVO_CHAT_SIDE_PORT=0, LENOVO_CHAT_SNAPSHOT_INTERVAL=0)
+    app.init_db()
+    sc = app.get_config('scorecard')
+    if args.anonymize:
+        export_candidates(app, sc, args)
+        return
+
+    corpus, sha = load_corpus(args.corpus)
+    report = {
+        'corpus': {'sha': sha, 'transcripts': len(corpus),
+                   'sources': {s: sum(t.get('source') == s for t in corpus) for s in sorted({t.get('source', '?') for t in corpus})}},
+        'scorecard': app.get_config_meta('scorecard').get('hash'),
+        'accuracy': accuracy(app, sc, corpus),
+        'throughput': throughput(app, sc, corpus, args.lengths, args.min_seconds, args.repeats),
+        'host': {'python': platform.python_version(), 'machine': platform.machine(), 'pandas': pd.__version__},
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w") as f: f.write(text + "\n")
+
+    acc = report['accuracy']
+    print(f"corpus {sha}: {len(corpus)} transcripts {report['corpus']['sources']}")
+    print(f"criteria agreement {acc['criteria_agreement']:.2%} · critical accuracy {acc['critical_accuracy']:.2%} · "
+          f"exact transcripts {acc['transcript_exact']:.2%}")
+    for cid, s in acc['per_criterion'].items():
+        print(f"  {cid:<12} {s['agree']:>3}/{s['labels']:<3} false pass {s['false_pass']}  false fail {s['false_fail']}")
+    for m in acc['mismatches']:
+        print(f"  ✗ {m['id']}: {m['criterion']} expected {m['expected']} got {m['actual']}")
+    print("throughput (transcripts/s): " + "  ".join(f"{k} msgs: {v:g}" for k, v in report['throughput'].items()))
+
+    if args.write_baseline:
+        with open(args.baseline, "w") as f: f.write(text + "\n")
+        print(f"baseline written to {args.baseline}")
+    if args.check:
+        with open(args.baseline) as f: base = json.load(f)
+        if base['corpus']['sha'] != sha: print(f"note: corpus changed since the baseline ({base['corpus']['sha']} -> {sha})")
+        if base['host'] != report['host']: print("note: baseline taken on a different host/version; throughput may not compare")
+        failures = compare(report, base, args.max_accuracy_drop, args.max_slowdown)
+        for line in failures: print(f"REGRESSION {line}")
+        if failures: sys.exit(1)
+        print("no regression against baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""Write-contention benchmark: single SQLite file vs. sharded layout,
+with and without the group-commit writer queue.
+
+Every writer thread hammers send_msg() on random rooms, which is exactly the
+INSERT messages + UPDATE rooms.last_activity_ms pair the live app performs.
+
+    python tools/bench_shards.py --shards 1 4 --group-commit 0 1 --writers 16 --messages 200
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+
+from app_loader import load_app
+
+
+def run_layout(shards, group_commit, args):
+    tmp = tempfile.mkdtemp(prefix=f"bench_shards_{shards}_")
+    app = load_app(LENOVO_CHAT_DB=os.path.join(tmp, "qa_database.db"), LENOVO_CHAT_SHARDS=shards,
+                   LENOVO_CHAT_SHARD_BY=args.strategy, LENOVO_CHAT_GROUP_COMMIT=group_commit)
+    app.init_db()
+    rooms = [app.create_room(f"cohort{i % args.cohorts}") for i in range(args.rooms)]
+
+    latencies = []
+    lock = threading.Lock()
+
+    def writer(n):
+        rnd = random.Random(n)
+        local = []
+        for i in range(args.messages):
+            rid = rnd.choice(rooms)
+            t0 = time.perf_counter()
+            app.send_msg(rid, f"user{n}", "Agent" if i % 2 else "Manager", f"bench message {i} from {n}")
+            local.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.perf_counter() - t0
+
+    # Unified view must still see every room and message
+    listed = len(app.get_rooms())
+    conn = app.get_unified_connection()
+    total_msgs = conn.execute("SELECT COUNT(*) FROM all_messages").fetchone()[0]
+    conn.close()
+
+    commits = app.get_write_queue().stats['commits'] if group_commit else len(latencies)
+    latencies.sort()
+    return {
+        "shards": shards,
+        "group_commit": group_commit,
+        "commits": commits,
+        "msgs_per_s": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95) - 1] * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "rooms_listed": listed,
+        "messages": total_msgs,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--shards", type=int, nargs="+", default=[1, 4])
+    ap.add_argument("--group-commit", type=int, nargs="+", choices=[0, 1], default=[0, 1])
+    ap.add_argument("--strategy", choices=["range", "cohort"], default="cohort")
+    ap.add_argument("--rooms", type=int, default=40)
+    ap.add_argument("--cohorts", type=int, default=8)
+    ap.add_argument("--writers", type=int, default=16)
+    ap.add_argument("--messages", type=int, default=200, help="messages per writer")
+    args = ap.parse_args()
+
+    print(f"{'shards':>6} {'gc':>3} {'msgs/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'commits':>8} {'rooms':>6} {'msgs':>7}")
+    for shards in args.shards:
+        for gc in args.group_commit:
+            r = run_layout(shards, gc, args)
+            print(f"{r['shards']:>6} {r['group_commit']:>3} {r['msgs_per_s']:>9.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+                  f"{r['max_ms']:>8.1f} {r['commits']:>8} {r['rooms_listed']:>6} {r['messages']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Read-snapshot cost: how long a backup-API refresh takes at a given database size, and
+what it does to live send_msg latency when it runs under write load.
+
+    python tools/bench_snapshot.py --rooms 500 --messages 20000 --writers 8 --refreshes 5
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from app_loader import load_app
+
+
+def writer_latencies(app, rooms, args, stop):
+    """Writers send until stop is set; returns every send_msg latency in ms."""
+    out, lock = [], threading.Lock()
+
+    def writer(n):
+        local, i = [], 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            app.send_msg(rooms[(n * 7919 + i) % len(rooms)], f"w{n}", "Agent" if i % 2 else "Manager", f"bench message {i}")
+            local.append((time.perf_counter() - t0) * 1000)
+            i += 1
+        with lock: out.extend(local)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(args.writers)]
+    for t in threads: t.start()
+    return threads, out
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--rooms", type=int, default=300)
+    p.add_argument("--messages", type=int, default=20000, help="seeded before measuring")
+    p.add_argument("--writers", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=3.0, help="per phase")
+    p.add_argument("--refreshes", type=int, default=5, help="snapshots taken during the loaded phase")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_snapshot_")
+    app = load_app(LENOVO_CHAT_DB=os.path.join(tmp, "qa_database.db"), LENOVO_CHAT_SHARDS=args.shards,
+                   LENOVO_CHAT_SIDE_PORT=0, LENOVO_CHAT_SNAPSHOT_INTERVAL=0)
+    app.init_db()
+    rooms = [app.create_room(f"cohort{i % 10}") for i in range(args.rooms)]
+    for i in range(args.messages):
+        app.send_msg(rooms[i % len(rooms)], "seed", "Agent" if i % 2 else "Manager", f"seed message {i} " + "x" * 80)
+    time.sleep(0.5)
+    snap = app.get_snapshot()
+
+    idle = [snap.refresh()['duration_ms'] for _ in range(3)]
+    print(f"snapshot of {snap.meta['bytes'] / 1e6:.1f} MB ({snap.meta['pages']} pages, {args.shards} shard(s)): "
+          f"idle refresh median {statistics.median(idle):.1f} ms")
+
+    for label, refreshes in (("writers only", 0), ("writers + snapshots", args.refreshes)):
+        stop = threading.Event()
+        threads, lat = writer_latencies(app, rooms, args, stop)
+        before = dict(snap.stats)
+        loaded = []
+        t_end = time.time() + args.seconds
+        for _ in range(refreshes):
+            meta = snap.refresh()
+            if meta: loaded.append(meta['duration_ms'])
+            time.sleep(args.seconds / max(1, refreshes) / 2)
+        time.sleep(max(0.0, t_end - time.time()))
+        stop.set()
+        for t in threads: t.join()
+        line = f"{label:<20} sends {len(lat):>6}  p50 {pct(lat, 0.5):7.2f} ms  p99 {pct(lat, 0.99):7.2f} ms  max {max(lat or [0]):8.2f} ms"
+        if refreshes:
+            line += (f"  | refresh median {statistics.median(loaded or [0]):.1f} ms, "
+                     f"{snap.stats['restarts'] - before['restarts']} restarts, {snap.stats['failures'] - before['failures']} failures")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Storage backend conformance checks and a shared benchmark workload.
+
+Every class in the app's STORAGE_BACKENDS runs the same checks (rooms, conditional claims and
+status changes, message order and limits, deletes, config versions, grades, presence), then
+the same timed workload, so a new backend is compared with SQLite on equal terms.
+
+    python tools/bench_storage.py                                  # every backend
+    python tools/bench_storage.py --backends memory --seconds 5
+    python tools/bench_storage.py --threads 8 --out storage.json   # stable JSON for diffing
+    python tools/bench_storage.py --checks-only
+
+Workload per thread, until --seconds is up: pick a room, then send (30%), read the newest 50
+messages (50%), read the room row (15%) or create and claim a room (5%).
+Exit status 1 when a check fails.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+from app_loader import load_app
+
+WORKLOAD = (('send', 0.30), ('read', 0.50), ('room', 0.15), ('create', 0.05))
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+def check(failures, name, ok, msg):
+    print(f"  {'ok  ' if ok else 'FAIL'} {msg}")
+    if not ok: failures.append(f"{name}: {msg}")
+
+
+def ticket(rid, sender, text, role="Agent", flags=None):
+    return {'rid': rid, 'sender': sender, 'role': role, 'text': text, 'flags': flags, 'error': None}
+
+
+def run_threads(n, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(n)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+
+# --- conformance ---
+
+def check_rooms(store, failures):
+    rids = [store.create_room(f"host{i}", scenario_id=i or None) for i in range(3)]
+    check(failures, store.name, len(set(rids)) == 3 and all(rids), f"create_room hands out distinct ids {rids}")
+    room = store.get_room(rids[1])
+    check(failures, store.name, room and (room['id'], room['host'], room['agent'], room['status'], room['scenario_id'], room['graded_at_ms'])
+          == (rids[1], "host1", "Waiting...", "Active", 1, None), "get_room: new room is Active, waiting, ungraded")
+    listed = [r['id'] for r in store.list_rooms()]
+    check(failures, store.name, listed[:3] == rids[::-1], "list_rooms: newest first")
+    check(failures, store.name, store.get_room(max(listed) + 1000) is None, "get_room: unknown id -> None")
+
+
+def check_claims(store, failures):
+    rid, results = store.create_room("claim-host"), {}
+    before = store.get_room(rid)['updated_at_ms']
+    time.sleep(0.002) # Next millisecond: the claim moves updated_at_ms
+    run_threads(16, lambda i: results.__setitem__(i, store.claim_room(rid, f"agent{i}")))
+    winners = [i for i, (claimed, _) in results.items() if claimed]
+    check(failures, store.name, len(winners) == 1, f"claim_room: 16 racing agents -> one winner ({len(winners)})")
+    holder = f"agent{winners[0]}" if winners else None
+    check(failures, store.name, all(h == holder for _, h in results.values()) and store.get_room(rid)['agent'] == holder,
+          "claim_room: every caller and the row name the winner")
+    check(failures, store.name, store.get_room(rid)['updated_at_ms'] > before, "claim_room: bumps updated_at_ms")
+    check(failures, store.name, store.claim_room(rid, "late") == (False, holder), "claim_room: a taken room stays taken")
+    check(failures, store.name, store.claim_room(10 ** 9, "x") == (False, None), "claim_room: unknown room -> (False, None)")
+
+
+def check_status(store, failures):
+    rid = store.create_room("status-host")
+    room = store.get_room(rid)
+    check(failures, store.name, not store.set_status(rid, "Expired", "Offline", room['last_activity_ms']), "set_status: wrong expected status is refused")
+    time.sleep(0.002) # Next millisecond: the message moves last_activity_ms
+    store.add_messages([ticket(rid, "late", "arrived first")])
+    check(failures, store.name, not store.set_status(rid, "Expired", "Active", room['last_activity_ms']), "set_status: stale last_activity_ms is refused")
+    room = store.get_room(rid)
+    time.sleep(0.002)
+    check(failures, store.name, store.set_status(rid, "Expired", "Active", room['last_activity_ms']) and store.get_room(rid)['status'] == "Expired",
+          "set_status: matching expectation applies")
+    check(failures, store.name, store.get_room(rid)['updated_at_ms'] > room['updated_at_ms'], "set_status: bumps updated_at_ms")
+    check(failures, store.name, not store.set_status(rid, "Offline", "Active", room['last_activity_ms']), "set_status: second transition from the same read is refused")
+
+
+def check_messages(store, failures):
+    rid, gone = store.create_room("msg-host"), store.create_room("gone-host")
+    store.delete_rooms([gone])
+    before = store.get_room(rid)['last_activity_ms']
+    batch = [ticket(rid, "a", f"m{i}", flags="cvv" if i == 3 else "") for i in range(5)]
+    batch.insert(2, ticket(gone, "a", "into a deleted room"))
+    time.sleep(0.002)
+    store.add_messages(batch)
+    ok = [t for t in batch if t['rid'] == rid]
+    check(failures, store.name, isinstance(batch[2]['error'], LookupError) and all(t['error'] is None for t in ok),
+          "add_messages: ticket for a deleted room gets LookupError, the rest are written")
+    ids = [t['id'] for t in ok]
+    check(failures, store.name, ids == sorted(ids) and len(set(ids)) == 5 and all(t['timestamp_ms'] for t in ok), "add_messages: ids grow in batch order, timestamps set")
+    msgs = store.get_messages(rid, 0)
+    check(failures, store.name, [m['text'] for m in msgs] == [f"m{i}" for i in range(5)], "get_messages: oldest first")
+    check(failures, store.name, [m['text'] for m in store.get_messages(rid, 2)] == ["m3", "m4"], "get_messages: limit keeps the newest")
+    check(failures, store.name, [m['flags'] for m in msgs] == ["", "", "", "cvv", ""] and set(msgs[0]) >= {'id', 'room_id', 'sender', 'role', 'text', 'timestamp_ms', 'flags'},
+          "get_messages: every message field round-trips")
+    room = store.get_room(rid)
+    check(failures, store.name, room['last_activity_ms'] >= max(before, ok[-1]['timestamp_ms']) and room['updated_at_ms'] >= room['last_activity_ms'],
+          "add_messages: bumps last_activity_ms and updated_at_ms")
+
+    rooms = [store.create_room("race-host") for _ in range(4)]
+    def sender(n):
+        for i in range(50): store.add_messages([ticket(rooms[i % 4], f"s{n}", str(i))])
+    run_threads(8, sender)
+    per, ordered = {}, True
+    for r in rooms:
+        got = {}
+        for m in store.get_messages(r, 0): got.setdefault(m['sender'], []).append(int(m['text']))
+        for sender_, seq in got.items():
+            ordered &= seq == sorted(seq)
+            per.setdefault(sender_, []).extend(seq)
+    check(failures, store.name, ordered and len(per) == 8 and all(sorted(v) == list(range(50)) for v in per.values()),
+          "add_messages: 8 threads x 50 sends -> all stored once, in order per sender and room")
+
+
+def check_delete(store, failures):
+    rid = store.create_room("del-host")
+    store.add_messages([ticket(rid, "a", "bye")])
+    check(failures, store.name, store.delete_rooms([rid]) == 1 and store.get_room(rid) is None and store.get_messages(rid) == [],
+          "delete_rooms: room and messages gone")
+    check(failures, store.name, store.delete_rooms([rid]) == 0, "delete_rooms: deleting again is a no-op")
+
+
+def check_config(store, failures):
+    key = f"bench_storage_{random.random()}"
+    check(failures, store.name, store.get_config(key) is None and store.get_config_version(key) is None, "get_config: unset key -> None")
+    store.set_config(key, {'a': [1, 2]})
+    v1 = store.get_config_version(key)
+    value = store.get_config(key)
+    value['a'].append(3)
+    check(failures, store.name, store.get_config(key) == {'a': [1, 2]}, "get_config: returns a private copy")
+    store.set_config(key, {'a': []})
+    check(failures, store.name, store.get_config(key) == {'a': []} and store.get_config_version(key) > v1, "set_config: replaces the value, bumps the version")
+
+
+def check_grades(store, failures):
+    rid = store.create_room("grade-host")
+    store.mark_graded(rid)
+    check(failures, store.name, store.get_room(rid)['graded_at_ms'], "mark_graded: sets graded_at_ms")
+
+
+def check_presence(store, failures):
+    rid = store.create_room("presence-host")
+    store.beat(rid, "ann", "Agent", typing=True)
+    store.beat(rid, "bob", "Manager")
+    check(failures, store.name, sorted((p['user'], p['typing']) for p in store.room_presence(rid)) == [("ann", True), ("bob", False)],
+          "presence: heartbeats and typing show up per room")
+
+
+CHECKS = (check_rooms, check_claims, check_status, check_messages, check_delete, check_config, check_grades, check_presence)
+
+
+# --- benchmark ---
+
+def benchmark(store, args):
+    rooms = [store.create_room("bench-host") for _ in range(args.rooms)]
+    for rid in rooms: store.claim_room(rid, "bench-agent")
+    for i in range(args.seed):
+        store.add_messages([ticket(rooms[i % len(rooms)], "seed", f"seed {i} " + "x" * 80, role="Manager")])
+    lat, lock = {op: [] for op, _ in WORKLOAD}, threading.Lock()
+
+    def worker(n):
+        rnd, local = random.Random(n), {op: [] for op, _ in WORKLOAD}
+        ops, weights = zip(*WORKLOAD)
+        deadline = time.perf_counter() + args.seconds
+        while time.perf_counter() < deadline:
+            op, rid = rnd.choices(ops, weights)[0], rooms[rnd.randrange(len(rooms))]
+            t0 = time.perf_counter()
+            if op == 'send': store.add_messages([ticket(rid, f"t{n}", "benchmark message " + "y" * 60)])
+            elif op == 'read': store.get_messages(rid, 50)
+            elif op == 'room': store.get_room(rid)
+            else: store.claim_room(store.create_room("bench-host"), f"t{n}")
+            local[op].append((time.perf_counter() - t0) * 1000)
+        with lock:
+            for op, v in local.items(): lat[op] += v
+
+    t0 = time.perf_counter()
+    run_threads(args.threads, worker)
+    wall = time.perf_counter() - t0
+    total = sum(len(v) for v in lat.values())
+    return {'ops_per_s': round(total / wall, 1),
+            'ops': {op: {'calls': len(v), 'p50_ms': round(pct(v, 0.5), 3), 'p99_ms': round(pct(v, 0.99), 3)} for op, v in lat.items()}}
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--backends", nargs="+", help="names from STORAGE_BACKENDS (default: all)")
+    p.add_argument("--shards", type=int, default=1, help="SQLite shard files")
+    p.add_argument("--rooms", type=int, default=200)
+    p.add_argument("--seed", type=int, default=5000, help="messages stored before timing")
+    p.add_argument("--threads", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=3.0)
+    p.add_argument("--checks-only", action="store_true")
+    p.add_argument("--out", help="write the JSON report here")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench_storage_")
+    app = load_app(LENOVO_CHAT_DB=os.path.join(tmp, "qa_database.db"), LENOVO_CHAT_SHARDS=args.shards, LENOVO_CHAT_SIDE_PORT=0,
+                   LENOVO_CHAT_SNAPSHOT_INTERVAL=0, LENOVO_CHAT_RETENTION_INTERVAL=0, LENOVO_CHAT_TRACE="",
+                   LENOVO_CHAT_BLOBS=os.path.join(tmp, "attachments"))
+    app.init_db()
+    names = args.backends or list(app.STORAGE_BACKENDS)
+    unknown = set(names) - set(app.STORAGE_BACKENDS)
+    if unknown: raise SystemExit(f"unknown backend(s) {sorted(unknown)}; have {sorted(app.STORAGE_BACKENDS)}")
+
+    failures, report = [], {}
+    for name in names:
+        print(f"[{name}]")
+        store = app.STORAGE_BACKENDS[name]()
+        for fn in CHECKS:
+            try: fn(store, failures)
+            except Exception as e: check(failures, name, False, f"{fn.__name__} raised {e!r}")
+        if args.checks_only: continue
+        report[name] = benchmark(app.STORAGE_BACKENDS[name](), args)
+
+    if report:
+        print(f"\n{args.threads} threads x {args.seconds:g}s, {args.rooms} rooms, {args.seed} seeded messages")
+        print(f"{'backend':<10}{'ops/s':>10}   " + "   ".join(f"{op + ' p50/p99 ms':<22}" for op, _ in WORKLOAD))
+        for name, r in report.items():
+            cells = [f"{o['p50_ms']:.3f} / {o['p99_ms']:.3f}" for o in r['ops'].values()]
+            print(f"{name:<10}{r['ops_per_s']:>10.0f}   " + "   ".join(f"{c:<22}" for c in cells))
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(json.dumps({'params': {k: getattr(args, k) for k in ('shards', 'rooms', 'seed', 'threads', 'seconds')},
+                                'backends': report, 'failures': failures}, indent=2, sort_keys=True) + "\n")
+    print(f"{len(failures)} check(s) failed" if failures else "all checks pass")
+    if failures: raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
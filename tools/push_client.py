@@ -0,0 +1,140 @@
+"""Stand-in browser for the side channel's push stream (GET /events?room=N).
+
+Listen to a running app and print every event for a room. The stream needs the push token
+of a logged-in session that has the room open (st.session_state['push_token']):
+
+    python tools/push_client.py listen --url http://localhost:8765 --room 12 --token 3f9c...
+
+Or run a self-contained check: load the app against a temp database with its own
+side-channel port, hold --clients streams open on one room, send --messages through
+send_msg() and report send -> event latency next to what the polling fragment costs:
+
+    python tools/push_client.py selftest --clients 20 --messages 50 --group-commit 1
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def stream_events(host, port, room, on_event, token="push-client", stop=None, timeout=30.0):
+    """Blocking SSE reader: calls on_event(kind, data_dict) until the stream ends or stop is set."""
+    sock = socket.create_connection((host, port), timeout=timeout)
+    try:
+        sock.sendall(f"GET /events?room={room}&token={token} HTTP/1.1\r\nHost: {host}\r\nAccept: text/event-stream\r\n\r\n".encode())
+        f = sock.makefile("rb")
+        status = f.readline().decode("latin-1").strip()
+        if " 200 " not in status + " ":
+            raise RuntimeError(f"stream refused: {status}")
+        while f.readline() not in (b"\r\n", b""):
+            pass
+        kind, data = "message", []
+        while not (stop and stop.is_set()):
+            line = f.readline()
+            if not line: break
+            line = line.decode().rstrip("\n")
+            if line.startswith("event:"): kind = line[6:].strip()
+            elif line.startswith("data:"): data.append(line[5:].strip())
+            elif line == "" and data:
+                on_event(kind, json.loads("\n".join(data)))
+                kind, data = "message", []
+    finally:
+        sock.close()
+
+
+def listen(args):
+    url = urlparse(args.url)
+    t0 = time.time()
+    def show(kind, data):
+        print(f"{time.time() - t0:8.3f}s  {kind:<9} {json.dumps(data)}", flush=True)
+    stream_events(url.hostname, url.port or 80, args.room, show, token=args.token, timeout=None)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def selftest(args):
+    from app_loader import load_app
+    tmp = tempfile.mkdtemp(prefix="push_client_")
+    port = free_port()
+    app = load_app(LENOVO_CHAT_DB=os.path.join(tmp, "qa_database.db"), LENOVO_CHAT_SIDE_PORT=port,
+                   LENOVO_CHAT_SIDE_HOST="127.0.0.1", LENOVO_CHAT_GROUP_COMMIT=args.group_commit)
+    app.init_db()
+    side = app.get_side_channel()
+    if not side.running:
+        raise SystemExit(f"side channel did not start: {side.error}")
+    rid = app.create_room("push_host")
+    for n in range(args.clients): side.grant(f"client{n}", rid, f"push_client{n}", "Agent") # What a rendered page does
+
+    stop = threading.Event()
+    sends = []     # perf_counter of each send_msg, in order
+    arrivals = []  # (client, kind, perf_counter)
+    lock = threading.Lock()
+
+    def client(n):
+        def got(kind, data):
+            with lock: arrivals.append((n, kind, time.perf_counter()))
+        try: stream_events("127.0.0.1", port, rid, got, token=f"client{n}", stop=stop, timeout=args.timeout)
+        except OSError: pass
+
+    threads = [threading.Thread(target=client, args=(n,), daemon=True) for n in range(args.clients)]
+    for t in threads: t.start()
+    deadline = time.time() + 5
+    while side.subscriber_count() < args.clients and time.time() < deadline: time.sleep(0.01)
+    print(f"{side.subscriber_count()}/{args.clients} streams open on room {rid} (port {port})")
+
+    app.join_room(rid, "push_agent")
+    time.sleep(args.interval)
+    for i in range(args.messages):
+        sends.append(time.perf_counter())
+        app.send_msg(rid, "push_host" if i % 2 else "push_agent", "Manager" if i % 2 else "Agent", f"push message {i}")
+        time.sleep(args.interval)
+    stop.set()
+
+    # Sends are spaced wider than the expected latency: pair each event with the latest send before it
+    latencies, statuses = [], 0
+    for n, kind, at in arrivals:
+        if kind == "status": statuses += 1
+        if kind != "message": continue
+        before = [s for s in sends if s <= at]
+        if before: latencies.append((at - before[-1]) * 1000)
+    expected = args.clients * args.messages
+    print(f"status events: {statuses}/{args.clients}  message events: {len(latencies)}/{expected}  "
+          f"(coalesced {side.stats['coalesced']})")
+    if latencies:
+        latencies.sort()
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        print(f"push latency ms: p50 {statistics.median(latencies):.2f}  p95 {p95:.2f}  max {latencies[-1]:.2f}")
+    print(f"polling fragment: mean {app.PUSH_POLL_SECONDS * 500:.0f} ms, worst {app.PUSH_POLL_SECONDS * 1000:.0f} ms "
+          f"(+ one query per open tab every {app.PUSH_POLL_SECONDS:g}s)")
+    if len(latencies) < expected or statuses < args.clients:
+        raise SystemExit("missed events")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = p.add_subparsers(dest="mode", required=True)
+    l = sub.add_parser("listen", help="print events from a running app")
+    l.add_argument("--url", default="http://localhost:8765")
+    l.add_argument("--room", type=int, required=True)
+    l.add_argument("--token", required=True, help="push token of a session that has the room open")
+    t = sub.add_parser("selftest", help="in-process publish/subscribe latency check")
+    t.add_argument("--clients", type=int, default=10)
+    t.add_argument("--messages", type=int, default=30)
+    t.add_argument("--interval", type=float, default=0.05, help="seconds between sends")
+    t.add_argument("--group-commit", type=int, default=1, choices=[0, 1])
+    t.add_argument("--timeout", type=float, default=30.0)
+    args = p.parse_args()
+    listen(args) if args.mode == "listen" else selftest(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Re-drives a recorded traffic trace against a copy of the database it started from and compares
+call latencies with the recording.
+
+Record with LENOVO_CHAT_TRACE=trace.jsonl (or the DIAGNOSTICS toggle, which writes to traces/).
+Starting a recording also copies every shard file to <trace>.base/; replays start from there.
+
+    python tools/replay.py traces/trace_20261019_101500.jsonl            # original pacing
+    python tools/replay.py trace.jsonl --speed 10 --workers 32           # 10x faster
+    python tools/replay.py trace.jsonl --speed 0 --out after.json        # as fast as possible
+    python tools/replay.py trace.jsonl --compare before.json             # fix verified?
+    python tools/replay.py trace.jsonl --db qa_database.db               # start from another copy
+
+Each recorded session replays in order on one worker (sessions are spread over --workers threads)
+at its original offset divided by --speed. Rooms created during the trace get fresh ids in the
+copy; later calls are remapped, and wait for the create they depend on.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+
+from app_loader import load_app
+
+ROOM_OPS = {'send_msg', 'get_msgs', 'get_live_msgs', 'check_room_status', 'join_room', 'delete_room'}
+
+
+def load_trace(path):
+    header, calls = None, []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip(): continue
+            e = json.loads(line)
+            if e['op'] == 'start':
+                if header is None: header = e
+                continue
+            calls.append(e)
+    if header is None:
+        raise SystemExit(f"{path}: no 'start' line (not written by the recorder?)")
+    calls.sort(key=lambda e: e['t'])
+    return header, calls
+
+
+def copy_base(src_db, shards, target_dir):
+    """Copies the catalog file and its shard files (qa_database.db, qa_database.shardN.db)."""
+    base, ext = os.path.splitext(src_db)
+    names = [src_db] + [f"{base}.shard{s}{ext or '.db'}" for s in range(1, shards)]
+    for name in names:
+        if not os.path.exists(name): raise SystemExit(f"missing database file {name}")
+        shutil.copy2(name, os.path.join(target_dir, os.path.basename(name)))
+    return os.path.join(target_dir, os.path.basename(src_db))
+
+
+def pct(values, q):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 3) if values else None
+
+
+class Replayer:
+    def __init__(self, app, calls, speed):
+        self.app = app
+        self.speed = speed
+        self.t_first = calls[0]['t'] if calls else 0.0
+        self.rids = {}  # recorded room id -> replay room id
+        self.created = {e['result']: threading.Event() for e in calls if e['op'] == 'create_room' and 'result' in e}
+        self.lock = threading.Lock()
+        self.results = []  # (op, recorded_ms, replay_ms, lag_ms, error)
+
+    def rid(self, recorded):
+        ev = self.created.get(recorded)
+        if ev is not None: ev.wait(30)
+        with self.lock: return self.rids.get(recorded, recorded)
+
+    def call(self, e):
+        app, op, args, kwargs = self.app, e['op'], list(e.get('args', [])), e.get('kwargs', {})
+        if op in ROOM_OPS and args: args[0] = self.rid(args[0])
+        if op == 'room_page': return app.get_room_index().page(*args, **kwargs)
+        result = getattr(app, op)(*args, **kwargs)
+        if op == 'create_room' and 'result' in e:
+            with self.lock: self.rids[e['result']] = result
+            self.created[e['result']].set()
+        return result
+
+    def worker(self, calls, t0):
+        for e in calls:
+            due = t0 + (e['t'] - self.t_first) / self.speed if self.speed else time.perf_counter()
+            wait = due - time.perf_counter()
+            if wait > 0: time.sleep(wait)
+            start = time.perf_counter()
+            error = None
+            try: self.call(e)
+            except Exception as ex: error = repr(ex)
+            ms = (time.perf_counter() - start) * 1000
+            with self.lock:
+                self.results.append((e['op'], e['ms'], ms, max(0.0, (start - due) * 1000), error))
+
+    def run(self, calls, workers):
+        lanes = [[] for _ in range(workers)]
+        for e in calls: lanes[zlib.crc32(str(e['session']).encode()) % workers].append(e)
+        start = time.perf_counter()
+        t0 = start + 0.2 # Schedule anchor: lets every thread start before the first call is due
+        threads = [threading.Thread(target=self.worker, args=(lane, t0)) for lane in lanes if lane]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        return time.perf_counter() - start
+
+
+def report(results, wall_s, app, header, sessions, args):
+    ops = {}
+    for op, rec_ms, ms, lag, error in results:
+        o = ops.setdefault(op, {'recorded': [], 'replay': [], 'errors': 0})
+        o['recorded'].append(rec_ms)
+        o['replay'].append(ms)
+        o['errors'] += error is not None
+    lags = [r[3] for r in results]
+    stmts, _ = app.get_query_stats().snapshot()
+    return {
+        'trace': {'calls': len(results), 'sessions': sessions, 'shards': header['shards'], 'speed': args.speed, 'workers': args.workers},
+        'wall_s': round(wall_s, 3),
+        'lag_ms': {'p95': pct(lags, 0.95), 'max': pct(lags, 1.0)},
+        'ops': {op: {'calls': len(o['replay']), 'errors': o['errors'],
+                     'recorded': {q: pct(o['recorded'], v) for q, v in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))},
+                     'replay': {q: pct(o['replay'], v) for q, v in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))}}
+                for op, o in sorted(ops.items())},
+        'writer': dict(app.get_write_queue().stats),
+        'lock_errors': sum(s['lock_errors'] for s in stmts.values()),
+    }
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("trace")
+    p.add_argument("--db", help="start from this database instead of <trace>.base/")
+    p.add_argument("--speed", type=float, default=1.0, help="time compression; 0 = no pacing")
+    p.add_argument("--workers", type=int, default=0, help="threads (default: one per session, max 64)")
+    p.add_argument("--group-commit", type=int, choices=[0, 1], help="override the recorded setting")
+    p.add_argument("--out", help="write the JSON report here")
+    p.add_argument("--compare", help="earlier --out report to diff against")
+    p.add_argument("--keep", action="store_true", help="keep the replay database copy")
+    args = p.parse_args()
+
+    header, calls = load_trace(args.trace)
+    if not calls: raise SystemExit("trace holds no calls")
+    sessions = {e['session'] for e in calls}
+    args.workers = args.workers or min(64, len(sessions))
+
+    tmp = tempfile.mkdtemp(prefix="replay_")
+    src = args.db or os.path.join(os.path.dirname(os.path.abspath(args.trace)), header['base'], header['db'])
+    db = copy_base(src, header['shards'], tmp)
+    group_commit = header.get('group_commit', True) if args.group_commit is None else bool(args.group_commit)
+    app = load_app(LENOVO_CHAT_DB=db, LENOVO_CHAT_SHARDS=header['shards'], LENOVO_CHAT_GROUP_COMMIT=int(group_commit),
+                   LENOVO_CHAT_SIDE_PORT=0, LENOVO_CHAT_SNAPSHOT_INTERVAL=0, LENOVO_CHAT_RETENTION_INTERVAL=0,
+                   LENOVO_CHAT_TRACE="", LENOVO_CHAT_BLOBS=os.path.join(tmp, "attachments"))
+    app.init_db()
+
+    span = calls[-1]['t'] - calls[0]['t']
+    print(f"{len(calls)} calls from {len(sessions)} sessions over {span:.1f}s -> {args.workers} workers at "
+          f"{'full speed' if not args.speed else f'{args.speed:g}x'} (copy in {tmp})")
+    rep = Replayer(app, calls, args.speed)
+    wall = rep.run(calls, args.workers)
+    out = report(rep.results, wall, app, header, len(sessions), args)
+
+    print(f"replayed in {out['wall_s']:.2f}s · schedule lag p95 {out['lag_ms']['p95']} ms, max {out['lag_ms']['max']} ms · "
+          f"lock errors {out['lock_errors']}")
+    print(f"{'op':<18}{'calls':>7}{'errors':>7}   {'recorded p50/p95/p99 ms':<28}{'replay p50/p95/p99 ms'}")
+    for op, o in out['ops'].items():
+        rec, rp = o['recorded'], o['replay']
+        print(f"{op:<18}{o['calls']:>7}{o['errors']:>7}   {rec['p50']:>7} {rec['p95']:>8} {rec['p99']:>8}    {rp['p50']:>7} {rp['p95']:>8} {rp['p99']:>8}")
+
+    if args.compare:
+        with open(args.compare) as f: before = json.load(f)
+        print("replay p95 vs --compare:")
+        for op, o in out['ops'].items():
+            ref = before['ops'].get(op, {}).get('replay', {}).get('p95')
+            if ref: print(f"  {op:<18} {ref:>8} -> {o['replay']['p95']:>8} ms ({(o['replay']['p95'] / ref - 1) * 100:+.0f}%)")
+    if args.out:
+        with open(args.out, "w") as f: f.write(json.dumps(out, indent=2, sort_keys=True) + "\n")
+    if not args.keep: shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Multi-worker consistency and throughput check: several processes run the data layer on one
+database (as Streamlit workers behind a local reverse proxy would, LENOVO_CHAT_MULTI_WORKER=1)
+and race on the same rooms.
+
+    python tools/stress_multiworker.py                                # 4 workers, every scenario
+    python tools/stress_multiworker.py --workers 8 --rooms 100
+    python tools/stress_multiworker.py --only sends --scaling 1 2 4 --seconds 5
+
+Scenarios, and what is asserted after each:
+  join    every worker joins every waiting room at once: one winner per room, the row names it
+  status  every worker checks the same stale rooms at once: each room changes status exactly once
+  clear   every worker clears the same rooms while others send into them: one replacement per
+          room and every worker gets its id; old rooms are gone; no message outlives its room
+  sends   mixed sends + reads from 1, 2, 4... workers: nothing lost, duplicated or reordered per
+          sender; other workers' hubs see each message within --max-visibility-ms; throughput
+          with N workers stays above --min-scaling x the 1-worker figure (checked only while N
+          does not exceed the CPU count; oversubscribed runs are reported)
+Exit status 1 when an invariant fails.
+"""
+import argparse
+import multiprocessing as mp
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from app_loader import load_app
+
+SCENARIOS = ("join", "status", "clear", "sends")
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+# --- worker process ---
+
+def worker_main(wid, env, commands, results):
+    app = load_app(**env, LENOVO_CHAT_WORKER_ID=wid)
+    results.put((wid, 'ready', None))
+    while True:
+        cmd = commands.get()
+        if cmd is None: return
+        name, start_at, params = cmd
+        time.sleep(max(0.0, start_at - time.time())) # Everyone starts together
+        try: out = globals()[f"run_{name}"](app, wid, params)
+        except Exception as e: out = {'crash': repr(e)}
+        results.put((wid, name, out))
+
+
+def run_join(app, wid, p):
+    rooms = list(p['rooms'])
+    random.Random(wid).shuffle(rooms)
+    return {'won': [rid for rid in rooms if app.join_room(rid, f"agent-w{wid}")]}
+
+
+def run_status(app, wid, p):
+    rooms = list(p['rooms'])
+    random.Random(wid).shuffle(rooms)
+    statuses = {rid: app.check_room_status(rid)[0] for rid in rooms}
+    hub = app.get_room_hub()
+    return {'transitions': hub.transitions, 'conflicts': hub.conflicts, 'statuses': statuses}
+
+
+def run_clear(app, wid, p):
+    stop, errors, sent = threading.Event(), [], [0]
+
+    def spam(): # Sends racing the deletes
+        i = 0
+        while not stop.is_set():
+            try:
+                app.send_msg(p['rooms'][i % len(p['rooms'])], f"spam-w{wid}", "Manager", f"spam {i}")
+                sent[0] += 1
+            except Exception as e: errors.append(type(e).__name__)
+            i += 1
+
+    t = threading.Thread(target=spam)
+    t.start()
+    rooms = list(p['rooms'])
+    random.Random(wid).shuffle(rooms)
+    replaced = {rid: app.job_clear_room(rid, p['host']) for rid in rooms}
+    stop.set()
+    t.join()
+    return {'replaced': replaced, 'sent': sent[0], 'errors': sorted(set(errors))}
+
+
+def run_sends(app, wid, p):
+    """p['threads'] senders, each doing 1 send + p['reads'] reads per op, for p['seconds'];
+    a watcher thread notes when this worker's hub first shows other workers' messages."""
+    rooms, stop = p['rooms'], threading.Event()
+    seen, sent, ops, lat = {}, {}, [0] * p['threads'], []
+
+    def watch():
+        hub, tag = app.get_room_hub(), f"-{p['tag']}" # Earlier runs' messages are already cached
+        while not stop.is_set():
+            for rid in rooms:
+                for m in hub.get_msgs(rid, 0):
+                    if m['sender'].endswith(tag) and not m['sender'].startswith(f"w{wid}-") and m['id'] not in seen:
+                        seen[m['id']] = time.time() * 1000 - m['timestamp_ms'] # Stamped inside the write transaction
+            time.sleep(0.01)
+
+    def sender(n):
+        rnd, i = random.Random(wid * 1000 + n), 0
+        name = f"w{wid}-t{n}-{p['tag']}"
+        deadline = time.time() + p['seconds']
+        while time.time() < deadline:
+            rid = rooms[rnd.randrange(len(rooms))]
+            t0 = time.perf_counter()
+            app.send_msg(rid, name, "Agent" if i % 2 else "Manager", f"{name} #{i}")
+            lat.append((time.perf_counter() - t0) * 1000)
+            for _ in range(p['reads']):
+                rid = rooms[rnd.randrange(len(rooms))]
+                app.get_live_msgs(rid, 50)
+                app.check_room_status(rid)
+            ops[n] += 1 + p['reads']
+            i += 1
+        sent[name] = i
+
+    w = threading.Thread(target=watch)
+    w.start()
+    threads = [threading.Thread(target=sender, args=(n,)) for n in range(p['threads'])]
+    t0 = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.time() - t0
+    time.sleep(p['settle'])
+    stop.set()
+    w.join()
+    return {'sent': sent, 'ops': sum(ops), 'wall': wall,
+            'visibility_ms': list(seen.values()), 'send_ms': lat, 'synced': app.get_room_hub().synced}
+
+
+# --- coordinator ---
+
+class Pool:
+    def __init__(self, n, env):
+        ctx = mp.get_context("spawn")
+        self.results = ctx.Queue()
+        self.commands = [ctx.Queue() for _ in range(n)]
+        self.procs = [ctx.Process(target=worker_main, args=(w, env, self.commands[w], self.results), daemon=True) for w in range(n)]
+        for p in self.procs: p.start()
+        for _ in range(n): self.results.get(timeout=120)
+
+    def run(self, name, params, workers=None):
+        workers = range(len(self.procs)) if workers is None else workers
+        start_at = time.time() + 0.5
+        for w in workers: self.commands[w].put((name, start_at, params))
+        out = {}
+        for _ in workers:
+            wid, _, res = self.results.get(timeout=600)
+            if 'crash' in res: raise SystemExit(f"worker {wid} crashed in {name}: {res['crash']}")
+            out[wid] = res
+        return out
+
+    def close(self):
+        for q in self.commands: q.put(None)
+        for p in self.procs: p.join(10)
+
+
+def shard_files(db, shards):
+    base, ext = os.path.splitext(db)
+    return [db] + [f"{base}.shard{s}{ext or '.db'}" for s in range(1, shards)]
+
+
+def db_rows(db, shards, query, params=()):
+    rows = []
+    for path in shard_files(db, shards):
+        conn = sqlite3.connect(path, timeout=30)
+        try: rows += conn.execute(query, params).fetchall()
+        finally: conn.close()
+    return rows
+
+
+def check(failures, ok, msg):
+    print(f"  {'ok  ' if ok else 'FAIL'} {msg}")
+    if not ok: failures.append(msg)
+
+
+def scenario_join(app, pool, args, failures):
+    rooms = [app.create_room("stress-host") for _ in range(args.rooms)]
+    out = pool.run("join", {'rooms': rooms})
+    winners = {}
+    for wid, res in out.items():
+        for rid in res['won']: winners.setdefault(rid, []).append(wid)
+    check(failures, all(len(winners.get(rid, [])) == 1 for rid in rooms),
+          f"join: {len(rooms)} rooms x {len(out)} workers -> one winner each ({sum(len(v) for v in winners.values())} wins)")
+    agents = dict(db_rows(args.db, args.shards, f"SELECT id, agent FROM rooms WHERE id IN ({','.join('?' * len(rooms))})", rooms))
+    check(failures, all(agents[rid] == f"agent-w{winners[rid][0]}" for rid in rooms if len(winners.get(rid, [])) == 1),
+          "join: stored agent is the winner")
+
+
+def scenario_status(app, pool, args, failures):
+    rooms = [app.create_room("stress-host") for _ in range(args.rooms)]
+    for rid in rooms:
+        app.join_room(rid, "stress-agent")
+        app.send_msg(rid, "stress-host", "Manager", "still there?") # Agent's turn
+    stale = app.now_ms() - 400 * 1000 # Past the 300 s expiry, short of the 600 s offline mark
+    for path in shard_files(args.db, args.shards):
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute(f"UPDATE rooms SET last_activity_ms = ? WHERE id IN ({','.join('?' * len(rooms))})", (stale, *rooms))
+        conn.commit()
+        conn.close()
+    out = pool.run("status", {'rooms': rooms})
+    won = sum(r['transitions'] for r in out.values())
+    check(failures, won == len(rooms), f"status: {len(rooms)} stale rooms -> {won} transitions ({sum(r['conflicts'] for r in out.values())} lost races)")
+    check(failures, all(s == 'Expired' for r in out.values() for s in r['statuses'].values()), "status: every worker reports Expired")
+    stored = db_rows(args.db, args.shards, f"SELECT status FROM rooms WHERE id IN ({','.join('?' * len(rooms))})", rooms)
+    check(failures, stored and all(s == 'Expired' for (s,) in stored), "status: stored as Expired")
+
+
+def scenario_clear(app, pool, args, failures):
+    sid = app.get_scenarios().list()[0]['id']
+    rooms = [app.create_room("clear-host", sid) for _ in range(args.rooms)]
+    for rid in rooms: app.send_msg(rid, "clear-host", "Manager", "before clear")
+    out = pool.run("clear", {'rooms': rooms, 'host': "clear-host"})
+    agree = all(len({res['replaced'][rid] for res in out.values()}) == 1 and out[0]['replaced'][rid] for rid in rooms)
+    check(failures, agree, f"clear: {len(rooms)} rooms x {len(out)} workers -> every worker got the same replacement")
+    new = [out[0]['replaced'][rid] for rid in rooms]
+    hosted = db_rows(args.db, args.shards, "SELECT id, scenario_id FROM rooms WHERE host = 'clear-host'")
+    check(failures, sorted(r[0] for r in hosted) == sorted(new) and all(r[1] == sid for r in hosted),
+          f"clear: exactly {len(rooms)} replacement rooms with the scenario ({len(hosted)} found)")
+    left = db_rows(args.db, args.shards, f"SELECT COUNT(*) FROM rooms WHERE id IN ({','.join('?' * len(rooms))})", rooms)
+    check(failures, sum(n for (n,) in left) == 0, "clear: old rooms deleted")
+    orphans = db_rows(args.db, args.shards, "SELECT COUNT(*) FROM messages WHERE room_id NOT IN (SELECT id FROM rooms)")
+    errors = sorted({e for res in out.values() for e in res['errors']})
+    check(failures, sum(n for (n,) in orphans) == 0,
+          f"clear: no orphaned messages ({sum(r['sent'] for r in out.values())} racing sends, rejected as {errors or 'none'})")
+
+
+def scenario_sends(app, pool, args, failures):
+    rooms = [app.create_room("send-host") for _ in range(args.send_rooms)]
+    for rid in rooms: app.join_room(rid, "send-agent")
+    params = {'rooms': rooms, 'threads': args.threads, 'reads': args.reads, 'seconds': args.seconds, 'settle': 1.0}
+    rates, visibility = {}, []
+    for n in args.scaling:
+        if n > args.workers: continue
+        out = pool.run("sends", dict(params, tag=f"x{n}"), workers=range(n))
+        sent = {name: k for res in out.values() for name, k in res['sent'].items()}
+        rows = db_rows(args.db, args.shards, f"SELECT id, sender, text FROM messages WHERE room_id IN ({','.join('?' * len(rooms))}) AND sender IN ({','.join('?' * len(sent))})",
+                       (*rooms, *sent))
+        per = {}
+        for mid, sender, text in sorted(rows):
+            per.setdefault(sender, []).append(int(text.split('#')[1].split()[0]))
+        intact = all(per.get(name) == list(range(k)) for name, k in sent.items())
+        check(failures, intact, f"sends x{n}: {sum(sent.values())} messages stored once each, in send order per sender")
+        rates[n] = sum(res['ops'] for res in out.values()) / max(res['wall'] for res in out.values())
+        vis = [v for res in out.values() for v in res['visibility_ms']]
+        visibility += vis
+        send = [v for res in out.values() for v in res['send_ms']]
+        print(f"        {n} worker(s): {rates[n]:8.0f} ops/s ({sum(sent.values()) / max(res['wall'] for res in out.values()):.0f} sends/s, "
+              f"send p50 {pct(send, 0.5):.1f} ms p99 {pct(send, 0.99):.1f} ms max {max(send):.0f} ms)"
+              + (f" · cross-worker visibility p50 {pct(vis, 0.5):.0f} ms p95 {pct(vis, 0.95):.0f} ms max {max(vis):.0f} ms" if vis else ""))
+    if visibility:
+        check(failures, pct(visibility, 0.95) <= args.max_visibility_ms,
+              f"sends: other workers see a message within {args.max_visibility_ms:g} ms (p95 {pct(visibility, 0.95):.0f} ms)")
+    base, cpus = rates.get(1), os.cpu_count() or 1
+    for n, r in sorted(rates.items()):
+        if base and n > cpus:
+            print(f"  --   sends: {n} workers at {r / base:.2f}x the 1-worker rate (not checked: {cpus} CPU(s) here)")
+        elif base and n > 1:
+            check(failures, r >= base * args.min_scaling, f"sends: {n} workers at {r / base:.2f}x the 1-worker rate (floor {args.min_scaling:g}x)")
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--shards", type=int, default=1)
+    p.add_argument("--rooms", type=int, default=40, help="rooms per race scenario")
+    p.add_argument("--send-rooms", type=int, default=20)
+    p.add_argument("--threads", type=int, default=4, help="sender threads per worker")
+    p.add_argument("--reads", type=int, default=4, help="reads per send in the sends scenario")
+    p.add_argument("--seconds", type=float, default=3.0, help="per sends run")
+    p.add_argument("--scaling", type=int, nargs="+", default=[1, 2, 4], help="worker counts for the sends scenario")
+    p.add_argument("--min-scaling", type=float, default=0.8, help="N-worker throughput floor as a multiple of 1 worker")
+    p.add_argument("--max-visibility-ms", type=float, default=1000.0)
+    p.add_argument("--group-commit", type=int, default=1, choices=[0, 1])
+    p.add_argument("--only", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    p.add_argument("--db", help="database file (default: fresh temp file)")
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="stress_mw_")
+    args.db = args.db or os.path.join(tmp, "qa_database.db")
+    env = dict(LENOVO_CHAT_DB=args.db, LENOVO_CHAT_SHARDS=args.shards, LENOVO_CHAT_MULTI_WORKER=1,
+               LENOVO_CHAT_GROUP_COMMIT=args.group_commit, LENOVO_CHAT_SIDE_PORT=0, LENOVO_CHAT_SNAPSHOT_INTERVAL=0,
+               LENOVO_CHAT_RETENTION_INTERVAL=0, LENOVO_CHAT_TRACE="", LENOVO_CHAT_BLOBS=os.path.join(tmp, "attachments"))
+    app = load_app(**env, LENOVO_CHAT_WORKER_ID=args.workers) # Coordinator: sets up rooms, reads results
+    app.init_db()
+    mode = sqlite3.connect(args.db).execute("PRAGMA journal_mode").fetchone()[0]
+    print(f"{args.workers} workers on {args.db} ({args.shards} shard(s), journal {mode}, group commit {args.group_commit})")
+
+    pool = Pool(args.workers, env)
+    failures = []
+    try:
+        for name in args.only:
+            print(f"[{name}]")
+            globals()[f"scenario_{name}"](app, pool, args, failures)
+    finally:
+        pool.close()
+    print(f"{len(failures)} invariant(s) failed" if failures else "all invariants hold")
+    if failures: raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()